@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# benchmarks the thread pool and asyncio transfer engines of s3lib against a local S3 stand-in,
+# e.g. minio or moto_server. When no endpoint is given, an in-process moto server is started
+# (pip install "moto[server]"). With -storage-root, the thread engine runs against the local
+# storage backend instead, which measures the pipelines at disk speed. Example:
+#   python extras/bench_s3_engines.py -count 2000 -size 4096 -threads 10 -concurrency 200
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.joinpath("scripts")))
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-endpoint-url",
+    dest="endpointUrl",
+    help="the url of the S3 stand-in, an in-process moto server is used by default",
+)
+parser.add_argument(
+    "-storage-root",
+    dest="storageRoot",
+    help="benchmark the local storage backend in this folder (STORAGE_BACKEND=local), threads engine only",
+)
+parser.add_argument(
+    "-bucket",
+    dest="bucket",
+    help="the bucket to use, it is created when missing",
+    default="cloudburst-bench",
+)
+parser.add_argument(
+    "-count", dest="count", type=int, help="the number of objects", default=1000
+)
+parser.add_argument(
+    "-size",
+    dest="size",
+    type=int,
+    help="the size of each object in bytes",
+    default=4096,
+)
+parser.add_argument(
+    "-threads",
+    dest="threads",
+    type=int,
+    help="the number of threads for the thread engine",
+    default=10,
+)
+parser.add_argument(
+    "-concurrency",
+    dest="concurrency",
+    type=int,
+    help="the number of requests in flight for the async engine",
+    default=200,
+)
+
+
+def main(args):
+    server = None
+    endpoint_url = args.endpointUrl
+    engines = [("threads", args.threads), ("async", args.concurrency)]
+    if args.storageRoot is not None:
+        os.environ["STORAGE_BACKEND"] = "local"
+        os.environ["STORAGE_ROOT"] = args.storageRoot
+        endpoint_url = f"local storage {args.storageRoot}"
+        engines = engines[:1]
+    elif endpoint_url is None:
+        from moto.server import ThreadedMotoServer
+
+        server = ThreadedMotoServer(port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        endpoint_url = f"http://{host}:{port}"
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    if args.storageRoot is None:
+        os.environ["S3_ENDPOINT_URL"] = endpoint_url
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ.setdefault("AWS_DEFAULT_REGION", os.environ["AWS_REGION"])
+
+    import s3lib
+
+    client = s3lib.get_client()
+    try:
+        client.create_bucket(Bucket=args.bucket)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-s3-"))
+    try:
+        source = work_dir.joinpath("source")
+        for i in range(args.count):
+            file = source.joinpath(f"p{i % 10}", f"m{i}", "output.pkl")
+            os.makedirs(file.parent, exist_ok=True)
+            file.write_bytes(os.urandom(args.size))
+
+        results = []
+        for engine, concurrency in engines:
+            prefix = f"bench-{engine}/"
+            start = time.perf_counter()
+            rc = s3lib.put_files(
+                args.bucket, source, prefix, threads=concurrency, engine=engine
+            )
+            put_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            rc = rc or s3lib.get_files(
+                args.bucket,
+                prefix,
+                str(work_dir.joinpath(engine)),
+                threads=concurrency,
+                use_cache=False,
+                engine=engine,
+            )
+            get_seconds = time.perf_counter() - start
+            results.append((engine, concurrency, put_seconds, get_seconds, rc))
+
+        print(f"\n{args.count} objects of {args.size} bytes at {endpoint_url}")
+        print(f"{'engine':<8} {'in flight':>9} {'put obj/s':>10} {'get obj/s':>10} rc")
+        for engine, concurrency, put_seconds, get_seconds, rc in results:
+            print(
+                f"{engine:<8} {concurrency:>9} {args.count / put_seconds:>10.0f} {args.count / get_seconds:>10.0f} {rc}"
+            )
+    finally:
+        shutil.rmtree(work_dir)
+        if server is not None:
+            server.stop()
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main(args)
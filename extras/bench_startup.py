@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# benchmarks the cold start of fw_entrypoint.py: the time from starting the framework in a new
+# interpreter to the start of its first task, for a tasks document shaped like tasks.json, in
+# local mode so no transfers are made. The first run validates the document, the others find it
+# in the validation cache. Exits with 1 when the median is over -max-ms, to catch regressions.
+# With -importtime, the modules that take longest to import are listed. Example:
+#   python extras/bench_startup.py -runs 20 -max-ms 500
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPTS_DIR = Path(__file__).parent.parent.joinpath("scripts")
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-runs", dest="runs", type=int, help="the number of cold starts", default=10
+)
+parser.add_argument(
+    "-max-ms",
+    dest="maxMs",
+    type=float,
+    help="the most milliseconds the median time to the first task may take",
+    default=1000,
+)
+parser.add_argument(
+    "-importtime",
+    dest="importTime",
+    action="store_true",
+    help="list the modules that take longest to import",
+)
+parser.add_argument(
+    "-top",
+    dest="top",
+    type=int,
+    help="the number of modules listed with -importtime",
+    default=15,
+)
+
+
+# a document with the phases of tasks.json, whose first task records the time it started
+def write_tasks(work_dir: Path):
+    marker = work_dir.joinpath("first-task.txt")
+    tasks = {
+        "programName": "startup benchmark",
+        "itemName": "${WORK_ITEM}",
+        "fetch": [
+            {
+                "name": "get-profiles",
+                "bucket": "${BUCKET_NAME}",
+                "key": "input/profiles/",
+                "dest": "./input/profiles/",
+            }
+        ],
+        "tasks": [
+            {
+                "name": "first-task",
+                "command": f'{sys.executable} -S -c "import time; print(time.time())" > {marker}',
+            }
+        ],
+        "store": [
+            {
+                "name": "store-output-files",
+                "bucket": "${BUCKET_NAME}",
+                "source": "./output/",
+                "dest": "output/${WORK_ITEM}/",
+            }
+        ],
+    }
+    tasks_path = work_dir.joinpath("tasks.json")
+    with open(tasks_path, "w") as f:
+        json.dump(tasks, f, indent=2)
+    return tasks_path, marker
+
+
+# the seconds from starting the framework to the start of its first task
+def time_to_first_task(env: dict, work_dir: Path, marker: Path):
+    if marker.exists():
+        marker.unlink()
+    start = time.time()
+    result = subprocess.run(
+        [sys.executable, str(SCRIPTS_DIR.joinpath("fw_entrypoint.py"))],
+        cwd=work_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0 or not marker.exists():
+        print(f"error: the framework exited with {result.returncode}\n{result.stderr}")
+        return None
+    return float(marker.read_text()) - start
+
+
+def print_import_times(env: dict, work_dir: Path, top: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import fw_entrypoint"],
+        cwd=work_dir,
+        env=dict(env, PYTHONPATH=str(SCRIPTS_DIR)),
+        capture_output=True,
+        text=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    times = []
+    for line in result.stderr.splitlines()[1:]:
+        fields = line[len("import time:") :].split("|")
+        if len(fields) == 3:
+            times.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+    print("slowest imports of fw_entrypoint (cumulative ms, self ms):")
+    for cumulative, own, name in sorted(times, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} {own / 1000:8.1f}  {name}")
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = Path(temp_dir)
+        tasks_path, marker = write_tasks(work_dir)
+        env = dict(
+            os.environ,
+            LOCAL_MODE="1",
+            TASKS_PATH=str(tasks_path),
+            TASKS_VALIDATION_CACHE=str(work_dir.joinpath("validated-tasks.json")),
+            WORK_ITEM="bench",
+            BUCKET_NAME="bench",
+            RUNTIME_HISTORY_FILE=str(work_dir.joinpath("runtime-history.json")),
+        )
+
+        seconds = []
+        for run in range(args.runs):
+            elapsed = time_to_first_task(env, work_dir, marker)
+            if elapsed is None:
+                return 2
+            seconds.append(elapsed)
+            label = "validating" if run == 0 else "cached"
+            print(f"run {run + 1}: {elapsed * 1000:.0f} ms to the first task ({label})")
+
+        warm = seconds[1:] or seconds
+        median_ms = statistics.median(warm) * 1000
+        print(
+            f"time to first task: first run {seconds[0] * 1000:.0f} ms, median {median_ms:.0f} ms, min {min(warm) * 1000:.0f} ms, max {max(warm) * 1000:.0f} ms over {len(warm)} runs"
+        )
+        if args.importTime:
+            print_import_times(env, work_dir, args.top)
+
+    if median_ms > args.maxMs:
+        print(f"error: the median of {median_ms:.0f} ms is over {args.maxMs:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    exit(main(args))
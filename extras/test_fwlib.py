@@ -40,5 +40,31 @@ def test_move():
     fwlib.move_files(move, "default")
 
 
+# the tasks in dependency order, and None (no exception) for cycles or unknown tasks. Checked
+def test_task_order():
+    def names(order):
+        return None if order is None else [task["name"] for task in order]
+
+    tasks = [
+        {"name": "report", "dependsOn": ["run-a", "run-b"]},
+        {"name": "run-a", "dependsOn": ["prepare"]},
+        {"name": "run-b", "dependsOn": ["prepare"]},
+        {"name": "prepare"},
+    ]
+    assert names(fwlib._task_order(tasks)) == ["prepare", "run-a", "run-b", "report"]
+
+    cycle = [
+        {"name": "a", "dependsOn": ["c"]},
+        {"name": "b", "dependsOn": ["a"]},
+        {"name": "c", "dependsOn": ["b"]},
+        {"name": "d"},
+    ]
+    assert fwlib._task_order(cycle) is None
+    assert fwlib._task_order([{"name": "a", "dependsOn": ["a"]}]) is None
+    assert fwlib._task_order([{"name": "a", "dependsOn": ["missing"]}]) is None
+    assert fwlib._task_order([{"name": "a"}, {"name": "a"}]) is None
+
+
 # test_store_sub('test-bh22')
+test_task_order()
 test_move()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# tests the transfer journal against the local storage backend, so no AWS account is needed. The
+# results are checked: run with python extras/test_journallib.py, or with pytest
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.joinpath("scripts")))
+
+import journallib
+import s3lib
+import storagelib
+
+TEST_ROOT = tempfile.mkdtemp(prefix="test-journallib-")
+# the journal settings are read on import, and the module may have been imported by other tests
+journallib.JOURNAL_DIR = os.path.join(TEST_ROOT, "journal")
+journallib.JOURNAL_S3 = None
+journallib.JOURNAL_ID = "test-job"
+
+MB = 1024 * 1024
+
+
+# a client that counts the parts uploaded, and fails the upload of the parts in fail_parts
+class PartClient:
+    def __init__(self, client, fail_parts=()):
+        self.client = client
+        self.fail_parts = fail_parts
+        self.uploaded = []
+        self._lock = threading.Lock()
+
+    def upload_part(self, **kwargs):
+        if kwargs["PartNumber"] in self.fail_parts:
+            raise PermissionError(f"part {kwargs['PartNumber']} refused by the test")
+        response = self.client.upload_part(**kwargs)
+        with self._lock:
+            self.uploaded.append(kwargs["PartNumber"])
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def test_resume_multipart_upload():
+    client = storagelib.LocalClient(os.path.join(TEST_ROOT, "storage"))
+    client.create_bucket(Bucket="bkt")
+    s3lib.configure_transfer(multipart_threshold=1 * MB, multipart_chunksize=1 * MB)
+    local_file = Path(TEST_ROOT).joinpath("big.bin")
+    data = os.urandom(5 * MB + 123)
+    local_file.write_bytes(data)
+
+    # the first attempt stops with parts 2 and 5 missing
+    first = PartClient(client, fail_parts=(2, 5))
+    try:
+        s3lib.put_file_resumable("bkt", first, local_file, "in/big.bin")
+        assert False, "the first attempt must fail"
+    except PermissionError:
+        pass
+    assert sorted(first.uploaded) == [1, 3, 4, 6]
+
+    # the next attempt reads the journal from disk and uploads only the missing parts
+    journallib._entries = None
+    second = PartClient(client)
+    etag = s3lib.put_file_resumable("bkt", second, local_file, "in/big.bin")
+    assert sorted(second.uploaded) == [2, 5]
+    assert client.get_object(Bucket="bkt", Key="in/big.bin")["Body"].read() == data
+    assert etag.strip('"') == s3lib.local_etag(local_file, 1 * MB)
+    assert journallib.get("multipart", "bkt", "in/big.bin") is None
+
+    # a third attempt finds the completed upload in the journal and uploads nothing
+    journallib._entries = None
+    third = PartClient(client)
+    assert s3lib.put_file("bkt", third, local_file, "in/big.bin") == 0
+    assert third.uploaded == []
+
+    # the file changed: its journal entry no longer applies
+    local_file.write_bytes(os.urandom(5 * MB + 123))
+    assert not s3lib.is_journaled_put("bkt", local_file, "in/big.bin")
+
+    journallib.remove()
+    assert not journallib.journal_path().exists()
+
+
+if __name__ == "__main__":
+    test_resume_multipart_upload()
+    print("journallib tests passed")
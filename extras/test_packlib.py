@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# tests packlib against the local storage backend, so no AWS account is needed. The results are
+# checked: run with python extras/test_packlib.py, or with pytest
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent.joinpath("scripts")))
+
+import packlib
+import s3lib
+import storagelib
+
+TEST_ROOT = tempfile.mkdtemp(prefix="test-packlib-")
+os.makedirs(os.path.join(TEST_ROOT, "storage", "bkt"), exist_ok=True)
+# the backend is read on import, and the module may have been imported by other tests. The
+# shared client is rebuilt for the local backend
+storagelib.BACKEND = "local"
+storagelib.STORAGE_ROOT = os.path.join(TEST_ROOT, "storage")
+s3lib.configure_transfer()
+
+
+def write_outputs(folder: str, name: str, n_files: int):
+    files = {}
+    for i in range(n_files):
+        member = f"sub{i % 3}/{name}-{i}.csv"
+        files[member] = os.urandom(100 * i + 1)
+        path = Path(folder).joinpath(member)
+        os.makedirs(path.parent, exist_ok=True)
+        path.write_bytes(files[member])
+    return files
+
+
+def read_files(folder: str):
+    return {
+        path.relative_to(folder).as_posix(): path.read_bytes()
+        for path in Path(folder).rglob("*")
+        if path.is_file()
+    }
+
+
+def test_pack_round_trip():
+    source = os.path.join(TEST_ROOT, "round-trip")
+    files = write_outputs(source, "r", 20)
+    # small shards, so members are spread over several shards and several ranged reads
+    assert packlib.put_packed("bkt", source, "packed/", shard_size=2000) == 0
+
+    index = packlib.get_index("bkt", "packed")
+    assert sorted(index["members"]) == sorted(files)
+    assert len(index["shards"]) > 1
+
+    local_path = os.path.join(TEST_ROOT, "round-trip-all")
+    assert packlib.get_packed("bkt", "packed/", local_path) == 0
+    assert read_files(local_path) == files
+
+    local_path = os.path.join(TEST_ROOT, "round-trip-filtered")
+    assert packlib.get_packed("bkt", "packed/", local_path, filter="^sub1/") == 0
+    assert read_files(local_path) == {
+        member: data for member, data in files.items() if member.startswith("sub1/")
+    }
+
+
+def test_packs_of_several_work_items():
+    files = {}
+    for work_item in ["Dam001", "Dam002/Period03"]:
+        source = os.path.join(TEST_ROOT, "items", work_item)
+        files.update(write_outputs(source, work_item.replace("/", "-"), 5))
+        assert (
+            packlib.put_packed("bkt", source, "shared/", shard_size=500, name=work_item)
+            == 0
+        )
+
+    keys = os.listdir(os.path.join(TEST_ROOT, "storage", "bkt", "shared"))
+    assert "pack-index-Dam001.json" in keys
+    assert "pack-index-Dam002-Period03.json" in keys
+    assert "pack-Dam001-00000.tar" in keys
+
+    local_path = os.path.join(TEST_ROOT, "items-fetched")
+    assert packlib.get_packed("bkt", "shared/", local_path) == 0
+    assert read_files(local_path) == files
+
+
+def test_no_pack():
+    local_path = os.path.join(TEST_ROOT, "nothing")
+    assert packlib.get_packed("bkt", "nothing/", local_path) == 221
+
+
+if __name__ == "__main__":
+    test_pack_round_trip()
+    test_packs_of_several_work_items()
+    test_no_pack()
+    print("packlib tests passed")
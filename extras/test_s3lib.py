@@ -65,6 +65,92 @@ def test_put_files(bucket: str):
     )
 
 
+# the sharded listing yields the same entries, in the same order, as a flat listing. Runs against
+# the local storage backend and is checked
+def test_list_object_info_sharded():
+    import tempfile
+    import storagelib
+
+    client = storagelib.LocalClient(tempfile.mkdtemp(prefix="test-s3lib-"))
+    client.create_bucket(Bucket="bkt")
+    keys = [
+        "out/top.txt",
+        "out/a/1.csv",
+        "out/a/b/2.csv",
+        "out/a/b/c/3.csv",
+        "out/a-b/4.csv",
+        "out/a0",
+        "out/b/5.csv",
+        "out/b/d/6.csv",
+        "out/\u00e9t\u00e9/7.csv",
+        "out/z.txt",
+        "other/8.csv",
+    ]
+    for i in range(1500):
+        keys.append(f"out/many/{i % 7}/file{i:05d}.csv")
+    for key in keys:
+        client.put_object(Bucket="bkt", Key=key, Body=key.encode("utf-8"))
+
+    for prefix in ["out/", "out/a", "out/many/", "missing/"]:
+        flat = [
+            (obj["Key"], obj["Size"], obj["ETag"])
+            for obj in s3lib.list_object_info("bkt", client, prefix, depth=0)
+        ]
+        for depth in [1, 2, 3]:
+            sharded = [
+                (obj["Key"], obj["Size"], obj["ETag"])
+                for obj in s3lib.list_object_info_sharded(
+                    "bkt", client, prefix, depth, threads=4
+                )
+            ]
+            assert sharded == flat, f"prefix {prefix} depth {depth}"
+        assert len(flat) == len([key for key in keys if key.startswith(prefix)])
+
+
+# the adaptive limit grows while the throughput improves, settles back to the best limit, and is
+# halved on throttling, within its bounds. Checked
+def test_adaptive_limiter():
+    from botocore.exceptions import ClientError
+
+    MB = 1024 * 1024
+    limiter = s3lib.AdaptiveLimiter(min_limit=2, max_limit=16, initial=4)
+
+    def window(n_bytes: int, throttles: int = 0):
+        limiter._window_bytes = n_bytes
+        limiter._window_errors = throttles
+        limiter._adjust(1.0)
+        return limiter.limit
+
+    assert window(100 * MB) == 6
+    assert window(200 * MB) == 9
+    # not faster than the best window: back to the limit of the best window
+    assert window(150 * MB) == 6
+    assert window(300 * MB) == 9
+    assert window(400 * MB) == 13
+    assert window(500 * MB) == 16
+    assert window(600 * MB) == 16
+    assert window(600 * MB, throttles=1) == 8
+    assert window(600 * MB, throttles=2) == 4
+    assert window(600 * MB, throttles=1) == 2
+    assert window(600 * MB, throttles=1) == 2
+    assert limiter.peak_limit == 16
+    assert limiter.n_backoffs == 4
+
+    # throttled transfers reported by release end the window and halve the limit
+    limiter = s3lib.AdaptiveLimiter(min_limit=1, max_limit=64, initial=8)
+    slow_down = ClientError(
+        {"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate"}},
+        "GetObject",
+    )
+    for i in range(20):
+        limiter.acquire()
+        limiter.release(0, error=slow_down)
+    assert limiter.limit == 4
+    assert limiter.n_backoffs == 1
+
+
+test_list_object_info_sharded()
+test_adaptive_limiter()
 test_put_files("test-bruceh")
 
 # use an incomplete prefix to retrieve a single file
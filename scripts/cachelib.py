@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# a local, content-addressed cache of objects fetched from S3. Objects are stored by bucket, key
+# and ETag, so a changed object is never served from the cache. Point FETCH_CACHE_DIR to a
+# persistent volume to keep the cache across runs, retries and containers.
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+GB = 1024 * 1024 * 1024
+
+# the cache is disabled unless a directory is provided
+CACHE_DIR = os.getenv("FETCH_CACHE_DIR")
+CACHE_MAX_BYTES = int(float(os.getenv("FETCH_CACHE_MAX_GB", "10")) * GB)
+# 'link' hardlinks cached files into place (falling back to a copy across devices), 'copy' always
+# copies. Use 'copy' if tasks modify their input files in place
+CACHE_MODE = os.getenv("FETCH_CACHE_MODE", "link")
+
+_evict_lock = threading.Lock()
+# the size of the cache, found by the first eviction of the job and kept up to date by add, so
+# later evictions do not walk the cache directory again while the cache fits
+_cache_bytes = None
+
+
+def is_enabled():
+    return CACHE_DIR is not None and CACHE_DIR != ""
+
+
+# the cache location of an object. The key is hashed so any key maps to a safe file name
+def cache_path(bucket: str, key: str, etag: str):
+    key_hash = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    tag = "".join(c for c in etag if c.isalnum() or c == "-")
+    return Path(CACHE_DIR).joinpath(bucket, key_hash[:2], f"{key_hash}-{tag}")
+
+
+# returns the cached file for the object, or None when it is not cached. A hit refreshes the
+# file's modification time, which is used for least-recently-used eviction
+def lookup(bucket: str, key: str, etag: str, size: int):
+    path = cache_path(bucket, key, etag)
+    try:
+        if path.stat().st_size != size:
+            # a partial or modified entry, discard it
+            path.unlink()
+            return None
+        os.utime(path)
+        return path
+    except FileNotFoundError:
+        return None
+
+
+# a temporary file name inside the cache, on the same device as the cached objects. Unique unless
+# a name is given
+def temp_path(name: str = None):
+    tmp_dir = Path(CACHE_DIR).joinpath("tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    return tmp_dir.joinpath(name or uuid.uuid4().hex)
+
+
+# moves a freshly downloaded file into the cache
+def add(bucket: str, key: str, etag: str, downloaded_file: Path):
+    global _cache_bytes
+    path = cache_path(bucket, key, etag)
+    os.makedirs(path.parent, exist_ok=True)
+    size = os.stat(downloaded_file).st_size
+    # atomic, so concurrent fetches of the same object never see a partial file
+    os.replace(downloaded_file, path)
+    with _evict_lock:
+        if _cache_bytes is not None:
+            _cache_bytes += size
+    return path
+
+
+# places a cached file at local_file
+def materialize(cached_file: Path, local_file: Path):
+    local_file = Path(local_file)
+    if local_file.parent != Path(""):
+        os.makedirs(local_file.parent, exist_ok=True)
+    if local_file.exists():
+        local_file.unlink()
+
+    if CACHE_MODE == "link":
+        try:
+            os.link(cached_file, local_file)
+            return
+        except OSError:
+            # e.g. the cache is on another device
+            pass
+    shutil.copyfile(cached_file, local_file)
+
+
+# removes the least recently used objects until the cache fits in max_bytes
+def evict(max_bytes: int = None):
+    global _cache_bytes
+    if not is_enabled():
+        return
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    with _evict_lock:
+        if _cache_bytes is not None and _cache_bytes <= max_bytes:
+            return
+        entries = []
+        total = 0
+        for root, dirs, files in os.walk(CACHE_DIR):
+            if Path(root).name == "tmp":
+                continue
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        _cache_bytes = total
+        if total <= max_bytes:
+            return
+
+        n_removed = 0
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            n_removed += 1
+        _cache_bytes = total
+        print(f"fetch cache: evicted {n_removed} objects, {total / GB:.2f} GB remain")
@@ -1,7 +1,7 @@
 ﻿# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
 import os
 from pathlib import Path
-import s3lib, fwlib, ziplib
+import s3lib, fwlib, manifestlib, packlib, ziplib
 
 # this will compress folders in the input folder into zip files
 def compress_inputs(
@@ -9,6 +9,7 @@ def compress_inputs(
     zip_folder: Path = "zipped.tmp/",
     level: int = 1,
     filter: str = None,
+    format: str = "7z",
 ):
     if not (os.path.exists(source_folder)):
         print("Cannot find inputFolder {0}, exiting".format(source_folder))
@@ -19,13 +20,19 @@ def compress_inputs(
 
     for dir in source_folder.rglob(filter):
         if dir.is_dir():
-            out_file = f"{str(dir).replace(str(source_folder), str(zip_folder))}.7z"
+            out_file = (
+                f"{str(dir).replace(str(source_folder), str(zip_folder))}.{format}"
+            )
             print(out_file)
 
             if os.path.exists(out_file):
                 os.remove(out_file)
 
-            ziplib.compress(source_path=dir, zip_path=out_file)
+            if format == "7z":
+                ziplib.compress(source_path=dir, zip_path=out_file)
+            else:
+                # tar archives can be expanded while they download, see the fetch 'stream' option
+                ziplib.compress_tar(source_path=dir, zip_path=out_file)
 
 
 # load the data into S3
@@ -34,8 +41,12 @@ def upload(
     local_folder: Path = Path("./input.tmp/"),
     prefix: str = "input/",
     filter: str = "*",
-    thread_count: int = 10,
+    thread_count: int = None,
+    sync: bool = False,
+    engine: str = "threads",
 ):
+    if thread_count is None:
+        thread_count = s3lib.DEFAULT_CONCURRENCY[engine]
 
     # load the bucket with files from a local directory. Exclude directory names!
     print(
@@ -47,6 +58,8 @@ def upload(
         prefix=prefix,
         filter=filter,
         threads=thread_count,
+        sync=sync,
+        engine=engine,
     )
 
 
@@ -94,17 +107,56 @@ def get(
     prefix: str,
     filter: str,
     local_folder="output.tmp",
-    thread_count: int = 10,
+    thread_count: int = None,
+    engine: str = "threads",
+    packed: bool = False,
+    list_depth: int = None,
+    manifest: str = None,
+    work_items: list = None,
 ):
+    if thread_count is None:
+        thread_count = s3lib.DEFAULT_CONCURRENCY[engine]
     os.makedirs(local_folder, exist_ok=True)
 
     print(f"getting data from bucket: s3://{bucket}/{prefix} from {local_folder}")
+    if packed:
+        packlib.get_packed(
+            bucket_name=bucket,
+            prefix=prefix,
+            local_path=local_folder,
+            filter=filter,
+            threads=thread_count if engine == "threads" else 0,
+        )
+        return
+    objects = None
+    if manifest is not None:
+        # plan the downloads from the output manifests of the work items, without listing
+        manifests, missing = manifestlib.read_manifests(manifest, work_items)
+        incomplete = [
+            item for item, m in sorted(manifests.items()) if not m.get("complete")
+        ]
+        print(f"output manifests found for {len(manifests)} work items")
+        if len(missing) > 0:
+            print(
+                f"missing outputs for {len(missing)} work items: {', '.join(missing)}"
+            )
+        if len(incomplete) > 0:
+            print(
+                f"incomplete outputs for {len(incomplete)} work items: {', '.join(incomplete)}"
+            )
+        objects = manifestlib.list_objects(manifests, bucket, prefix)
+        if len(objects) == 0:
+            print(f"no outputs under s3://{bucket}/{prefix} in the manifests")
+            return
     s3lib.get_files(
         bucket_name=bucket,
         local_path=local_folder,
         prefix=prefix,
         filter=filter,
         threads=thread_count,
+        engine=engine,
+        list_depth=list_depth,
+        objects=objects,
     )
 
 
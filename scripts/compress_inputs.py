@@ -25,11 +25,21 @@ parser.add_argument(
     dest="filter",
     help='Filters the folder names to be zipped in the source folder, eg. "Site"',
 )
+parser.add_argument(
+    "-format",
+    dest="format",
+    choices=["7z", "tar.gz", "tar"],
+    help='The archive format, defaults to "7z". Tar archives can be expanded while they are fetched',
+    default="7z",
+)
 
 
 def main(args):
     clilib.compress_inputs(
-        source_folder=args.sourceFolder, zip_folder=args.zipFolder, filter=args.filter
+        source_folder=args.sourceFolder,
+        zip_folder=args.zipFolder,
+        filter=args.filter,
+        format=args.format,
     )
 
 
@@ -1,9 +1,223 @@
 ﻿#!/usr/bin/python3
 # cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
-import boto3
+import concurrent.futures
 import fwlib
+import itemslib
+import journallib
+import metricslib
 import os
 import os.path
+import storagelib
+import streamlib
+import time
+import tracelib
+import workerlib
+from pathlib import Path
+
+PHASES = ("fetch", "tasks", "move", "copy", "store")
+
+
+# runs the phases of a tasks document in the order they are listed, and returns the first
+# non-zero return code. With a store_executor, a store phase that comes last, does not stream and
+# only stores sources of the work item is submitted to it, so it runs while the next work item is
+# processed, and its future is returned
+def run_phases(
+    cfg: dict,
+    mode_str: str,
+    local_mode: bool,
+    local_storage: bool,
+    disk_stats: bool,
+    errors_found: bool = False,
+    work_item: str = None,
+    store_executor: concurrent.futures.Executor = None,
+):
+    exit_code = 0
+    return_code = 0
+    store_future = None
+    phases = [element for element in cfg if element in PHASES]
+    for element in cfg:
+        phase_start = time.perf_counter()
+        try:
+            if element == "fetch":
+                if not local_mode or local_storage:
+                    fetches = cfg[element]
+                    return_code = fwlib.process_fetches(mode_str, fetches, errors_found)
+
+                    if disk_stats:
+                        os.system(
+                            "echo disk space: && df -h && echo disk usage: && du -ch"
+                        )
+                else:
+                    return_code = 0
+                    print("skipping fetch tasks in local mode")
+            elif element == "tasks":
+                if not local_mode or local_storage:
+                    # streamed store tasks upload the outputs while the tasks run
+                    streamlib.start(cfg.get("store", []), mode_str, errors_found)
+                tasks_processing = cfg[element]
+                return_code = fwlib.run_tasks(
+                    tasks_processing,
+                    mode_str,
+                    errors_found,
+                    keep_workers=store_executor is not None,
+                )
+
+            elif element == "move":
+                moves = cfg[element]
+                return_code = fwlib.move_files(moves, mode_str, errors_found)
+
+            elif element == "copy":
+                if not local_mode or local_storage:
+                    copies = cfg[element]
+                    return_code = fwlib.process_copies(copies, mode_str, errors_found)
+                else:
+                    return_code = 0
+                    print("skipping copy tasks in local mode")
+
+            elif element == "store":
+                if not local_mode or local_storage:
+                    tasks_store = cfg[element]
+                    if (
+                        store_executor is not None
+                        and element == phases[-1]
+                        and is_item_store(tasks_store, work_item)
+                    ):
+                        print(f"storing the outputs of [{work_item}] in the background")
+                        store_future = store_executor.submit(
+                            store_in_background,
+                            tasks_store,
+                            mode_str,
+                            errors_found,
+                            work_item,
+                        )
+                        continue
+                    return_code = fwlib.process_store(
+                        tasks_store, mode_str, errors_found, work_item
+                    )
+                else:
+                    return_code = 0
+                    print("skipping store tasks in local mode")
+            else:
+                # header elements are ignored
+                return_code = 0
+        except Exception as err:
+            print(f"unexpected error: {str(err)}")
+            return_code = 4
+
+        if element in PHASES:
+            tracelib.complete(
+                element,
+                "phase",
+                phase_start,
+                return_code=return_code,
+                work_item=work_item,
+            )
+
+        if return_code != 0:
+            # set the first non-zero error code encountered
+            if not errors_found:
+                exit_code = return_code
+                errors_found = True
+
+    return exit_code, store_future
+
+
+# true when the store tasks only read sources named after the work item, e.g.
+# ./output/${WORK_ITEM}/, which the next item does not write to. A shared source such as ./output/
+# is stored before the next item starts, or the store would pick up its files. The path components
+# are compared, so that ./output/item-10/ is not taken for a source of item-1
+def is_item_store(tasks_store: list, work_item: str):
+    item_parts = Path(work_item).parts
+    return len(item_parts) > 0 and all(
+        not task.get("stream", False)
+        and _has_parts(Path(task["source"]).parts, item_parts)
+        for task in tasks_store
+    )
+
+
+# true when parts appears as consecutive components of path_parts
+def _has_parts(path_parts: tuple, parts: tuple):
+    return any(
+        path_parts[i : i + len(parts)] == parts
+        for i in range(len(path_parts) - len(parts) + 1)
+    )
+
+
+# the store phase of a work item, run while the next item is processed. Its metrics and output
+# manifest are kept apart from those of the next item's phases
+def store_in_background(
+    tasks_store: list, mode_str: str, errors_found: bool, work_item: str
+):
+    metricslib.reset()
+    with tracelib.span("store", "phase", work_item=work_item) as trace_args:
+        try:
+            return_code = fwlib.process_store(
+                tasks_store, mode_str, errors_found, work_item
+            )
+        except Exception as err:
+            print(f"unexpected error: {str(err)}")
+            return_code = 4
+        trace_args["return_code"] = return_code
+    return return_code
+
+
+# runs the tasks document of each work item in turn, after the fetches they share. An item whose
+# store sources are its own stores its outputs while the next one runs, one store at a time. Returns the first non-zero
+# return code, of the shared fetches or of the items in their order
+def run_work_items(
+    work_items: list,
+    cfgs: list,
+    mode_str: str,
+    local_mode: bool,
+    local_storage: bool,
+    disk_stats: bool,
+):
+    exit_code = 0
+    shared = itemslib.shared_fetches(cfgs)
+    if len(shared) > 0:
+        if not local_mode or local_storage:
+            print(f"fetching the inputs shared by {len(work_items)} work items")
+            with tracelib.span("fetch", "phase", shared=True) as trace_args:
+                try:
+                    exit_code = fwlib.process_fetches(mode_str, shared)
+                except Exception as err:
+                    print(f"unexpected error: {str(err)}")
+                    exit_code = 4
+                trace_args["return_code"] = exit_code
+        else:
+            print("skipping fetch tasks in local mode")
+
+    # (work item, return code, future of its store)
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as store_executor:
+        for count, (work_item, cfg) in enumerate(zip(work_items, cfgs), start=1):
+            print(f"processing work item [{work_item}] {count}/{len(work_items)}")
+            # for the commands of the item, and the processes they start
+            os.environ["WORK_ITEM"] = work_item
+            return_code, store_future = run_phases(
+                cfg,
+                mode_str,
+                local_mode,
+                local_storage,
+                disk_stats,
+                exit_code != 0,
+                work_item,
+                store_executor,
+            )
+            results.append((work_item, return_code, store_future))
+    workerlib.shutdown()
+
+    n_failed = 0
+    for work_item, return_code, store_future in results:
+        if store_future is not None and return_code == 0:
+            return_code = store_future.result()
+        if return_code != 0:
+            print(f"work item [{work_item}] failed with return code {return_code}")
+            n_failed += 1
+            if exit_code == 0:
+                exit_code = return_code
+    print(f"{len(work_items) - n_failed} of {len(work_items)} work items completed")
+    return exit_code
 
 
 def main():
@@ -19,6 +233,8 @@ def main():
     # optional parameters
     disk_stats = os.getenv("DISK_STATS") == "1"
     local_mode = os.getenv("LOCAL_MODE") == "1"
+    # with the local storage backend, fetch, copy and store run in local mode too
+    local_storage = storagelib.is_local()
 
     # can override the default tasks.json with another path
     tasks_path = os.getenv("TASKS_PATH")
@@ -26,71 +242,48 @@ def main():
     log_folder = "./logs"
     os.makedirs(log_folder, exist_ok=True)
 
-    cfg = fwlib.get_validated_task_config(tasks_path)
-    if cfg is None:
+    # with $WORK_ITEMS or $WORK_ITEMS_MANIFEST, the job runs several work items
+    work_items = itemslib.get_work_items()
+    job_work_item = os.getenv("WORK_ITEM")
+    if work_items is None:
+        cfgs = [fwlib.get_validated_task_config(tasks_path)]
+    else:
+        cfgs = itemslib.load_configs(work_items, tasks_path)
+
+    if cfgs is None or cfgs[0] is None:
         print(f"cannot continue as json tasks document is not valid")
     else:
         print(f"starting processing")
         if disk_stats:
             os.system("df -h")  # get linux disk space
 
+        cfg = cfgs[0]
         program = cfg["programName"]
-        item_name = cfg["itemName"]
+        item_name = (
+            cfg["itemName"] if work_items is None else f"{len(work_items)} items"
+        )
         print(
-            f"processing: program [{program}] work item [{item_name}] mode [{mode_str}] local-mode [{local_mode}] region [{aws_region}]"
+            f"processing: program [{program}] work item [{item_name}] mode [{mode_str}] local-mode [{local_mode}] local-storage [{local_storage}] region [{aws_region}]"
         )
-        boto3.setup_default_session(region_name=aws_region)
-
-        exit_code = 0
-        return_code = 0
-        errors_found = False
-        for element in cfg:
-            try:
-                if element == "fetch":
-                    if not local_mode:
-                        fetches = cfg[element]
-                        return_code = fwlib.process_fetches(
-                            mode_str, fetches, errors_found
-                        )
-
-                        if disk_stats:
-                            os.system(
-                                "echo disk space: && df -h && echo disk usage: && du -ch"
-                            )
-                    else:
-                        return_code = 0
-                        print("skipping fetch tasks in local mode")
-                elif element == "tasks":
-                    tasks_processing = cfg[element]
-                    return_code = fwlib.run_tasks(
-                        tasks_processing, mode_str, errors_found
-                    )
-
-                elif element == "move":
-                    moves = cfg[element]
-                    return_code = fwlib.move_files(moves, mode_str, errors_found)
-
-                elif element == "store":
-                    if not local_mode:
-                        tasks_store = cfg[element]
-                        return_code = fwlib.process_store(
-                            tasks_store, mode_str, errors_found
-                        )
-                    else:
-                        return_code = 0
-                        print("skipping store tasks in local mode")
-                else:
-                    # header elements are ignored
-                    return_code = 0
-            except Exception as err:
-                print(f"unexpected error: {str(err)}")
-                return_code = 4
+        # the region of the S3 client, which imports boto3 when a phase first needs it
+        if aws_region:
+            os.environ["AWS_DEFAULT_REGION"] = aws_region
+        # python workers of 'callable' tasks import their modules while the inputs are fetched
+        fwlib.prewarm_callables(cfg.get("tasks", []), mode_str)
 
-            if return_code != 0:
-                # set the first non-zero error code encountered
-                if not errors_found:
-                    exit_code = return_code
-                    errors_found = True
+        if work_items is None:
+            exit_code, _ = run_phases(
+                cfg, mode_str, local_mode, local_storage, disk_stats
+            )
+        else:
+            exit_code = run_work_items(
+                work_items, cfgs, mode_str, local_mode, local_storage, disk_stats
+            )
+            # the trace is named after the job's work item
+            if job_work_item is None:
+                os.environ.pop("WORK_ITEM", None)
+            else:
+                os.environ["WORK_ITEM"] = job_work_item
 
         print(f"processing completed with exit code {exit_code}")
 
@@ -98,6 +291,13 @@ def main():
         if disk_stats:
             os.system("echo Disk space: && df -h && echo disk usage: && du -ch")
 
+        # with $JOB_TRACE_FILE or $JOB_TRACE_S3, the timeline of the job
+        tracelib.write()
+
+        # no attempt will resume from the transfer journal of a job that succeeded
+        if exit_code == 0:
+            journallib.remove()
+
     exit(exit_code)
 
 
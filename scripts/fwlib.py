@@ -2,26 +2,58 @@
 # cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
 # multithreading
 import concurrent.futures
+import hashlib
 import json
 import os.path
 import shutil
+import signal
 import subprocess
+import threading
+import time
 from pathlib import Path
 from typing import List
 
-import jsonschema
+import historylib
+import loglib
+import manifestlib
+import memorylib
+import metricslib
+import packlib
 import s3lib
+import streamlib
+import tracelib
+import workerlib
 import ziplib
 
 # from multiprocessing import Pool
 
 # this variable determines the default behavior, to exit when an error is found. Individual tasks override this behavior
 EXIT_ON_ERROR = True
+# the number of items that tasks declaring dependsOn may run at once, across all tasks. 0 uses the
+# number of processors available
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "0"))
+# the failed items of a task whose output is reported, all are listed in the task summary
+MAX_FAILURES_REPORTED = 10
+# the seconds the running items of a task failing fast get to exit after SIGTERM, before SIGKILL
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "5"))
+MB = 1024 * 1024
+# the hashes of the tasks documents that passed validation, so a document validated before, e.g.
+# by an earlier attempt of the job or an earlier run on the same host, skips loading jsonschema
+VALIDATION_CACHE = os.getenv(
+    "TASKS_VALIDATION_CACHE",
+    str(Path.home().joinpath(".cache", "cloudburst", "validated-tasks.json")),
+)
+# the hashes kept in the cache, the oldest are dropped first
+VALIDATION_CACHE_SIZE = 1000
+
+# schema text: its compiled validator
+_validators = {}
 
 
 # get the input data for all the sites we are going to process
 def process_fetches(mode: str, fetches: list, prior_errors: bool = False):
     return_code = 0
+    metricslib.reset()
 
     # TODO: move elsewhere or change default
     remove_zips = True
@@ -51,173 +83,681 @@ def process_fetches(mode: str, fetches: list, prior_errors: bool = False):
                 print(f"skipping fetch task {name} in mode {mode}")
                 continue
 
-        bucket: str = fetch["bucket"]
-        key: str = fetch["key"]
-        dest: str = fetch["dest"]
-
-        expand = False
-        if "expand" in fetch:
-            expand = fetch["expand"]
-
-        if expand:
-            # allows the user to specify a directory for dest path
-            if key.endswith(".7z") and not dest.endswith(".7z"):
-                dest = os.path.join(dest, os.path.basename(key))
-
-        b_fetch = True
-        if dest.endswith(".7z") and Path(dest).exists():
-            # if the file already exists in place, we will not re-fetch it
-            b_fetch = False
-
-        # fetch file from S3
-        if b_fetch:
-            rc = s3lib.get_files(bucket, key, dest, filter=None)
-            # return_code = s3lib.copy_s3_object(bucket, key, dest)
-
-        if exit_on_error and rc != 0:
-            return_code = rc
-            break
-        elif expand:
-            # unzip the inputs, prepare input files
-            is_expanded = False
-            if dest.endswith(".7z"):
-                expand_to = Path(dest).parent
-            else:
-                # if dest does not end with 7z, it may be a directory tree with 7z files to expand
-                p_dest = Path(dest)
-                if p_dest.is_dir():
-                    for zip in p_dest.rglob("*.7z"):
-                        return_code = ziplib.expand(zip, zip.parent)
-                        if exit_on_error and return_code != 0:
-                            break
-                        elif remove_zips:
-                            zip.unlink()
-                    is_expanded = True
+        with tracelib.span(name, "fetch", key=fetch["key"]):
+            bucket: str = fetch["bucket"]
+            key: str = fetch["key"]
+            dest: str = fetch["dest"]
+
+            expand = False
+            if "expand" in fetch:
+                expand = fetch["expand"]
+
+            stream = fetch.get("stream", False)
+            streamed = False
+
+            if expand and stream and ziplib.is_stream_archive(key):
+                # decompress the archive while it downloads, nothing is staged on disk
+                if dest.endswith(os.path.basename(key)):
+                    dest = os.path.dirname(dest)
+                rc = s3lib.expand_s3_object(bucket, key, dest)
+                streamed = True
+            elif expand and stream and not key.endswith(".7z"):
+                # a prefix of .7z archives: expand each archive as soon as it has downloaded.
+                # 7z archives cannot be read from a stream, so a single .7z is fetched as usual
+                rc = s3lib.get_files_expanded(
+                    bucket, key, dest, remove_zips=remove_zips
+                )
+                streamed = True
+
+            if streamed:
+                expand = False
+            elif expand:
+                # allows the user to specify a directory for dest path
+                if key.endswith(".7z") and not dest.endswith(".7z"):
+                    dest = os.path.join(dest, os.path.basename(key))
+
+            b_fetch = not streamed
+            if dest.endswith(".7z") and Path(dest).exists():
+                # if the file already exists in place, we will not re-fetch it
+                b_fetch = False
+
+            # fetch file from S3
+            if b_fetch:
+                engine = fetch.get("engine", "threads")
+                rc = s3lib.get_files(
+                    bucket,
+                    key,
+                    dest,
+                    filter=None,
+                    threads=fetch.get("concurrency", s3lib.DEFAULT_CONCURRENCY[engine]),
+                    use_cache=fetch.get("cache", True),
+                    engine=engine,
+                    list_depth=fetch.get("listDepth"),
+                )
+                # return_code = s3lib.copy_s3_object(bucket, key, dest)
+            elif not streamed:
+                rc = 0
 
-            if not is_expanded:
-                rc = ziplib.expand(dest, expand_to)
+            if exit_on_error and rc != 0:
+                return_code = rc
+                break
+            elif expand:
+                # unzip the inputs, prepare input files
+                is_expanded = False
+                if dest.endswith(".7z"):
+                    expand_to = Path(dest).parent
+                else:
+                    # if dest does not end with 7z, it may be a directory tree with 7z files to expand
+                    p_dest = Path(dest)
+                    if p_dest.is_dir():
+                        for zip in p_dest.rglob("*.7z"):
+                            return_code = ziplib.expand(zip, zip.parent)
+                            if exit_on_error and return_code != 0:
+                                break
+                            elif remove_zips:
+                                zip.unlink()
+                        is_expanded = True
 
-                if exit_on_error and rc != 0:
-                    return_code = rc
-                    break
-                elif remove_zips:
-                    if len(dest) > 3 and dest[-3:] == ".7z":
-                        os.remove(dest)
-
-        if "excludeFilePattern" in fetch:
-            patterns = fetch["excludeFilePattern"]
-            files = [
-                f
-                for f in Path(dest.replace(".7z", "")).iterdir()
-                if any(f.match(p) for p in patterns)
-            ]
-            for file in files:
-                print(f"removing file: {file}")
-                os.remove(file)
+                if not is_expanded:
+                    rc = ziplib.expand(dest, expand_to)
 
+                    if exit_on_error and rc != 0:
+                        return_code = rc
+                        break
+                    elif remove_zips:
+                        if len(dest) > 3 and dest[-3:] == ".7z":
+                            os.remove(dest)
+
+            if "excludeFilePattern" in fetch:
+                patterns = fetch["excludeFilePattern"]
+                files = [
+                    f
+                    for f in Path(dest.replace(".7z", "")).iterdir()
+                    if any(f.match(p) for p in patterns)
+                ]
+                for file in files:
+                    print(f"removing file: {file}")
+                    os.remove(file)
+
+    metricslib.report("fetch")
     return return_code
 
 
-def run_tasks(process_list: list, mode: str, prior_errors: bool = False):
+# runs the tasks of the job. keep_workers leaves the python workers of 'callable' tasks running,
+# for the tasks of the next work item
+def run_tasks(
+    process_list: list,
+    mode: str,
+    prior_errors: bool = False,
+    keep_workers: bool = False,
+):
     logFolder = "./logs"
     return_code = 0
 
     # create logs folder if it doesn't exist
     os.makedirs(logFolder, exist_ok=True)
 
+    if any("dependsOn" in process for process in process_list):
+        return_code = run_task_graph(process_list, mode, prior_errors)
+        if not keep_workers:
+            workerlib.shutdown()
+        historylib.save()
+        return return_code
+
     for process in process_list:
-        required = False
-        if "required" in process:
-            required = process["required"]
-        # skip a store task when there are prior errors UNLESS task is required
-        if not required and prior_errors:
+        rc, task = prepare_task(process, mode, prior_errors)
+        if rc != 0:
+            return_code = rc
+            break
+        if task is None:
             continue
 
-        exit_on_error = EXIT_ON_ERROR
-        if "exitOnError" in process:
-            exit_on_error = process["exitOnError"]
-
-        # apply run mode logic - skip processes as needed
-        proc_name = process["name"]
+        # run the current process
+        rc = manage_process(**task)
+        if task["exit_on_error"] and rc != 0:
+            print("errors found processing " + task["process_name"] + ", ending early")
+            return_code = rc
+            break
 
-        if "includeWhenMode" in process:
-            include_when_mode = process["includeWhenMode"]
-            if mode not in include_when_mode:
-                print(f"skipping process task {proc_name} in mode {mode}")
-                continue
-        if "excludeWhenMode" in process:
-            exclude_when_mode = process["excludeWhenMode"]
-            if mode in exclude_when_mode:
-                print(f"skipping process task {proc_name} in mode {mode}")
-                continue
+    if not keep_workers:
+        workerlib.shutdown()
+    historylib.save()
+    return return_code
 
-        # create the output directory when provided
-        output_folder = None
-        if "outputFolder" in process:
-            output_folder = process["outputFolder"]
-            os.makedirs(output_folder, exist_ok=True)
 
-        # generate index of input files, when file pattern is specified
-        file_pattern = None
-        if "inputFilePattern" in process:
-            file_pattern = process["inputFilePattern"]
+# the arguments of manage_process for a process entry, or None when it is skipped in this mode or
+# for prior errors. The input files are matched now, so a task sees the files of those before it.
+# Returns a return code as well, not 0 when the task cannot run and processing should end
+def prepare_task(process: dict, mode: str, prior_errors: bool):
+    required = False
+    if "required" in process:
+        required = process["required"]
+    # skip a store task when there are prior errors UNLESS task is required
+    if not required and prior_errors:
+        return 0, None
+
+    exit_on_error = EXIT_ON_ERROR
+    if "exitOnError" in process:
+        exit_on_error = process["exitOnError"]
+
+    # apply run mode logic - skip processes as needed
+    proc_name = process["name"]
+
+    if "includeWhenMode" in process:
+        include_when_mode = process["includeWhenMode"]
+        if mode not in include_when_mode:
+            print(f"skipping process task {proc_name} in mode {mode}")
+            return 0, None
+    if "excludeWhenMode" in process:
+        exclude_when_mode = process["excludeWhenMode"]
+        if mode in exclude_when_mode:
+            print(f"skipping process task {proc_name} in mode {mode}")
+            return 0, None
+
+    # create the output directory when provided
+    output_folder = None
+    if "outputFolder" in process:
+        output_folder = process["outputFolder"]
+        os.makedirs(output_folder, exist_ok=True)
+
+    # generate index of input files, when file pattern is specified
+    file_pattern = None
+    if "inputFilePattern" in process:
+        file_pattern = process["inputFilePattern"]
+
+    input_folder = None
+    if file_pattern == None:
+        # create an empty work list so that we execute the command that was provided
+        work_list = [""]
+    else:
+        input_folder = process["inputFolder"]
+        work_list = []
+        # get files - recursive matches
+        files = Path(input_folder).rglob(file_pattern)
+        for file in files:
+            work_list.append(file)
 
-        if file_pattern == None:
-            # create an empty work list so that we execute the command that was provided
-            work_list = [""]
-        else:
-            input_folder = process["inputFolder"]
-            work_list = []
-            # get files - recursive matches
-            files = Path(input_folder).rglob(file_pattern)
-            for file in files:
-                work_list.append(file)
-
-            if len(work_list) == 0:
+        if len(work_list) == 0:
+            print(
+                f"Error preparing {proc_name} work list. No files found in {file_pattern}"
+            )
+            if exit_on_error:
+                return 232, None
+
+        # the files expected to take longest start first, from the runtimes of earlier runs
+        if process.get("itemOrder", "longest") == "longest":
+            work_list = historylib.order(proc_name, work_list, input_folder)
+
+    log_behavior = None
+    if "logBehavior" in process:
+        log_behavior = process["logBehavior"]
+
+    workers = 0
+    if "workers" in process:
+        workers = process["workers"]
+
+    timeout = None
+    if "timeout" in process:
+        timeout = process["timeout"]
+        if timeout <= 0:
+            timeout = None
+
+    return 0, {
+        "process_name": proc_name,
+        "work_list": work_list,
+        "command": process.get("command"),
+        "log_behavior": log_behavior,
+        "workers": workers,
+        "timeout": timeout,
+        "exit_on_error": exit_on_error,
+        "target": process.get("callable"),
+        "args": process.get("args", []),
+        "memory_hint": process.get("memoryMB"),
+        "input_folder": input_folder,
+    }
+
+
+# the order the tasks can run in: each task after the tasks it depends on. Returns None, after
+# printing the problem, for an unknown task name or a cycle
+def _task_order(process_list: list):
+    names = [process["name"] for process in process_list]
+    for process in process_list:
+        if names.count(process["name"]) > 1:
+            print(f"error: task names must be unique with dependsOn: {process['name']}")
+            return None
+        for dependency in process.get("dependsOn", []):
+            if dependency not in names:
                 print(
-                    f"Error preparing {proc_name} work list. No files found in {file_pattern}"
+                    f"error: task {process['name']} depends on an unknown task: {dependency}"
                 )
-                if exit_on_error:
-                    return_code = 232
-                    break
-
-        log_behavior = None
-        if "logBehavior" in process:
-            log_behavior = process["logBehavior"]
+                return None
 
-        workers = 0
-        if "workers" in process:
-            workers = process["workers"]
+    order = []
+    remaining = list(process_list)
+    while len(remaining) > 0:
+        ready = [
+            process
+            for process in remaining
+            if all(
+                dependency in [p["name"] for p in order]
+                for dependency in process.get("dependsOn", [])
+            )
+        ]
+        if len(ready) == 0:
+            print(
+                f"error: tasks depend on each other in a cycle: {', '.join(p['name'] for p in remaining)}"
+            )
+            return None
+        order += ready
+        remaining = [process for process in remaining if process not in ready]
+    return order
+
+
+# runs the tasks as a graph: a task starts as soon as the tasks in its dependsOn have completed,
+# so independent tasks run side by side. Their items share one budget of TASK_WORKERS concurrent
+# processes (by default the number of processors), on top of the workers limit of each task.
+# Tasks skipped for the mode or prior errors count as completed. When a task with exitOnError
+# fails, no further task is started and the items of the running tasks are cancelled
+def run_task_graph(process_list: list, mode: str, prior_errors: bool = False):
+    order = _task_order(process_list)
+    if order is None:
+        return 233
+
+    budget_size = TASK_WORKERS if TASK_WORKERS > 0 else len(os.sched_getaffinity(0))
+    budget = threading.BoundedSemaphore(budget_size)
+    print(f"running {len(order)} tasks as a graph, {budget_size} concurrent workers")
 
-        timeout = None
-        if "timeout" in process:
-            timeout = process["timeout"]
-            if timeout <= 0:
-                timeout = None
+    return_code = 0
+    completed = set()
+    pending = list(order)
+    running = {}
+    stop = False
+    cancellation = Cancellation()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(order)) as executor:
+        while True:
+            # start the ready tasks. A skipped task completes at once, and may make others ready
+            started = True
+            while started and not stop:
+                started = False
+                for process in list(pending):
+                    if not all(d in completed for d in process.get("dependsOn", [])):
+                        continue
+                    pending.remove(process)
+                    started = True
+                    rc, task = prepare_task(process, mode, prior_errors)
+                    if rc != 0:
+                        return_code = return_code or rc
+                        stop = True
+                        break
+                    if task is None:
+                        completed.add(process["name"])
+                        continue
+                    future = executor.submit(
+                        manage_process,
+                        budget=budget,
+                        cancellation=cancellation,
+                        **task,
+                    )
+                    running[future] = task
 
-        # run the current process
-        rc = manage_process(
-            proc_name,
-            work_list,
-            process["command"],
-            log_behavior,
-            workers,
-            timeout,
-            exit_on_error,
-        )
-        if exit_on_error and rc != 0:
-            print("errors found processing " + proc_name + ", ending early")
-            return_code = rc
-            break
+            if len(running) == 0:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                task = running.pop(future)
+                try:
+                    rc = future.result()
+                except Exception as err:
+                    print(f"error of type [{type(err)}] in process: {str(err)}")
+                    rc = 244
+                completed.add(task["process_name"])
+                if task["exit_on_error"] and rc != 0:
+                    print(
+                        f"errors found processing {task['process_name']}, ending early"
+                    )
+                    return_code = return_code or rc
+                    stop = True
+                    cancellation.cancel()
 
+    if stop and len(pending) > 0:
+        print(f"tasks not started: {', '.join(p['name'] for p in pending)}")
     return return_code
 
 
-# delegate for running external executables
-def process_runner(process_name: str, item: int, items: int, timeout: int, cmd: str):
+# starts the python workers of the 'callable' tasks that will run in this mode, so their modules
+# are imported while the inputs are fetched
+def prewarm_callables(process_list: list, mode: str):
+    modules = []
+    size = 0
+    for process in process_list:
+        if "callable" not in process:
+            continue
+        if "includeWhenMode" in process and mode not in process["includeWhenMode"]:
+            continue
+        if "excludeWhenMode" in process and mode in process["excludeWhenMode"]:
+            continue
+        modules.append(workerlib.target_module(process["callable"]))
+        workers = process.get("workers", 0)
+        if workers <= 0:
+            workers = len(os.sched_getaffinity(0))
+        size = max(size, workers)
+    if len(modules) > 0:
+        workerlib.get_pool(modules, size)
+
+
+# the result of an item: a CompletedProcess holding the last lines of its output in stdout and
+# stderr when the output is captured, and the resources the item used, None when unknown
+class ItemResult(subprocess.CompletedProcess):
+    def __init__(
+        self,
+        args,
+        returncode: int,
+        stdout: str = None,
+        stderr: str = None,
+        wall_seconds: float = None,
+        cpu_seconds: float = None,
+        peak_rss: int = None,
+    ):
+        super().__init__(args, returncode, stdout, stderr)
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.peak_rss = peak_rss
+
+
+# whether a process of the group is still running. Zombies do not count, orphans are not reaped
+# when the framework is the init process of the container
+def _group_running(group: int):
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "stat")) as f:
+                # the fields after the name: state, parent pid, process group...
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        if int(fields[2]) == group and fields[0] != "Z":
+            return True
+    return False
+
+
+# fail-fast cancellation of the items of a task, or of the tasks of a graph. Each shell item runs
+# in a process group of its own, so cancelling stops the processes it started too: the groups
+# get SIGTERM, and SIGKILL when they are still running after CANCEL_GRACE_SECONDS. Items not
+# started yet are not run
+class Cancellation:
+    def __init__(self):
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+        # the process group ids of the running shell items
+        self._groups = set()
+        # when the groups are killed
+        self._deadline = None
+
+    def is_set(self):
+        return self.event.is_set()
+
+    # registers the group of a started item. Returns False when the work is already cancelled
+    def add(self, group: int):
+        with self._lock:
+            if self.event.is_set():
+                return False
+            self._groups.add(group)
+            return True
+
+    # once the process of an item has exited, waits for the processes it started to exit too,
+    # until the grace period ends. Its group is killed then, and unregistered
+    def remove(self, group: int):
+        if self.event.is_set():
+            while time.monotonic() < self._deadline:
+                if not _group_running(group):
+                    break
+                time.sleep(0.1)
+            else:
+                try:
+                    os.killpg(group, signal.SIGKILL)
+                except (ProcessLookupError, PermissionError):
+                    pass
+        with self._lock:
+            self._groups.discard(group)
+
+    def _signal(self, sig: int):
+        with self._lock:
+            for group in self._groups:
+                try:
+                    os.killpg(group, sig)
+                except (ProcessLookupError, PermissionError):
+                    pass
+
+    def cancel(self):
+        with self._lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            self._deadline = time.monotonic() + CANCEL_GRACE_SECONDS
+        self._signal(signal.SIGTERM)
+        timer = threading.Timer(CANCEL_GRACE_SECONDS, self._signal, [signal.SIGKILL])
+        timer.daemon = True
+        timer.start()
+
+
+# runs an item holding one of the job's worker slots, when tasks share a budget, and once the
+# memory admission has room for it. The peak memory of the item is learned, and the seconds a
+# successful input file took are recorded, given the (name, bytes) it is recorded under
+def _admitted(
+    budget: threading.Semaphore,
+    admission: memorylib.MemoryAdmission,
+    cancellation: Cancellation,
+    memory_hint: int,
+    history_item: tuple,
+    runner,
+    process_name: str,
+    *args,
+):
+    if budget is not None:
+        budget.acquire()
+    admitted = None
+    try:
+        if admission is not None:
+            wait_start = time.perf_counter()
+            admitted = admission.admit(process_name, memory_hint)
+            if time.perf_counter() - wait_start > 0.01:
+                tracelib.complete(
+                    f"{process_name} memory wait", "admission", wait_start
+                )
+        # the task failed while the item waited
+        if cancellation.is_set():
+            raise concurrent.futures.CancelledError()
+        with tracelib.span(process_name, "item", item=args[0]) as trace_args:
+            result = runner(process_name, *args, cancellation=cancellation)
+            trace_args["return_code"] = result.returncode
+            trace_args["cpu_seconds"] = result.cpu_seconds
+            trace_args["peak_rss"] = result.peak_rss
+        memorylib.record_peak(process_name, result.peak_rss)
+        if history_item is not None and result.returncode == 0:
+            historylib.record(
+                process_name, history_item[0], result.wall_seconds, history_item[1]
+            )
+        return result
+    finally:
+        if admitted is not None:
+            admission.release(admitted)
+        if budget is not None:
+            budget.release()
+
+
+# delegate for running external executables. With capture, the output is read from pipes into
+# the last lines kept in memory, and into the log files when given. The process is reaped with
+# wait4, which gives its CPU time and peak RSS, including those of the processes it waited for.
+# A peak no larger than the framework's own memory may only be the framework copied into the
+# forked process before it ran the command, so it is not known. The process runs in a group of its own: on a
+# timeout the group is killed, so the processes it started do not keep running, holding the pipes
+def process_runner(
+    process_name: str,
+    item: int,
+    items: int,
+    timeout: int,
+    cmd: str,
+    capture: bool = False,
+    log_file_out: str = None,
+    log_file_err: str = None,
+    cancellation: Cancellation = None,
+):
     escapedCmd = cmd.replace("\n", "\\n")
     print(f"starting: [{process_name}] #{item}/{items} [{escapedCmd}]")
-    return subprocess.run(cmd, shell=True, timeout=timeout)
+    start = time.perf_counter()
+    fork_rss = memorylib.process_rss()
+    pipe = subprocess.PIPE if capture else None
+    process = subprocess.Popen(
+        cmd, shell=True, stdout=pipe, stderr=pipe, start_new_session=True
+    )
+    if cancellation is not None and not cancellation.add(process.pid):
+        os.killpg(process.pid, signal.SIGKILL)
+    out_tail = loglib.LogTail()
+    err_tail = loglib.LogTail()
+    pumps = []
+    if capture:
+        pumps.append(loglib.pump(process.stdout, out_tail, log_file_out))
+        pumps.append(loglib.pump(process.stderr, err_tail, log_file_err))
+    lock = threading.Lock()
+    timed_out = False
+
+    def kill():
+        nonlocal timed_out
+        with lock:
+            if process.returncode is None:
+                timed_out = True
+                os.killpg(process.pid, signal.SIGKILL)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if cancellation is not None:
+            cancellation.remove(process.pid)
+    with lock:
+        process.returncode = os.waitstatus_to_exitcode(status)
+    deadline = time.monotonic() + loglib.PUMP_GRACE_SECONDS
+    for thread in pumps:
+        thread.join(max(0.0, deadline - time.monotonic()))
+
+    stdout = out_tail.text() if capture else None
+    stderr = err_tail.text() if capture else None
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, output=stdout, stderr=stderr)
+    if process.returncode != 0 and cancellation is not None and cancellation.is_set():
+        raise concurrent.futures.CancelledError()
+    # ru_maxrss is in KB on linux
+    peak_rss = usage.ru_maxrss * 1024
+    if fork_rss is not None and peak_rss <= fork_rss:
+        peak_rss = None
+    return ItemResult(
+        cmd,
+        process.returncode,
+        stdout,
+        stderr,
+        wall_seconds=time.perf_counter() - start,
+        cpu_seconds=usage.ru_utime + usage.ru_stime,
+        peak_rss=peak_rss,
+    )
+
+
+# delegate for running python callables in the worker pool, with the same results as
+# process_runner. The worker writes the output to the log files, the last lines are read back and
+# the files removed unless they are kept
+def callable_runner(
+    process_name: str,
+    item: int,
+    items: int,
+    timeout: int,
+    target: str,
+    args: list,
+    log_file_out: str = None,
+    log_file_err: str = None,
+    keep_logs: bool = True,
+    cancellation: Cancellation = None,
+):
+    print(f"starting: [{process_name}] #{item}/{items} [{target} {' '.join(args)}]")
+    start = time.perf_counter()
+    pool = workerlib.get_pool([workerlib.target_module(target)], 1)
+
+    def tails():
+        if log_file_out is None:
+            return None, None
+        stdout = loglib.tail_file(log_file_out)
+        stderr = loglib.tail_file(log_file_err)
+        if not keep_logs:
+            for log_file in (log_file_out, log_file_err):
+                if os.path.exists(log_file):
+                    os.remove(log_file)
+        return stdout, stderr
+
+    try:
+        return_code, peak_rss, cpu_seconds = pool.run(
+            target,
+            args,
+            timeout,
+            log_file_out,
+            log_file_err,
+            cancellation.event if cancellation is not None else None,
+            CANCEL_GRACE_SECONDS,
+        )
+    except subprocess.TimeoutExpired as ex:
+        ex.output, ex.stderr = tails()
+        raise
+    stdout, stderr = tails()
+    return ItemResult(
+        [target] + args,
+        return_code,
+        stdout,
+        stderr,
+        wall_seconds=time.perf_counter() - start,
+        cpu_seconds=cpu_seconds,
+        peak_rss=peak_rss,
+    )
+
+
+# writes the resources used by the items of a task to logs/<task>-summary.json, and prints the
+# totals. entries are the summaries of the items, in the order of the work list
+def _write_task_summary(
+    log_folder: str, process_name: str, entries: list, wall_seconds: float
+):
+    cpu_seconds = sum(entry.get("cpu_seconds") or 0.0 for entry in entries)
+    peaks = [
+        entry["peak_rss_mb"]
+        for entry in entries
+        if entry.get("peak_rss_mb") is not None
+    ]
+    cancelled = sum(1 for entry in entries if entry.get("cancelled"))
+    failed = sum(1 for entry in entries if entry.get("return_code") != 0) - cancelled
+    summary = {
+        "task": process_name,
+        "items": len(entries),
+        "failed": failed,
+        "cancelled": cancelled,
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "peak_rss_mb": max(peaks) if len(peaks) > 0 else None,
+        "results": entries,
+    }
+    summary_path = os.path.join(log_folder, process_name + "-summary.json")
+    try:
+        os.makedirs(log_folder, exist_ok=True)
+        with open(summary_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    except OSError as err:
+        print(f"warning, cannot write {summary_path}: {str(err)}")
+    peak_str = f"{summary['peak_rss_mb']} MB" if len(peaks) > 0 else "unknown"
+    print(
+        f"task summary [{process_name}]: {len(entries)} items, {failed} failed, {cancelled} cancelled, {cpu_seconds:.1f} CPU seconds in {wall_seconds:.1f}s, peak RSS {peak_str}"
+    )
 
 
 # ************************************************************************************************************
@@ -232,10 +772,17 @@ def manage_process(
     workers: int,
     timeout: int,
     exit_on_error: bool,
+    target: str = None,
+    args: list = None,
+    budget: threading.Semaphore = None,
+    memory_hint: int = None,
+    input_folder: str = None,
+    cancellation: Cancellation = None,
 ):
     return_code = 0
     log_folder = "logs"
     counter = 0
+    start = time.perf_counter()
 
     # read in the index file, which list the files to run
     process_count = len(work_list)
@@ -253,14 +800,42 @@ def manage_process(
         f"processes to run: {process_count}, processors available: {processor_count}, concurrent workers: {workers}"
     )
 
-    futures = []
+    if target is not None:
+        # python callables run in a pool of as many worker processes as there are threads
+        workerlib.get_pool([workerlib.target_module(target)], workers)
+
+    # with several workers, an item starts only when there is memory for it
+    admission = memorylib.get_admission() if workers > 1 or budget is not None else None
+
+    # 'capture' keeps the output in log files, 'tail' only its last lines in memory. Either way
+    # the output does not go to the console, and the last lines are reported on errors
+    capture = log_behavior in ("capture", "tail")
+    if capture:
+        os.makedirs(log_folder, exist_ok=True)
+
+    # with exitOnError, the first item that fails cancels the others
+    if cancellation is None:
+        cancellation = Cancellation()
+
+    def fail_fast():
+        if cancellation.is_set():
+            return
+        n_cancelled = sum(1 for future in futures if not future.done())
+        if n_cancelled > 0:
+            print(f"cancelling the remaining {n_cancelled} items of {process_name}")
+        cancellation.cancel()
+        for future in futures:
+            future.cancel()
+
+    # future: (item number, input file, error log file)
+    futures = {}
     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
         for inputFilePath in work_list:
             counter += 1
 
-            cmd = command.replace("[INPUT_FILE_PATH]", str(inputFilePath))
-
-            if log_behavior == "capture":
+            log_file_out = None
+            log_file_err = None
+            if capture:
                 log_file_str = (
                     str(inputFilePath)
                     .replace("/", "-")
@@ -273,61 +848,140 @@ def manage_process(
                 log_file_err = os.path.join(
                     log_folder, process_name + "-" + log_file_str + ".err"
                 )
-                cmd += f" >{log_file_out} 2>{log_file_err}"
 
-            futures.append(
-                executor.submit(
-                    process_runner, process_name, counter, len(work_list), timeout, cmd
+            history_item = None
+            if input_folder is not None:
+                history_item = (
+                    historylib.item_key(inputFilePath, input_folder),
+                    historylib.file_size(inputFilePath),
                 )
-            )
 
+            if target is not None:
+                item_args = [
+                    arg.replace("[INPUT_FILE_PATH]", str(inputFilePath))
+                    for arg in args or []
+                ]
+                future = executor.submit(
+                    _admitted,
+                    budget,
+                    admission,
+                    cancellation,
+                    memory_hint,
+                    history_item,
+                    callable_runner,
+                    process_name,
+                    counter,
+                    len(work_list),
+                    timeout,
+                    target,
+                    item_args,
+                    log_file_out,
+                    log_file_err,
+                    log_behavior == "capture",
+                )
+            else:
+                cmd = command.replace("[INPUT_FILE_PATH]", str(inputFilePath))
+                future = executor.submit(
+                    _admitted,
+                    budget,
+                    admission,
+                    cancellation,
+                    memory_hint,
+                    history_item,
+                    process_runner,
+                    process_name,
+                    counter,
+                    len(work_list),
+                    timeout,
+                    cmd,
+                    capture,
+                    log_file_out if log_behavior == "capture" else None,
+                    log_file_err if log_behavior == "capture" else None,
+                )
+            futures[future] = (counter, inputFilePath, log_file_err)
+
+        entries = {}
+        # (input file, stdout, stderr) of the items that failed
+        failures = []
         for future in concurrent.futures.as_completed(futures):
+            item, inputFilePath, log_file_err = futures[future]
+            entry = {"item": str(inputFilePath)}
             try:
                 process_result = future.result()
+                entry["return_code"] = process_result.returncode
+                entry["wall_seconds"] = round(process_result.wall_seconds, 3)
+                if process_result.cpu_seconds is not None:
+                    entry["cpu_seconds"] = round(process_result.cpu_seconds, 3)
+                if process_result.peak_rss is not None:
+                    entry["peak_rss_mb"] = round(process_result.peak_rss / MB, 1)
                 if process_result.returncode != 0:
+                    failures.append(
+                        (inputFilePath, process_result.stdout, process_result.stderr)
+                    )
                     if exit_on_error:
-                        return_code = process_result.returncode
+                        # the first error is the one reported
+                        return_code = return_code or process_result.returncode
                         print(
                             f"error: process returned return code: {process_result.returncode}"
                         )
+                        fail_fast()
                     else:
                         print(
                             f"warning: process returned return code: {process_result.returncode}"
                         )
+            except concurrent.futures.CancelledError:
+                entry["return_code"] = None
+                entry["cancelled"] = True
             except Exception as err:
                 print(f"error of type [{type(err)}] in process: {str(err)}")
+                entry["return_code"] = None
+                entry["error"] = str(err)
+                failures.append(
+                    (
+                        inputFilePath,
+                        getattr(err, "output", None),
+                        getattr(err, "stderr", None),
+                    )
+                )
                 if exit_on_error:
-                    return_code = 244
-
-    # remove any empty err files
-    files = Path(log_folder).glob(f"{process_name}-*.err")
-    for file in files:
-        if Path(file).stat().st_size == 0:
-            os.remove(file)
+                    return_code = return_code or 244
+                    fail_fast()
+            entries[item] = entry
+
+            # remove the empty err file
+            if (
+                log_file_err is not None
+                and os.path.exists(log_file_err)
+                and os.path.getsize(log_file_err) == 0
+            ):
+                os.remove(log_file_err)
+
+    if admission is not None:
+        admission.report(process_name)
+    tracelib.complete(
+        process_name, "task", start, items=len(work_list), return_code=return_code
+    )
+    _write_task_summary(
+        log_folder,
+        process_name,
+        [entries[item] for item in sorted(entries)],
+        time.perf_counter() - start,
+    )
 
     if return_code != 0:
-        # post-process the error log files. report any non-empty error files
+        # report the last lines of the output of the items that failed
         print(f"error running {process_name}...")
-        files = Path(log_folder).glob(f"{process_name}-*.err")
-        logs = ""
-        for file in files:
-            with open(file) as myfile:
-                a_errs = myfile.readlines()
-            errs = "\n".join(map(str, a_errs))
-
-            log_file = str(file).replace(".err", ".log")
-            if Path(log_file).stat().st_size > 0:
-                with open(log_file) as myfile2:
-                    a_logs = myfile2.readlines()
-                if len(a_logs) > 10:
-                    # only display the last 10 lines
-                    a_logs = a_logs[len(a_logs) - 10 : len(a_logs) - 1]
-                logs = "\n".join(map(str, a_logs))
-
-            subject = f"errors found processing {process_name}, file: {file}"
+        for inputFilePath, logs, errs in failures[:MAX_FAILURES_REPORTED]:
+            subject = f"errors found processing {process_name}, file: {inputFilePath}"
+            if logs is None and errs is None:
+                print(subject)
+                continue
             message = f"contents: {logs}\nErrors:\n{errs}"
-
             print(subject + ". " + message)
+        if len(failures) > MAX_FAILURES_REPORTED:
+            print(
+                f"... and {len(failures) - MAX_FAILURES_REPORTED} more failed items, see {log_folder}/{process_name}-summary.json"
+            )
     return return_code
 
 
@@ -356,54 +1010,112 @@ def move_files(move_tasks: List[dict], mode: str, prior_errors: bool = False):
                 print(f"skipping move task {name} in mode {mode}")
                 continue
 
-        input_folder = task["inputFolder"]
-        include_file_pattern = task["includeFilePattern"]
-        output_folder = task["outputFolder"]
-
-        exclude_file_pattern = task.get("excludeFilePattern", None)
-
-        n_moved = 0
-        input_path = Path(input_folder)
-        if input_path.exists():
-            for includePattern in include_file_pattern:
-                for file in input_path.rglob(includePattern):
-                    if exclude_file_pattern is None or not (
-                        True in [file.match(p) for p in exclude_file_pattern]
-                    ):
-                        try:
-                            in1 = str(input_path)
-                            out1 = str(Path(output_folder))
-                            output_path = out1
-                            # print(f'{file} / {in1}')
-                            if str(file).startswith(in1):
-                                # add one to include the trailing '/'
-                                file_part = str(file)[len(in1) + 1 :]
-                                output_path = Path(out1).joinpath(file_part)
-                                # print(f'{output_path}')
-                            os.makedirs(output_path.parent, exist_ok=True)
-
-                            if n_moved == 0:
-                                print(f"moving {file} (and others) to {output_path}")
-
-                            shutil.move(str(file), output_path)
-                            n_moved += 1
-                        except Exception as err:
-                            err_str = f"failed to move {str(file)} to {output_folder}, error: {str(err)}"
-                            if exit_on_error:
-                                print(f"error: {err_str}")
-                                return 213
-                            else:
-                                print(f"warning: {err_str}")
-        if n_moved == 0:
-            print(f"warning: no files moved from {input_folder} to {output_folder}")
-        else:
-            print(f"moved {n_moved} files from {input_folder} to {output_folder}")
+        with tracelib.span(name, "move"):
+            input_folder = task["inputFolder"]
+            include_file_pattern = task["includeFilePattern"]
+            output_folder = task["outputFolder"]
+
+            exclude_file_pattern = task.get("excludeFilePattern", None)
+
+            n_moved = 0
+            input_path = Path(input_folder)
+            if input_path.exists():
+                for includePattern in include_file_pattern:
+                    for file in input_path.rglob(includePattern):
+                        if exclude_file_pattern is None or not (
+                            True in [file.match(p) for p in exclude_file_pattern]
+                        ):
+                            try:
+                                in1 = str(input_path)
+                                out1 = str(Path(output_folder))
+                                output_path = out1
+                                # print(f'{file} / {in1}')
+                                if str(file).startswith(in1):
+                                    # add one to include the trailing '/'
+                                    file_part = str(file)[len(in1) + 1 :]
+                                    output_path = Path(out1).joinpath(file_part)
+                                    # print(f'{output_path}')
+                                os.makedirs(output_path.parent, exist_ok=True)
+
+                                if n_moved == 0:
+                                    print(
+                                        f"moving {file} (and others) to {output_path}"
+                                    )
+
+                                shutil.move(str(file), output_path)
+                                n_moved += 1
+                            except Exception as err:
+                                err_str = f"failed to move {str(file)} to {output_folder}, error: {str(err)}"
+                                if exit_on_error:
+                                    print(f"error: {err_str}")
+                                    return 213
+                                else:
+                                    print(f"warning: {err_str}")
+            if n_moved == 0:
+                print(f"warning: no files moved from {input_folder} to {output_folder}")
+            else:
+                print(f"moved {n_moved} files from {input_folder} to {output_folder}")
 
     return return_code
 
 
-def process_store(tasks_store: list, mode: str, prior_errors: bool = False):
+# copies objects from one S3 location to another. The copies are made server-side, so no data
+# passes through the container
+def process_copies(copy_tasks: List[dict], mode: str, prior_errors: bool = False):
     return_code = 0
+    metricslib.reset()
+
+    for task in copy_tasks:
+        required = task.get("required", False)
+        # skip a copy task when there are prior errors UNLESS task is required
+        if not required and prior_errors:
+            continue
+
+        exit_on_error = task.get("exitOnError", EXIT_ON_ERROR)
+        name = task["name"]
+
+        if "includeWhenMode" in task:
+            include_when_mode = task["includeWhenMode"]
+            if mode not in include_when_mode:
+                print(f"skipping copy task {name} in mode {mode}")
+                continue
+
+        if "excludeWhenMode" in task:
+            exclude_when_mode = task["excludeWhenMode"]
+            if mode in exclude_when_mode:
+                print(f"skipping copy task {name} in mode {mode}")
+                continue
+
+        with tracelib.span(name, "copy", key=task["key"]):
+            bucket = task["bucket"]
+            rc = s3lib.copy_objects(
+                bucket_name=bucket,
+                prefix=task["key"],
+                dest_bucket=task.get("destBucket", bucket),
+                dest=task["dest"],
+                filter=task.get("filter", None),
+                threads=task.get("concurrency", s3lib.DEFAULT_CONCURRENCY["threads"]),
+            )
+            if rc != 0:
+                if exit_on_error:
+                    return_code = rc
+                    break
+                print(f"warning: copy task [{name}] failed with {rc}")
+
+    metricslib.report("copy")
+    return return_code
+
+
+# stores the outputs of the job. The manifest is written for work_item, by default $WORK_ITEM
+def process_store(
+    tasks_store: list, mode: str, prior_errors: bool = False, work_item: str = None
+):
+    return_code = 0
+    # streamed store tasks started the phase, and the manifest, before the tasks ran
+    if not streamlib.is_streaming():
+        metricslib.reset()
+        # with $OUTPUT_MANIFEST_S3, each object stored is recorded in the manifest of the work item
+        manifestlib.start()
 
     for task in tasks_store:
         required = task.get("required", False)
@@ -426,130 +1138,148 @@ def process_store(tasks_store: list, mode: str, prior_errors: bool = False):
                 print(f"skipping storage task {name} in mode {mode}")
                 continue
 
-        bucket = task["bucket"]
-        dest = task["dest"]
-        source = task["source"]
+        with tracelib.span(name, "store", source=task["source"]):
+            watcher = streamlib.stop(name)
+            if watcher is not None:
+                # the subtrees completed while the tasks ran are stored, the final sweep stores the rest
+                rc = watcher.finish()
+                if exit_on_error and rc != 0:
+                    return_code = rc
+                    break
+                continue
 
-        compress = task.get("compress", False)
-        compress_sub_directories = task.get("compressSubDirectories", False)
-        remove_on_store = task.get("removeOnStore", True)
-        zip_shared_memory = task.get("compressInSharedMemory", False)
+            bucket = task["bucket"]
+            dest = task["dest"]
+            source = task["source"]
 
-        if not Path(source).exists():
-            print(
-                f"error: source path for store task [{name}] does not exists: {source}"
-            )
-            if exit_on_error:
-                return_code = 43
-                break
-        else:
-            contents = []
-            is_empty = False
-            if Path(source).is_dir():
-                contents = list(Path(source).glob("*"))
-                if not compress_sub_directories:
-                    # is there anything to zip?
-                    is_empty = len(contents) == 0
-                else:
-                    # when compressing subdirectories, pre-check that at least one exists
-                    for item in contents:
-                        if item.is_dir() and len(list(item.glob("*"))) > 0:
-                            is_empty = False
-                            break
+            compress = task.get("compress", False)
+            compress_sub_directories = task.get("compressSubDirectories", False)
+            remove_on_store = task.get("removeOnStore", True)
+            zip_shared_memory = task.get("compressInSharedMemory", False)
+            sync = task.get("sync", False)
+            pack = task.get("pack", False)
+            engine = task.get("engine", "threads")
+            concurrency = task.get("concurrency", s3lib.DEFAULT_CONCURRENCY[engine])
 
-            if is_empty:
+            if not Path(source).exists():
                 print(
-                    f"skipping empty output directory for storage task [{name}]: {source}"
+                    f"error: source path for store task [{name}] does not exists: {source}"
                 )
+                if exit_on_error:
+                    return_code = 43
+                    break
             else:
-                print(f"saving outputs: {source}")
-
-                if compress_sub_directories and len(contents) > 0:
-                    for dir in contents:
-                        if dir.is_dir():
-                            src = str(dir)
-
-                            # trim trailing / character
-                            if src[-1] == "/":
-                                src = src[0:-1]
-
-                            if zip_shared_memory:
-                                if src[0] == ".":
-                                    src = src[1:]
-                                if src[0] == "/":
-                                    src = src[1:]
-                                tmp_zip = "/dev/shm/" + src + ".7z"
-                            else:
-                                tmp_zip = src + ".7z"
-
-                            rc = ziplib.compress(source_path=src, zip_path=tmp_zip)
-                            if exit_on_error and rc != 0:
-                                return_code = rc
-                                break
-
-                            key = Path(dest).joinpath(Path(tmp_zip).name)
-
-                            rc = s3lib.write_s3_object(
-                                bucket_name=bucket, key=str(key), file=tmp_zip
-                            )
-                            if exit_on_error and rc != 0:
-                                return_code = rc
-                                break
-
-                            if remove_on_store:
-                                os.remove(tmp_zip)
-                elif compress:
-                    src = str(Path(source))
-                    # trim trailing / character
-                    if src[-1] == "/":
-                        src = src[0:-1]
-                    if zip_shared_memory:
-                        if src[0] == ".":
-                            src = src[1:]
-                        if src[0] == "/":
-                            src = src[1:]
-                        tmp_zip = "/dev/shm/" + src + ".7z"
+                contents = []
+                is_empty = False
+                if Path(source).is_dir():
+                    contents = list(Path(source).glob("*"))
+                    if not compress_sub_directories:
+                        # is there anything to zip?
+                        is_empty = len(contents) == 0
                     else:
-                        tmp_zip = src + ".7z"
-
-                    rc = ziplib.compress(source_path=src, zip_path=tmp_zip)
-                    if exit_on_error and rc != 0:
-                        return_code = rc
-                        break
-
-                    if dest[-1] == "/":
-                        key = Path(dest).joinpath(Path(tmp_zip).name)
-                    else:
-                        key = dest
+                        # when compressing subdirectories, pre-check that at least one exists
+                        for item in contents:
+                            if item.is_dir() and len(list(item.glob("*"))) > 0:
+                                is_empty = False
+                                break
 
-                    rc = s3lib.write_s3_object(
-                        bucket_name=bucket, key=str(key), file=tmp_zip
+                if is_empty:
+                    print(
+                        f"skipping empty output directory for storage task [{name}]: {source}"
                     )
-                    if exit_on_error and rc != 0:
-                        return_code = rc
-                        break
-
-                    if remove_on_store:
-                        os.remove(tmp_zip)
                 else:
-                    if Path(source).is_dir():
-                        rc = s3lib.put_files(
-                            bucket_name=bucket, local_folder=source, prefix=dest
-                        )
-                    else:
-                        # handle case where a directory name is specified for the destination
+                    print(f"saving outputs: {source}")
+
+                    if compress_sub_directories and len(contents) > 0:
+                        for dir in contents:
+                            if dir.is_dir():
+                                tmp_zip = ziplib.temp_zip_path(dir, zip_shared_memory)
+
+                                rc = ziplib.compress(source_path=dir, zip_path=tmp_zip)
+                                if exit_on_error and rc != 0:
+                                    return_code = rc
+                                    break
+
+                                key = Path(dest).joinpath(Path(tmp_zip).name)
+
+                                rc = s3lib.write_s3_object(
+                                    bucket_name=bucket, key=str(key), file=tmp_zip
+                                )
+                                if exit_on_error and rc != 0:
+                                    return_code = rc
+                                    break
+
+                                if remove_on_store:
+                                    os.remove(tmp_zip)
+                    elif compress:
+                        src = Path(source)
+                        tmp_zip = ziplib.temp_zip_path(src, zip_shared_memory)
+
+                        rc = ziplib.compress(source_path=src, zip_path=tmp_zip)
+                        if exit_on_error and rc != 0:
+                            return_code = rc
+                            break
+
                         if dest[-1] == "/":
-                            key = Path(dest).joinpath(Path(source).name)
+                            key = Path(dest).joinpath(Path(tmp_zip).name)
                         else:
                             key = dest
 
                         rc = s3lib.write_s3_object(
-                            bucket_name=bucket, key=str(key), file=source
+                            bucket_name=bucket, key=str(key), file=tmp_zip
                         )
-                    if exit_on_error and rc != 0:
-                        return_code = rc
-                        break
+                        if exit_on_error and rc != 0:
+                            return_code = rc
+                            break
+
+                        if remove_on_store:
+                            os.remove(tmp_zip)
+                    elif pack and Path(source).is_dir():
+                        rc = packlib.put_packed(
+                            bucket_name=bucket,
+                            source_path=source,
+                            dest=dest,
+                            shard_size=task.get("packShardMB", 256) * packlib.MB,
+                            name=work_item or os.getenv("WORK_ITEM"),
+                        )
+                        if exit_on_error and rc != 0:
+                            return_code = rc
+                            break
+                    else:
+                        if Path(source).is_dir():
+                            rc = s3lib.put_files(
+                                bucket_name=bucket,
+                                local_folder=source,
+                                prefix=dest,
+                                threads=concurrency,
+                                sync=sync,
+                                engine=engine,
+                            )
+                        else:
+                            # handle case where a directory name is specified for the destination
+                            if dest[-1] == "/":
+                                key = Path(dest).joinpath(Path(source).name)
+                            else:
+                                key = dest
 
+                            rc = s3lib.write_s3_object(
+                                bucket_name=bucket, key=str(key), file=source, sync=sync
+                            )
+                        if exit_on_error and rc != 0:
+                            return_code = rc
+                            break
+
+    # watchers of tasks skipped after an error, or not reached
+    streamlib.stop_all()
+
+    # outputs stored after an earlier phase failed, or by a failed store, may be incomplete
+    rc = manifestlib.write(
+        complete=return_code == 0 and not prior_errors, work_item=work_item
+    )
+    if return_code == 0:
+        return_code = rc
+
+    metricslib.report("store")
     return return_code
 
 
@@ -577,10 +1307,58 @@ def get_validated_task_config(json_data_path: str):
         else:
             with open(json_schema_path, "r") as file:
                 tasks_schema = file.read()
-                schema = json.loads(tasks_schema)
-            try:
-                jsonschema.validate(instance=cfg, schema=schema)
-            except jsonschema.exceptions.ValidationError as err:
-                print(f"error, cannot validate json schema: {err}")
-                return None
+            # the document after substitution, as validated: a substituted value can break it
+            digest = hashlib.sha256(
+                (tasks_schema + "\0" + tasks_json).encode("utf-8")
+            ).hexdigest()
+            validated = _read_validation_cache()
+            if digest not in validated:
+                err = _validation_error(tasks_schema, cfg)
+                if err is not None:
+                    print(f"error, cannot validate json schema: {err}")
+                    return None
+                _write_validation_cache(validated, digest)
     return cfg
+
+
+# validates the document against the schema, returns the error or None. jsonschema is imported
+# only when a document must be validated, and the validator of the schema is compiled once
+def _validation_error(tasks_schema: str, cfg: dict):
+    import jsonschema
+
+    validator = _validators.get(tasks_schema)
+    if validator is None:
+        schema = json.loads(tasks_schema)
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        _validators[tasks_schema] = validator
+    try:
+        validator.validate(cfg)
+    except jsonschema.exceptions.ValidationError as err:
+        return err
+    return None
+
+
+def _read_validation_cache():
+    if not VALIDATION_CACHE:
+        return []
+    try:
+        with open(VALIDATION_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_validation_cache(validated: list, digest: str):
+    if not VALIDATION_CACHE:
+        return
+    validated = (validated + [digest])[-VALIDATION_CACHE_SIZE:]
+    try:
+        os.makedirs(Path(VALIDATION_CACHE).parent, exist_ok=True)
+        with open(VALIDATION_CACHE, "w") as f:
+            json.dump(validated, f)
+    except OSError as err:
+        print(
+            f"warning, cannot write the validation cache {VALIDATION_CACHE}: {str(err)}"
+        )
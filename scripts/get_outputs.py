@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 # cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
 import argparse
+import os
 import pathlib
 
 import clilib
+import metricslib
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -35,19 +37,98 @@ parser.add_argument(
     "-threads",
     dest="threads",
     type=int,
-    help="the number of threads used in downloading files",
-    default=10,
+    help="the number of concurrent transfers, by default the number of threads adapts to the throughput, or 200 requests with -engine async",
+)
+parser.add_argument(
+    "-engine",
+    dest="engine",
+    choices=["threads", "async"],
+    help="the transfer engine. 'async' keeps many more requests in flight for small files and requires aiobotocore",
+    default="threads",
+)
+parser.add_argument(
+    "-packed",
+    dest="packed",
+    action="store_true",
+    help="the prefix holds a packed store (a store task with 'pack'). Only the files matching -filter are fetched, each with a ranged read of its shard",
+)
+parser.add_argument(
+    "-list-depth",
+    dest="listDepth",
+    type=int,
+    help="list the folders this many levels below the prefix concurrently, e.g. 2 for output/<profile>/<motion>/. Speeds up listing prefixes with millions of files, defaults to $S3_LIST_DEPTH or 0",
+)
+parser.add_argument(
+    "-manifest",
+    dest="manifest",
+    nargs="?",
+    const=os.getenv("OUTPUT_MANIFEST_S3"),
+    help="plan the downloads from the output manifests at this location (default $OUTPUT_MANIFEST_S3), e.g. s3://projectx_test/manifests/, instead of listing the prefix. Work items without outputs are reported",
+)
+parser.add_argument(
+    "-item-prefix",
+    dest="itemPrefix",
+    help="with -manifest, a prefix to use when -workitems provides a numeric value, a numeric range or comma-separated list (optional)",
+    default="",
+)
+parser.add_argument(
+    "-padding",
+    dest="itemPadding",
+    type=int,
+    help="with -manifest, when -workitems provides a numeric value, a numeric range or comma-separated list, the number of padded zeros (optional)",
+    default=3,
+)
+group1 = parser.add_mutually_exclusive_group()
+group1.add_argument(
+    "-workitems",
+    dest="items",
+    help='with -manifest, get the outputs of an individual, list or range of work items, e.g. "item1", by default all items with a manifest',
+)
+group1.add_argument(
+    "-workitemfile",
+    dest="itemListFile",
+    type=argparse.FileType("r"),
+    help="with -manifest, get the outputs of the work items listed in this file, one per line",
+)
+parser.add_argument(
+    "-metrics-file",
+    dest="metricsFile",
+    help="append the JSON summary of the transfer metrics to this file. It is always printed",
 )
 
 
 def main(args):
+    if args.metricsFile is not None:
+        metricslib.METRICS_FILE = args.metricsFile
+    metricslib.reset()
+
+    work_items = None
+    if args.items is not None:
+        items = clilib.convert_input_to_list(args.items, args.itemPadding)
+        work_items = [f"{args.itemPrefix}{item}" for item in items]
+    elif args.itemListFile is not None:
+        work_items = [
+            f"{args.itemPrefix}{item}"
+            for item in args.itemListFile.read().splitlines()
+            if item != ""
+        ]
+    if work_items is not None and args.manifest is None:
+        print("Error: -workitems and -workitemfile require -manifest")
+        exit(-1)
+
     clilib.get(
         bucket=args.bucket,
         prefix=args.prefix,
         local_folder=args.localFolder,
         filter=args.filter,
         thread_count=args.threads,
+        engine=args.engine,
+        packed=args.packed,
+        list_depth=args.listDepth,
+        manifest=args.manifest,
+        work_items=work_items,
     )
+    metricslib.report("get_outputs")
 
 
 if __name__ == "__main__":
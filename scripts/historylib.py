@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# runtime history of task items. The seconds each input file of a task took are kept in a small
+# JSON file, and optionally in S3 so the jobs of a batch learn from each other. Work lists are
+# sorted longest first from the history, so a slow file does not start last and leave the other
+# processors idle at the end of a task. Files without history are estimated from their size.
+import json
+import os
+import threading
+from pathlib import Path
+
+HISTORY_FILE = os.getenv("RUNTIME_HISTORY_FILE", "./logs/runtime-history.json")
+# e.g. s3://my-bucket/history/runtime-history.json, shared by all jobs
+HISTORY_S3 = os.getenv("RUNTIME_HISTORY_S3")
+# the items kept per task, the least recently run are dropped first
+MAX_ITEMS = int(os.getenv("RUNTIME_HISTORY_MAX_ITEMS", "10000"))
+# the weight of the latest run in the recorded seconds of an item
+WEIGHT = 0.5
+
+# task name: {item: [seconds, bytes]}, None until loaded
+_tasks = None
+# the runs recorded by this job, merged into the copy in S3
+_recorded = {}
+_lock = threading.Lock()
+
+
+def _s3_location():
+    bucket, _, key = HISTORY_S3[len("s3://") :].partition("/")
+    return bucket, key
+
+
+def _merge(tasks: dict, runs: dict):
+    for task_name, items in runs.items():
+        task = tasks.setdefault(task_name, {})
+        for item, (seconds, n_bytes) in items.items():
+            previous = task.pop(item, None)
+            if previous is not None:
+                seconds = WEIGHT * seconds + (1 - WEIGHT) * previous[0]
+            task[item] = [round(seconds, 3), n_bytes]
+        # dicts keep their order, the items run last are at the end
+        while len(task) > MAX_ITEMS:
+            del task[next(iter(task))]
+    return tasks
+
+
+# reads the history, the copy in S3 when there is one. Called with the lock held
+def _load():
+    global _tasks
+    if _tasks is not None:
+        return
+    _tasks = {}
+    if HISTORY_S3:
+        try:
+            import s3lib
+
+            bucket, key = _s3_location()
+            document, _ = s3lib.read_json_object(s3lib.get_client(), bucket, key)
+            if document is not None:
+                _tasks = document.get("tasks", {})
+                return
+        except Exception as err:
+            print(f"warning, cannot read the runtime history {HISTORY_S3}: {str(err)}")
+    try:
+        with open(HISTORY_FILE) as f:
+            _tasks = json.load(f).get("tasks", {})
+    except (OSError, ValueError):
+        # no history yet
+        pass
+
+
+# the name an input file is recorded under: its path below the input folder, so the files of
+# other work items in folders named after them share the history
+def item_key(path, input_folder: str = None):
+    if input_folder is not None:
+        try:
+            return Path(path).relative_to(input_folder).as_posix()
+        except ValueError:
+            pass
+    return Path(path).as_posix()
+
+
+def file_size(path):
+    try:
+        return Path(path).stat().st_size
+    except OSError:
+        return 0
+
+
+# the work list sorted by the seconds each file is expected to take, longest first. Files without
+# history take the seconds per byte of the task's recorded files times their size, or the average
+# of its files when their sizes are unknown. Without any history, the largest files go first
+def order(task_name: str, work_list: list, input_folder: str = None):
+    if len(work_list) < 2:
+        return work_list
+    with _lock:
+        _load()
+        history = dict(_tasks.get(task_name, {}))
+
+    keys = {path: item_key(path, input_folder) for path in work_list}
+    sizes = {path: file_size(path) for path in work_list}
+    n_known = sum(1 for path in work_list if keys[path] in history)
+    recorded_seconds = sum(seconds for seconds, n_bytes in history.values())
+    recorded_bytes = sum(n_bytes for seconds, n_bytes in history.values())
+    rate = recorded_seconds / recorded_bytes if recorded_bytes > 0 else None
+    average = recorded_seconds / len(history) if len(history) > 0 else 0.0
+
+    def expected(path):
+        entry = history.get(keys[path])
+        if entry is not None:
+            return entry[0]
+        if rate is not None and sizes[path] > 0:
+            return rate * sizes[path]
+        return average
+
+    ordered = sorted(work_list, key=lambda p: (expected(p), sizes[p]), reverse=True)
+    print(
+        f"ordering {len(work_list)} items of {task_name} longest first, {n_known} with recorded runtimes"
+    )
+    return ordered
+
+
+# records the seconds an input file took
+def record(task_name: str, item: str, seconds: float, n_bytes: int):
+    with _lock:
+        _load()
+        run = {task_name: {item: [seconds, n_bytes]}}
+        _merge(_tasks, run)
+        _merge(_recorded, run)
+
+
+# writes the history file, and merges the runs of this job into the copy in S3
+def save():
+    with _lock:
+        if len(_recorded) == 0:
+            return
+        runs = dict(_recorded)
+        _recorded.clear()
+        try:
+            os.makedirs(Path(HISTORY_FILE).parent, exist_ok=True)
+            with open(HISTORY_FILE, "w") as f:
+                json.dump({"version": 1, "tasks": _tasks}, f, separators=(",", ":"))
+        except OSError as err:
+            print(
+                f"warning, cannot write the runtime history {HISTORY_FILE}: {str(err)}"
+            )
+
+    if HISTORY_S3:
+        import s3lib
+
+        def merge_runs(document):
+            if document is None:
+                document = {"version": 1, "tasks": {}}
+            _merge(document["tasks"], runs)
+            return document
+
+        bucket, key = _s3_location()
+        s3lib.update_json_object(s3lib.get_client(), bucket, key, merge_runs)
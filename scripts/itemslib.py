@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# several work items per container. A job given a list of work items in WORK_ITEMS, or in a file
+# named by WORK_ITEMS_MANIFEST, runs the tasks document once for each of them, with $WORK_ITEM
+# set to the item. The fetches that are the same for all the items run once, before the first
+# item, so the image pull, the python startup and the shared inputs are paid for once per job
+# rather than once per item.
+import os
+
+import fwlib
+import s3lib
+
+# comma separated work items, e.g. site1,site2,site3
+WORK_ITEMS = os.getenv("WORK_ITEMS")
+# a file listing the work items one per line, local or e.g. s3://my-bucket/work-items/job1.txt
+WORK_ITEMS_MANIFEST = os.getenv("WORK_ITEMS_MANIFEST")
+
+
+def _read_manifest(location: str):
+    if location.startswith("s3://"):
+        bucket, _, key = location[len("s3://") :].partition("/")
+        response = s3lib.get_client().get_object(Bucket=bucket, Key=key)
+        return response["Body"].read().decode("utf-8")
+    with open(location) as f:
+        return f.read()
+
+
+# the work items of the job, None when it runs the one item of $WORK_ITEM
+def get_work_items():
+    if WORK_ITEMS_MANIFEST:
+        lines = _read_manifest(WORK_ITEMS_MANIFEST).splitlines()
+    elif WORK_ITEMS:
+        lines = WORK_ITEMS.split(",")
+    else:
+        return None
+    return [line.strip() for line in lines if len(line.strip()) > 0]
+
+
+# the tasks document of each work item, with its $WORK_ITEM substituted. None when one is not valid
+def load_configs(work_items: list, tasks_path: str):
+    cfgs = []
+    for work_item in work_items:
+        os.environ["WORK_ITEM"] = work_item
+        cfg = fwlib.get_validated_task_config(tasks_path)
+        if cfg is None:
+            return None
+        cfgs.append(cfg)
+    return cfgs
+
+
+# removes the fetches that are the same for all the work items from their documents, and returns
+# them to run once
+def shared_fetches(cfgs: list):
+    shared = [
+        fetch
+        for fetch in cfgs[0].get("fetch", [])
+        if all(fetch in cfg.get("fetch", []) for cfg in cfgs[1:])
+    ]
+    for cfg in cfgs:
+        if "fetch" not in cfg:
+            continue
+        cfg["fetch"] = [fetch for fetch in cfg["fetch"] if fetch not in shared]
+        if len(cfg["fetch"]) == 0:
+            del cfg["fetch"]
+    return shared
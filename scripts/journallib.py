@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# a per-job journal of completed transfers, so a retried attempt of a batch job only moves the
+# objects and parts that are still missing. Records are appended to a local file as transfers
+# complete, and the file is copied to S3 so the next attempt finds it on another host. All
+# attempts of an AWS Batch job share AWS_BATCH_JOB_ID, which names the journal. The journal is
+# deleted when the job succeeds.
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# the journal is disabled unless a local directory or an S3 location is provided
+JOURNAL_DIR = os.getenv("TRANSFER_JOURNAL_DIR")
+# e.g. s3://my-bucket/journals/
+JOURNAL_S3 = os.getenv("TRANSFER_JOURNAL_S3")
+# outside of AWS Batch, a run resumes only when given the ID of the run it follows, so unrelated
+# runs never share a journal
+JOURNAL_ID = (
+    os.getenv("TRANSFER_JOURNAL_ID")
+    or os.getenv("AWS_BATCH_JOB_ID")
+    or f"local-{uuid.uuid4().hex[:12]}"
+)
+# the most seconds between copies of the journal to S3 while transfers run
+JOURNAL_UPLOAD_INTERVAL = float(os.getenv("TRANSFER_JOURNAL_UPLOAD_SECONDS", "30"))
+
+_entries = None
+_lock = threading.Lock()
+_upload_lock = threading.Lock()
+_last_upload = 0.0
+_n_resumed = 0
+
+
+def is_enabled():
+    return bool(JOURNAL_DIR) or bool(JOURNAL_S3)
+
+
+def journal_path():
+    name = "".join(c if c.isalnum() or c in "-_." else "-" for c in JOURNAL_ID)
+    return Path(JOURNAL_DIR or "./logs").joinpath(f"transfer-journal-{name}.jsonl")
+
+
+def _s3_location():
+    bucket, _, prefix = JOURNAL_S3[len("s3://") :].partition("/")
+    if len(prefix) > 0 and not prefix.endswith("/"):
+        prefix += "/"
+    return bucket, prefix + journal_path().name
+
+
+# replays a record into the entries, keyed by (kind, bucket, key)
+def _apply(record: dict):
+    entry_key = (record["kind"], record["bucket"], record["key"])
+    if record["op"] == "set":
+        _entries[entry_key] = dict(record["entry"], parts={})
+    elif record["op"] == "part":
+        if entry_key in _entries:
+            _entries[entry_key]["parts"][str(record["part"])] = record["value"]
+    elif record["op"] == "clear":
+        _entries.pop(entry_key, None)
+
+
+# reads the journal of an earlier attempt: the local file when this host has one, otherwise the
+# copy in S3. Called with the lock held
+def _load():
+    global _entries
+    if _entries is not None:
+        return
+    _entries = {}
+
+    path = journal_path()
+    if not path.exists() and JOURNAL_S3:
+        try:
+            import s3lib
+
+            os.makedirs(path.parent, exist_ok=True)
+            bucket, key = _s3_location()
+            s3lib.get_client().download_file(bucket, key, str(path))
+            print(f"transfer journal: resuming from s3://{bucket}/{key}")
+        except Exception:
+            # the first attempt, there is no journal yet
+            if path.exists():
+                path.unlink()
+
+    if path.exists():
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    _apply(json.loads(line))
+                except (ValueError, KeyError):
+                    # a line cut short when an earlier attempt was killed
+                    pass
+
+
+def _append(record: dict):
+    _apply(record)
+    path = journal_path()
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+# returns a copy of the entry recorded for the transfer, or None
+def get(kind: str, bucket: str, key: str):
+    if not is_enabled():
+        return None
+    with _lock:
+        _load()
+        entry = _entries.get((kind, bucket, key))
+        if entry is None:
+            return None
+        return dict(entry, parts=dict(entry["parts"]))
+
+
+# records a transfer, replacing any earlier entry for it
+def record(kind: str, bucket: str, key: str, **entry):
+    if not is_enabled():
+        return
+    with _lock:
+        _load()
+        _append(
+            {"op": "set", "kind": kind, "bucket": bucket, "key": key, "entry": entry}
+        )
+    _upload_if_due()
+
+
+# records a completed part of a transfer started with record()
+def add_part(kind: str, bucket: str, key: str, part, value):
+    if not is_enabled():
+        return
+    with _lock:
+        _load()
+        _append(
+            {
+                "op": "part",
+                "kind": kind,
+                "bucket": bucket,
+                "key": key,
+                "part": part,
+                "value": value,
+            }
+        )
+    _upload_if_due()
+
+
+def clear(kind: str, bucket: str, key: str):
+    if not is_enabled():
+        return
+    with _lock:
+        _load()
+        if (kind, bucket, key) in _entries:
+            _append({"op": "clear", "kind": kind, "bucket": bucket, "key": key})
+
+
+# records a completed transfer of a local file. The size and modification time identify the file
+# on the same host, the ETag identifies its content on another
+def record_file(kind: str, bucket: str, key: str, local_file, etag: str, **entry):
+    if not is_enabled():
+        return
+    st = os.stat(local_file)
+    record(
+        kind,
+        bucket,
+        key,
+        path=str(local_file),
+        size=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        etag=etag.strip('"'),
+        **entry,
+    )
+
+
+# true when the entry was recorded for this very file, unchanged since
+def is_same_file(entry: dict, local_file):
+    try:
+        st = os.stat(local_file)
+    except OSError:
+        return False
+    return (
+        entry.get("path") == str(local_file)
+        and entry.get("size") == st.st_size
+        and entry.get("mtime_ns") == st.st_mtime_ns
+    )
+
+
+# counts a transfer skipped because an earlier attempt completed it
+def count_resumed():
+    global _n_resumed
+    with _lock:
+        _n_resumed += 1
+
+
+# returns and resets the number of transfers skipped since the last call
+def take_resumed():
+    global _n_resumed
+    with _lock:
+        n = _n_resumed
+        _n_resumed = 0
+    return n
+
+
+def _upload_if_due():
+    if JOURNAL_S3 and time.monotonic() - _last_upload >= JOURNAL_UPLOAD_INTERVAL:
+        flush()
+
+
+# copies the journal to S3. Transfers go on while the copy is made, a copy already running is
+# not waited for unless wait is set
+def flush(wait: bool = False):
+    global _last_upload
+    if not JOURNAL_S3 or not journal_path().exists():
+        return
+    if not _upload_lock.acquire(blocking=wait):
+        return
+    try:
+        import s3lib
+
+        _last_upload = time.monotonic()
+        bucket, key = _s3_location()
+        with _lock:
+            body = journal_path().read_bytes()
+        s3lib.get_client().put_object(Bucket=bucket, Key=key, Body=body)
+    except Exception as err:
+        print(f"warning, cannot copy the transfer journal to {JOURNAL_S3}: {str(err)}")
+    finally:
+        _upload_lock.release()
+
+
+# deletes the journal, locally and in S3, once the job has succeeded and no attempt will resume
+# from it
+def remove():
+    global _entries
+    if not is_enabled():
+        return
+    with _upload_lock, _lock:
+        _entries = {}
+        path = journal_path()
+        if path.exists():
+            path.unlink()
+        if not JOURNAL_S3:
+            return
+        try:
+            import s3lib
+
+            bucket, key = _s3_location()
+            s3lib.get_client().delete_object(Bucket=bucket, Key=key)
+        except Exception as err:
+            print(
+                f"warning, cannot delete the transfer journal from {JOURNAL_S3}: {str(err)}"
+            )
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# bounded log capture for task items. The output of a process is read from its pipes as it is
+# written, into ring buffers holding its last lines, and optionally into log files. Reporting an
+# error reads only those last lines, whatever the size of the logs.
+import collections
+import os
+import threading
+
+# the lines kept of each output of a process
+TAIL_LINES = int(os.getenv("LOG_TAIL_LINES", "20"))
+# lines longer than this are cut, also when they are read from the pipe
+MAX_LINE_BYTES = 4096
+# the seconds to wait for the output of a process that exited, when a process it started in the
+# background still holds the pipe
+PUMP_GRACE_SECONDS = 2.0
+
+
+# the last lines of an output
+class LogTail:
+    def __init__(self, lines: int = None):
+        self._lines = collections.deque(maxlen=lines or TAIL_LINES)
+        self._partial = False
+
+    def add(self, chunk: bytes):
+        # a chunk is a line, or the start of a line longer than MAX_LINE_BYTES
+        if self._partial:
+            self._partial = not chunk.endswith(b"\n")
+            return
+        self._lines.append(chunk[:MAX_LINE_BYTES])
+        self._partial = not chunk.endswith(b"\n")
+
+    def text(self):
+        return b"".join(
+            line if line.endswith(b"\n") else line + b"\n" for line in self._lines
+        ).decode("utf-8", errors="replace")
+
+
+# reads a pipe until it closes into the tail, and the file at path when given. Returns the thread
+def pump(stream, tail: LogTail, path: str = None):
+    def run():
+        log_file = None
+        try:
+            if path is not None:
+                log_file = open(path, "wb")
+        except OSError as err:
+            # the pipe is still read, the process would block when it is full
+            print(f"warning, cannot write the log file {path}: {str(err)}")
+        try:
+            for chunk in iter(lambda: stream.readline(MAX_LINE_BYTES), b""):
+                tail.add(chunk)
+                if log_file is not None:
+                    log_file.write(chunk)
+        finally:
+            stream.close()
+            if log_file is not None:
+                log_file.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+# the last lines of a file, reading only the end of it
+def tail_file(path: str, lines: int = None):
+    lines = lines or TAIL_LINES
+    tail = LogTail(lines)
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - (lines + 1) * MAX_LINE_BYTES))
+            if f.tell() > 0:
+                # the first line read is likely cut
+                f.readline(MAX_LINE_BYTES)
+            for chunk in iter(lambda: f.readline(MAX_LINE_BYTES), b""):
+                tail.add(chunk)
+    except OSError:
+        pass
+    return tail.text()
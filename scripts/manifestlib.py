@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# output manifests. While process_store runs, each object it stores is recorded with its size and
+# ETag. At the end of the store the job writes the manifest of its work item under
+# OUTPUT_MANIFEST_S3, and adds the item to the index of all manifests there. get_outputs.py
+# -manifest plans its downloads from the manifests instead of listing the outputs, and reports
+# the work items that have no outputs.
+import concurrent.futures
+import contextvars
+import datetime
+import json
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
+# manifests are written when a location is given, e.g. s3://my-bucket/manifests/
+MANIFEST_S3 = os.getenv("OUTPUT_MANIFEST_S3")
+WORK_ITEM = os.getenv("WORK_ITEM") or os.getenv("AWS_BATCH_JOB_ID", "local")
+INDEX_NAME = "manifest-index.json"
+ITEMS_FOLDER = "items/"
+# attempts at updating the index while other jobs update it at the same time
+INDEX_ATTEMPTS = int(os.getenv("OUTPUT_MANIFEST_INDEX_ATTEMPTS", "10"))
+
+# (bucket, key): [size, etag] of the objects stored by the calling thread, None when not recording.
+# The threads a store hands its transfers to run in a copy of its context (see s3lib.in_context),
+# so a store running in the background of the next work item records only its own objects
+_files = contextvars.ContextVar("manifest_files", default=None)
+_lock = threading.Lock()
+
+
+def is_enabled():
+    return bool(MANIFEST_S3)
+
+
+# the bucket and prefix of a location such as s3://my-bucket/manifests/
+def parse_location(location: str):
+    if location.startswith("s3://"):
+        location = location[len("s3://") :]
+    bucket, _, prefix = location.partition("/")
+    if len(prefix) > 0 and not prefix.endswith("/"):
+        prefix += "/"
+    return bucket, prefix
+
+
+def item_key(prefix: str, item: str):
+    return f"{prefix}{ITEMS_FOLDER}{item}.json"
+
+
+# starts recording the objects stored, when manifests are enabled
+def start():
+    if is_enabled():
+        _files.set({})
+
+
+def is_recording():
+    return _files.get() is not None
+
+
+# records an object stored by the job. Called by s3lib for each upload, and for each file a sync
+# found unchanged
+def add(bucket: str, key: str, size: int, etag: str):
+    files = _files.get()
+    if files is None:
+        return
+    with _lock:
+        files[(bucket, str(key))] = [size, etag.strip('"')]
+
+
+# writes the manifest of the objects recorded since start() and adds the work item to the index.
+# complete is false when the store ended with an error. work_item is WORK_ITEM by default
+def write(complete: bool, work_item: str = None):
+    files = _files.get()
+    _files.set(None)
+    if files is None:
+        return 0
+    work_item = work_item or WORK_ITEM
+
+    buckets = {}
+    n_bytes = 0
+    for (bucket, key), (size, etag) in sorted(files.items()):
+        buckets.setdefault(bucket, []).append([key, size, etag])
+        n_bytes += size
+    updated = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    manifest = {
+        "version": 1,
+        "workItem": work_item,
+        "jobId": os.getenv("AWS_BATCH_JOB_ID"),
+        "complete": complete,
+        "updated": updated,
+        # bucket: [[key, size, etag], ...]
+        "files": buckets,
+    }
+
+    import s3lib
+
+    client = s3lib.get_client()
+    bucket, prefix = parse_location(MANIFEST_S3)
+    key = item_key(prefix, work_item)
+    try:
+        response = client.put_object(
+            Bucket=bucket,
+            Key=key,
+            Body=json.dumps(manifest, separators=(",", ":")).encode("utf-8"),
+            ContentType="application/json",
+        )
+    except Exception as err:
+        print(f"error writing the output manifest to s3://{bucket}/{key}: {str(err)}")
+        return 223
+    print(
+        f"output manifest: {len(files)} objects ({n_bytes} bytes) of {work_item} at s3://{bucket}/{key}"
+    )
+
+    _update_index(
+        client,
+        bucket,
+        prefix,
+        work_item,
+        {
+            "objects": len(files),
+            "bytes": n_bytes,
+            "complete": complete,
+            "updated": updated,
+            "etag": response["ETag"].strip('"'),
+        },
+    )
+    return 0
+
+
+# adds an item to the index with a conditional write, so concurrent updates by other jobs are
+# not lost. The index summarises the items for people browsing the location; readers list the
+# manifests themselves, so an item whose update failed is still read
+def _update_index(client, bucket: str, prefix: str, item: str, entry: dict):
+    import s3lib
+
+    def add_item(index):
+        if index is None:
+            index = {"version": 1, "items": {}}
+        index["items"][item] = entry
+        return index
+
+    return s3lib.update_json_object(
+        client, bucket, prefix + INDEX_NAME, add_item, INDEX_ATTEMPTS
+    )
+
+
+def _read_manifest(client, bucket: str, prefix: str, item: str):
+    try:
+        response = client.get_object(Bucket=bucket, Key=item_key(prefix, item))
+    except ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+# reads the manifests of the work items, or of every item with a manifest when items is None.
+# Returns {item: manifest} and the items without a manifest. The manifests are listed rather
+# than taken from the index, whose update may have lost a race with other jobs
+def read_manifests(location: str, items: list = None, threads: int = 16):
+    import s3lib
+
+    client = s3lib.get_client(min_connections=threads)
+    bucket, prefix = parse_location(location)
+    if items is None:
+        folder = prefix + ITEMS_FOLDER
+        items = [
+            obj["Key"][len(folder) : -len(".json")]
+            for obj in s3lib.list_object_info(bucket, client, folder)
+            if obj["Key"].endswith(".json")
+        ]
+
+    manifests = {}
+    missing = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for item, manifest in zip(
+            items,
+            executor.map(
+                lambda item: _read_manifest(client, bucket, prefix, item), items
+            ),
+        ):
+            if manifest is None:
+                missing.append(item)
+            else:
+                manifests[item] = manifest
+    return manifests, missing
+
+
+# the listing entries (Key, Size, ETag) of the objects under prefix in bucket, as recorded in the
+# manifests
+def list_objects(manifests: dict, bucket: str, prefix: str):
+    objects = {}
+    for manifest in manifests.values():
+        for key, size, etag in manifest["files"].get(bucket, []):
+            if key.startswith(prefix):
+                objects[key] = {"Key": key, "Size": size, "ETag": f'"{etag}"'}
+    return [objects[key] for key in sorted(objects)]
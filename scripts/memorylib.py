@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# memory admission for task items. Running as many items as there are processors can exceed the
+# memory of the container, and the OOM killer then fails the whole job. Each item reserves the
+# memory it is expected to use: the peak RSS learned from the earlier items of its task, or the
+# task's memoryMB hint until then. A new item starts only when the reservations of the running
+# items, and the memory the container actually uses, leave room for it under the cgroup limit.
+# Items without an estimate reserve nothing, and are admitted against the memory in use.
+import os
+import threading
+import time
+
+MB = 1024 * 1024
+
+# overrides the memory limit found for the container, in MB
+MEMORY_LIMIT_MB = int(os.getenv("TASK_MEMORY_MB", "0"))
+# the part of the limit items may reserve, the rest is left to the framework and page cache
+MEMORY_FRACTION = float(os.getenv("TASK_MEMORY_FRACTION", "0.9"))
+# the memory reserved for an item of a task without memoryMB before one of its items has finished.
+# With 0, such items are only admitted against the memory in use
+DEFAULT_ITEM_MB = int(os.getenv("TASK_MEMORY_DEFAULT_MB", "0"))
+# how often a waiting item looks at the memory in use again
+POLL_SECONDS = 1.0
+
+# cgroup v2, then v1: the limit, the usage, and the statistics holding the reclaimable page cache
+_CGROUP_FILES = (
+    (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory.current",
+        "/sys/fs/cgroup/memory.stat",
+        "inactive_file",
+    ),
+    (
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+        "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+        "/sys/fs/cgroup/memory/memory.stat",
+        "total_inactive_file",
+    ),
+)
+# limits above this are not limits
+_UNLIMITED = 1 << 60
+
+_admission = None
+_admission_lock = threading.Lock()
+
+
+def _read_int(path: str):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def _read_stat(path: str, name: str):
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                if key == name:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _meminfo():
+    info = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return info
+
+
+def _cgroup():
+    for limit_file, usage_file, stat_file, inactive_name in _CGROUP_FILES:
+        limit = _read_int(limit_file)
+        if limit is not None and limit < _UNLIMITED:
+            return limit_file, usage_file, stat_file, inactive_name
+    return None
+
+
+# the memory limit of the container in bytes: $TASK_MEMORY_MB, the cgroup limit, or the memory of
+# the machine. None when it cannot be found
+def memory_limit():
+    if MEMORY_LIMIT_MB > 0:
+        return MEMORY_LIMIT_MB * MB
+    cgroup = _cgroup()
+    if cgroup is not None:
+        return _read_int(cgroup[0])
+    return _meminfo().get("MemTotal")
+
+
+# the resident memory of this process in bytes, None when unknown
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# the memory in use in bytes, without the page cache that can be reclaimed. None when unknown
+def memory_in_use():
+    cgroup = _cgroup()
+    if cgroup is not None:
+        usage = _read_int(cgroup[1])
+        if usage is not None:
+            return max(0, usage - _read_stat(cgroup[2], cgroup[3]))
+    info = _meminfo()
+    if "MemTotal" in info and "MemAvailable" in info:
+        return info["MemTotal"] - info["MemAvailable"]
+    return None
+
+
+class MemoryAdmission:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.budget = int(limit * MEMORY_FRACTION)
+        self.reserved = 0
+        self.running = 0
+        # task name: the largest peak RSS of its items
+        self.peaks = {}
+        # task name: [items, items that waited, seconds waited]
+        self.throttled = {}
+        self._condition = threading.Condition()
+
+    # the memory an item of the task is expected to use in bytes, 0 when unknown
+    def estimate(self, task_name: str, hint_mb: int = None):
+        if task_name in self.peaks:
+            return self.peaks[task_name]
+        if hint_mb is not None and hint_mb > 0:
+            return hint_mb * MB
+        return DEFAULT_ITEM_MB * MB
+
+    def _has_room(self, reservation: int):
+        # an item runs on its own whatever it needs, the job would not progress otherwise
+        if self.running == 0:
+            return True
+        if self.reserved + reservation > self.budget:
+            return False
+        in_use = memory_in_use()
+        return in_use is None or in_use + reservation <= self.budget
+
+    # waits until the item has room, and reserves its memory. Returns what to pass to release
+    def admit(self, task_name: str, hint_mb: int = None):
+        with self._condition:
+            reservation = self.estimate(task_name, hint_mb)
+            counts = self.throttled.setdefault(task_name, [0, 0, 0.0])
+            counts[0] += 1
+            if not self._has_room(reservation):
+                counts[1] += 1
+                start = time.monotonic()
+                while not self._has_room(reservation):
+                    self._condition.wait(POLL_SECONDS)
+                    # the estimate improves as items finish
+                    reservation = self.estimate(task_name, hint_mb)
+                counts[2] += time.monotonic() - start
+            self.reserved += reservation
+            self.running += 1
+            return task_name, reservation
+
+    def release(self, admitted: tuple):
+        task_name, reservation = admitted
+        with self._condition:
+            self.reserved -= reservation
+            self.running -= 1
+            self._condition.notify_all()
+
+    # learns the peak RSS of an item of the task, in bytes
+    def record_peak(self, task_name: str, peak_rss: int):
+        if peak_rss is None:
+            return
+        with self._condition:
+            self.peaks[task_name] = max(self.peaks.get(task_name, 0), peak_rss)
+            self._condition.notify_all()
+
+    # prints how much the admission of the task's items was throttled
+    def report(self, task_name: str):
+        with self._condition:
+            items, waited, seconds = self.throttled.pop(task_name, [0, 0, 0.0])
+            peak = self.peaks.get(task_name)
+        if items < 2:
+            return
+        peak_str = f"{peak / MB:.0f} MB" if peak is not None else "unknown"
+        print(
+            f"memory admission [{task_name}]: {waited} of {items} items waited for memory, {seconds:.1f}s in total, peak item RSS {peak_str}, budget {self.budget / MB:.0f} MB of {self.limit / MB:.0f} MB"
+        )
+
+
+# the admission shared by the tasks of the job, None when the memory limit cannot be found
+def get_admission():
+    global _admission
+    with _admission_lock:
+        if _admission is None:
+            limit = memory_limit()
+            if limit is None:
+                return None
+            _admission = MemoryAdmission(limit)
+        return _admission
+
+
+# records the peak RSS of an item, when admission is in use
+def record_peak(task_name: str, peak_rss: int):
+    if _admission is not None:
+        _admission.record_peak(task_name, peak_rss)
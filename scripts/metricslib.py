@@ -0,0 +1,194 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# transfer metrics. s3lib records the bytes, duration and outcome of every transfer, and a phase
+# (a fetch, store or copy, or a client script) ends with a JSON summary of throughput, latency
+# percentiles, errors and retries. The summary is printed on one line starting with
+# 'transfer metrics: ', and appended to TRANSFER_METRICS_FILE when it is set.
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+
+MB = 1024 * 1024
+
+METRICS_FILE = os.getenv("TRANSFER_METRICS_FILE")
+
+# latencies are counted in logarithmic buckets, each 2^(1/4) (about 19%) wider than the last,
+# so memory stays constant however many transfers there are
+_BUCKETS_PER_DOUBLING = 4
+_MIN_SECONDS = 0.0001
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        index = 0
+        if seconds > _MIN_SECONDS:
+            index = math.ceil(math.log2(seconds / _MIN_SECONDS) * _BUCKETS_PER_DOUBLING)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @staticmethod
+    def upper_bound(index: int):
+        return _MIN_SECONDS * 2 ** (index / _BUCKETS_PER_DOUBLING)
+
+    # the upper bound of the bucket holding the q-th quantile, e.g. q=0.99
+    def quantile(self, q: float):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.upper_bound(index), self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "p50_ms": round(self.quantile(0.5) * 1000, 2),
+            "p90_ms": round(self.quantile(0.9) * 1000, 2),
+            "p99_ms": round(self.quantile(0.99) * 1000, 2),
+            "max_ms": round(self.max * 1000, 2),
+            "mean_ms": round(self.total / max(self.count, 1) * 1000, 2),
+            "histogram_ms": {
+                f"{self.upper_bound(index) * 1000:.3g}": self.buckets[index]
+                for index in sorted(self.buckets)
+            },
+        }
+
+
+class _Operation:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class _Phase:
+    def __init__(self):
+        self.operations = {}
+        self.retries = 0
+        self.throttles = 0
+        self.start = time.monotonic()
+
+
+_lock = threading.Lock()
+# the phase of the calling thread. The threads a transfer hands work to run in a copy of its
+# context (see s3lib.in_context), so a store running in the background of the next work item
+# keeps metrics of its own. Requests made in other threads, e.g. by the transfer manager, count
+# in the phase of the main thread
+_phase = contextvars.ContextVar("metrics_phase", default=None)
+_main_phase = _Phase()
+
+
+def _current():
+    phase = _phase.get()
+    return _main_phase if phase is None else phase
+
+
+# starts a new phase in the calling thread, discarding what it recorded so far
+def reset():
+    global _main_phase
+    phase = _Phase()
+    _phase.set(phase)
+    if threading.current_thread() is threading.main_thread():
+        _main_phase = phase
+
+
+# records one transfer of an operation, e.g. 'get', 'put' or 'copy'. Without a duration, only the
+# count and bytes are recorded, e.g. for objects served from the fetch cache
+def record(operation: str, n_bytes: int, seconds: float = None, error: bool = False):
+    phase = _current()
+    with _lock:
+        op = phase.operations.get(operation)
+        if op is None:
+            op = phase.operations[operation] = _Operation()
+        op.count += 1
+        if error:
+            op.errors += 1
+        else:
+            op.bytes += n_bytes
+        if seconds is not None:
+            op.latency.add(seconds)
+
+
+# counts a transfer attempted again by retry_with_backoff
+def count_retry():
+    phase = _current()
+    with _lock:
+        phase.retries += 1
+
+
+# counts a request S3 throttled or that timed out, including those botocore retried by itself
+def count_throttle():
+    phase = _current()
+    with _lock:
+        phase.throttles += 1
+
+
+# the summary of the phase so far. Throughput is over the wall time of the phase, so it includes
+# the time spent listing and waiting as well as transferring
+def summary(phase: str):
+    current = _current()
+    with _lock:
+        wall_seconds = time.monotonic() - current.start
+        operations = {}
+        total_bytes = 0
+        total_count = 0
+        total_errors = 0
+        for name, op in sorted(current.operations.items()):
+            operations[name] = {
+                "count": op.count,
+                "bytes": op.bytes,
+                "errors": op.errors,
+                "throughput_mb_s": round(op.bytes / MB / max(wall_seconds, 1e-6), 2),
+            }
+            if op.latency.count > 0:
+                operations[name]["latency"] = op.latency.summary()
+            total_bytes += op.bytes
+            total_count += op.count
+            total_errors += op.errors
+
+        return {
+            "phase": phase,
+            "wall_seconds": round(wall_seconds, 3),
+            "objects": total_count,
+            "bytes": total_bytes,
+            "errors": total_errors,
+            "retries": current.retries,
+            "throttled": current.throttles,
+            "throughput_mb_s": round(total_bytes / MB / max(wall_seconds, 1e-6), 2),
+            "operations": operations,
+        }
+
+
+# prints the summary of the phase as one JSON line, and appends it to TRANSFER_METRICS_FILE.
+# Nothing is emitted for a phase without transfers
+def report(phase: str):
+    result = summary(phase)
+    if result["objects"] == 0:
+        return result
+    line = json.dumps(result)
+    print(f"transfer metrics: {line}")
+    if METRICS_FILE:
+        try:
+            if os.path.dirname(METRICS_FILE) != "":
+                os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+            with open(METRICS_FILE, "a") as f:
+                f.write(line + "\n")
+        except OSError as err:
+            print(
+                f"warning, cannot write transfer metrics to {METRICS_FILE}: {str(err)}"
+            )
+    return result
@@ -0,0 +1,275 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# packs many small output files into a few large shard objects, plus an index of where each member
+# is stored. A store of thousands of small files becomes a handful of PUTs, and single members can
+# still be fetched with a ranged GET instead of downloading a whole archive. Shards are plain tar
+# files, so a shard can also be downloaded and extracted with standard tools.
+import json
+import os
+import re
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+import manifestlib
+import s3lib
+
+MB = 1024 * 1024
+# with a pack name, usually the work item, the names are pack-index-<name>.json and
+# pack-<name>-00000.tar, so the jobs of several work items can store packs under the same dest
+INDEX_NAME = "pack-index{}.json"
+SHARD_NAME = "pack{}-{:05d}.tar"
+INDEX_PATTERN = re.compile(r"pack-index(-[^/]*)?\.json")
+DEFAULT_SHARD_SIZE = 256 * MB
+# members closer than this in a shard are fetched with a single ranged GET
+COALESCE_GAP = 1 * MB
+COALESCE_MAX = 64 * MB
+
+
+def _prefix(dest: str):
+    if len(dest) > 0 and not dest.endswith("/"):
+        dest += "/"
+    return dest
+
+
+def _name_suffix(name: str):
+    if not name:
+        return ""
+    return "-" + "".join(c if c.isalnum() or c in "-_." else "-" for c in name)
+
+
+# writes the files under source_path into tar shards of about shard_size bytes under the temp
+# folder. Yields (shard file, shard name) for each completed shard, and fills the index with
+# member name: [shard number, data offset, size]
+def _write_shards(
+    source_path: Path, tmp_dir: str, shard_size: int, index: dict, suffix: str
+):
+    shard = None
+    shard_file = None
+    for file in sorted(Path(source_path).rglob("*")):
+        if not file.is_file() or "DS_Store" in file.name:
+            continue
+        if shard is None:
+            name = SHARD_NAME.format(suffix, len(index["shards"]))
+            shard_file = Path(tmp_dir).joinpath(name)
+            shard = tarfile.open(shard_file, "w", format=tarfile.PAX_FORMAT)
+            index["shards"].append(name)
+
+        member = file.relative_to(source_path).as_posix()
+        size = file.stat().st_size
+        shard.add(file, arcname=member, recursive=False)
+        # the data ends the member, padded to the 512 byte tar block size
+        offset = shard.offset - -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        index["members"][member] = [len(index["shards"]) - 1, offset, size]
+
+        if shard.offset >= shard_size:
+            shard.close()
+            yield shard_file, index["shards"][-1]
+            shard = None
+    if shard is not None:
+        shard.close()
+        yield shard_file, index["shards"][-1]
+
+
+# stores the files under source_path as packed shards and an index under the dest prefix.
+# The index is written last, so readers never see an index of shards that are not complete
+def put_packed(
+    bucket_name: str,
+    source_path: str,
+    dest: str,
+    shard_size: int = DEFAULT_SHARD_SIZE,
+    threads: int = 4,
+    name: str = None,
+):
+    prefix = _prefix(dest)
+    suffix = _name_suffix(name)
+    index_key = prefix + INDEX_NAME.format(suffix)
+    print(f"storing packed files: {source_path} to s3://{bucket_name}/{prefix}")
+    client = s3lib.get_client(min_connections=threads)
+    index = {"version": 1, "shards": [], "members": {}}
+
+    def upload(shard_file, key):
+        return_code = s3lib.put_file(bucket_name, client, shard_file, key)
+        os.remove(shard_file)
+        return return_code
+
+    with tempfile.TemporaryDirectory(prefix="pack-") as tmp_dir:
+
+        def upload_jobs():
+            for shard_file, name in _write_shards(
+                source_path, tmp_dir, shard_size, index, suffix
+            ):
+                yield upload, (shard_file, prefix + name)
+
+        try:
+            # shards upload while the next ones are written, with few shards on disk at a time
+            return_code = s3lib.run_pipelined(upload_jobs(), threads, queue_size=1)
+        except Exception as err:
+            print(f"error packing {source_path}: {str(err)}")
+            return 220
+
+    if return_code != 0:
+        return return_code
+    if len(index["members"]) == 0:
+        print(f"no files to pack under {source_path}")
+        return 0
+
+    try:
+        body = json.dumps(index).encode("utf-8")
+        response = client.put_object(
+            Bucket=bucket_name,
+            Key=index_key,
+            Body=body,
+            ContentType="application/json",
+        )
+        manifestlib.add(bucket_name, index_key, len(body), response["ETag"])
+    except Exception as err:
+        print(
+            f"error storing the pack index to s3://{bucket_name}/{prefix}: {str(err)}"
+        )
+        return 220
+
+    print(
+        f"packed {len(index['members'])} files into {len(index['shards'])} shards at s3://{bucket_name}/{prefix}"
+    )
+    return 0
+
+
+# reads the indexes of all the packs under the prefix, e.g. one per work item, into one index
+def get_index(bucket_name: str, prefix: str):
+    prefix = _prefix(prefix)
+    client = s3lib.get_client()
+    index = {"version": 1, "shards": [], "members": {}}
+    index_keys = [
+        obj["Key"]
+        for obj in s3lib.list_object_info(
+            bucket_name, client, prefix + "pack-index", depth=0
+        )
+        if INDEX_PATTERN.fullmatch(obj["Key"][len(prefix) :])
+    ]
+    if len(index_keys) == 0:
+        raise FileNotFoundError("no pack index found")
+
+    n_replaced = 0
+    for key in index_keys:
+        response = client.get_object(Bucket=bucket_name, Key=key)
+        pack = json.loads(response["Body"].read())
+        first_shard = len(index["shards"])
+        index["shards"].extend(pack["shards"])
+        for member, (shard, offset, size) in pack["members"].items():
+            if member in index["members"]:
+                n_replaced += 1
+            index["members"][member] = [first_shard + shard, offset, size]
+    if n_replaced > 0:
+        print(
+            f"warning, {n_replaced} packed files are in more than one pack at s3://{bucket_name}/{prefix}, the last pack's copy is fetched"
+        )
+    return index
+
+
+# groups members into ranged reads, joining members that lie close together in the same shard
+def _plan_reads(members: list):
+    reads = []
+    for name, (shard, offset, size) in sorted(members, key=lambda m: m[1][:2]):
+        if len(reads) > 0:
+            last = reads[-1]
+            if (
+                last["shard"] == shard
+                and offset - last["end"] <= COALESCE_GAP
+                and offset + size - last["start"] <= COALESCE_MAX
+            ):
+                last["members"].append((name, offset, size))
+                last["end"] = max(last["end"], offset + size)
+                continue
+        reads.append(
+            {
+                "shard": shard,
+                "start": offset,
+                "end": offset + size,
+                "members": [(name, offset, size)],
+            }
+        )
+    return reads
+
+
+def _get_read(bucket_name: str, client, key: str, read: dict, local_path: Path):
+    start_time = time.perf_counter()
+    try:
+        data = b""
+        if read["end"] > read["start"]:
+            data = s3lib.retry_with_backoff(
+                lambda: client.get_object(
+                    Bucket=bucket_name,
+                    Key=key,
+                    Range=f"bytes={read['start']}-{read['end'] - 1}",
+                )["Body"].read(),
+                description=f"range of {key}",
+            )
+        if len(data) != read["end"] - read["start"]:
+            raise IOError(f"short read of {key}, received {len(data)} bytes")
+
+        for name, offset, size in read["members"]:
+            local_file = local_path.joinpath(name)
+            os.makedirs(local_file.parent, exist_ok=True)
+            start = offset - read["start"]
+            with open(local_file, "wb") as f:
+                f.write(data[start : start + size])
+    except Exception as ex:
+        print(f"failed to download members of {key}: {str(ex)}")
+        s3lib.record_transfer("get", 0, start_time, 217)
+        return 217
+    s3lib.record_transfer("get", len(data), start_time)
+    return 0
+
+
+# downloads the members of a packed store matching the filter (a regular expression), each with a
+# ranged GET of just its bytes. Members keep their relative paths below local_path
+def get_packed(
+    bucket_name: str,
+    prefix: str,
+    local_path: str,
+    filter: str = None,
+    threads: int = 0,
+):
+    prefix = _prefix(prefix)
+    print(f"fetching packed files: {local_path} from s3://{bucket_name}/{prefix}")
+    client = s3lib.get_client(min_connections=s3lib.max_threads(threads))
+    try:
+        index = get_index(bucket_name, prefix)
+    except Exception as err:
+        print(
+            f"error reading the pack index at s3://{bucket_name}/{prefix}: {str(err)}"
+        )
+        return 221
+
+    members = [
+        (name, location)
+        for name, location in index["members"].items()
+        if filter is None or filter == "" or re.search(filter, name)
+    ]
+    if len(members) == 0:
+        print(f"error: no packed file found at s3://{bucket_name}/{prefix}")
+        return 218
+
+    reads = _plan_reads(members)
+    n_bytes = sum(read["end"] - read["start"] for read in reads)
+    print(
+        f"fetching {len(members)} packed files in {len(reads)} ranged reads ({n_bytes} bytes)"
+    )
+    the_local_path = Path(local_path)
+    jobs = (
+        (
+            _get_read,
+            (
+                bucket_name,
+                client,
+                prefix + index["shards"][read["shard"]],
+                read,
+                the_local_path,
+            ),
+            read["end"] - read["start"],
+        )
+        for read in reads
+    )
+    return s3lib.run_pipelined(jobs, threads)
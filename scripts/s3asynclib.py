@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# asyncio transfer engine for large numbers of small objects. A single event loop keeps hundreds of
+# requests in flight, where the thread pool engine in s3lib stops scaling at a few dozen threads.
+# Requires the optional aiobotocore package: pip install aiobotocore
+import asyncio
+import itertools
+import os
+import random
+import re
+import time
+from pathlib import Path
+
+import cachelib
+import manifestlib
+import metricslib
+import s3lib
+
+# the objects read from the listing at a time, a page of list_objects_v2
+LISTING_PAGE_SIZE = 1000
+
+
+def _import_aiobotocore():
+    try:
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+    except ImportError:
+        raise ImportError(
+            "the async transfer engine requires aiobotocore, install it with: pip install aiobotocore"
+        )
+    return get_session, AioConfig
+
+
+def _create_client(concurrency: int):
+    get_session, AioConfig = _import_aiobotocore()
+    return get_session().create_client(
+        "s3",
+        region_name=os.getenv("AWS_REGION") or None,
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=AioConfig(max_pool_connections=concurrency),
+    )
+
+
+# awaits fn(*args), and again after a retryable failure, with the attempts and delays of
+# s3lib.retry_with_backoff
+async def _retry_with_backoff(
+    fn, *args, description: str = "", base_delay: float = 0.5
+):
+    attempts = s3lib.object_attempts()
+    for attempt in range(attempts):
+        try:
+            return await fn(*args)
+        except Exception as err:
+            if attempt == attempts - 1 or not s3lib.is_retryable(err):
+                raise
+            metricslib.count_retry()
+            delay = random.uniform(0, min(30.0, base_delay * 2**attempt))
+            print(f"retrying {description} in {delay:.1f}s: {str(err)}")
+            await asyncio.sleep(delay)
+
+
+async def _put_object(client, bucket_name: str, key: str, body: bytes):
+    return await client.put_object(Bucket=bucket_name, Key=key, Body=body)
+
+
+async def _get_object(client, bucket_name: str, key: str):
+    response = await client.get_object(Bucket=bucket_name, Key=key)
+    async with response["Body"] as stream:
+        return await stream.read()
+
+
+# runs worker(item) for every item of an async iterator with at most 'concurrency' in flight.
+# Items are passed through a bounded queue, so listing only runs a little ahead of the transfers.
+# Returns the last non-zero result
+async def _run_pipelined(items, worker, concurrency: int):
+    item_queue = asyncio.Queue(maxsize=concurrency * 4)
+    return_code = 0
+
+    async def consume():
+        nonlocal return_code
+        while True:
+            item = await item_queue.get()
+            if item is None:
+                return
+            result = await worker(item)
+            if result != 0:
+                return_code = result
+
+    consumers = [asyncio.create_task(consume()) for i in range(concurrency)]
+    try:
+        async for item in items:
+            await item_queue.put(item)
+    finally:
+        for consumer in consumers:
+            await item_queue.put(None)
+        await asyncio.gather(*consumers)
+    return return_code
+
+
+async def _put_files(
+    bucket_name: str,
+    local_folder: Path,
+    prefix: str,
+    filter: str,
+    concurrency: int,
+    sync: bool,
+):
+    n_skipped = 0
+    skipped_bytes = 0
+    n_files = 0
+
+    async with _create_client(concurrency) as client:
+        remote_objects = {}
+        if sync:
+            paginator = client.get_paginator("list_objects_v2")
+            async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+                for obj in page.get("Contents", []):
+                    remote_objects[obj["Key"]] = obj
+
+        async def files():
+            nonlocal n_files
+            for file, key in s3lib.local_files_with_keys(local_folder, prefix, filter):
+                n_files += 1
+                yield file, key
+
+        async def upload(item):
+            nonlocal n_skipped, skipped_bytes
+            file, key = item
+            try:
+                size = file.stat().st_size
+                remote = remote_objects.get(key)
+                if remote is not None and await asyncio.to_thread(
+                    s3lib.is_unchanged, file, remote["Size"], remote["ETag"]
+                ):
+                    n_skipped += 1
+                    skipped_bytes += size
+                    manifestlib.add(bucket_name, key, remote["Size"], remote["ETag"])
+                    return 0
+
+                if size >= s3lib.get_transfer_config().multipart_threshold:
+                    # large files go to the thread engine, which uploads them in parts
+                    return await asyncio.to_thread(
+                        s3lib.put_file, bucket_name, s3lib.get_client(), file, key
+                    )
+
+                start = time.perf_counter()
+                body = await asyncio.to_thread(file.read_bytes)
+                response = await _retry_with_backoff(
+                    _put_object,
+                    client,
+                    bucket_name,
+                    key,
+                    body,
+                    description=f"upload of {file}",
+                )
+                s3lib.record_transfer("put", len(body), start)
+                manifestlib.add(bucket_name, key, len(body), response["ETag"])
+                return 0
+            except Exception as ex:
+                print(f"failed to upload {file}: {str(ex)}")
+                metricslib.record("put", 0, error=True)
+                return 215
+
+        return_code = await _run_pipelined(files(), upload, concurrency)
+
+    if sync:
+        print(
+            f"sync: uploaded {n_files - n_skipped} files, skipped {n_skipped} unchanged files ({skipped_bytes} bytes)"
+        )
+    return return_code
+
+
+# async counterpart of s3lib.put_files
+def put_files(
+    bucket_name: str,
+    local_folder: Path,
+    prefix: str,
+    filter: str = "*",
+    concurrency: int = 200,
+    sync: bool = False,
+):
+    print(
+        f"storing files: {local_folder} to s3://{bucket_name}/{prefix} (async, {concurrency} in flight)"
+    )
+    try:
+        return asyncio.run(
+            _put_files(bucket_name, local_folder, prefix, filter, concurrency, sync)
+        )
+    except Exception as err:
+        print(
+            f"error copying {local_folder} to s3://{bucket_name}/{prefix}: {str(err)}"
+        )
+        return 216
+
+
+async def _download(client, bucket_name: str, obj: dict, local_file: Path):
+    key = obj["Key"]
+    try:
+        if obj["Size"] >= s3lib.get_transfer_config().multipart_threshold:
+            # large objects go to the thread engine, which downloads them in parts
+            return await asyncio.to_thread(
+                s3lib.get_file, bucket_name, local_file, s3lib.get_client(), key
+            )
+
+        start = time.perf_counter()
+        data = await _retry_with_backoff(
+            _get_object, client, bucket_name, key, description=f"download of {key}"
+        )
+        await asyncio.to_thread(_write_file, local_file, data)
+        s3lib.record_transfer("get", len(data), start)
+        return 0
+    except Exception as ex:
+        print(f"failed to download {local_file} from {key}: {str(ex)}")
+        metricslib.record("get", 0, error=True)
+        return 217
+
+
+def _write_file(local_file: Path, data: bytes):
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+    with open(local_file, "wb") as f:
+        f.write(data)
+
+
+async def _get_files(
+    bucket_name: str,
+    prefix: str,
+    local_path: str,
+    filter: str,
+    concurrency: int,
+    use_cache: bool,
+    listed_objects,
+):
+    the_local_path = Path(local_path)
+    n_objects = 0
+    cache_hits = 0
+
+    async with _create_client(concurrency) as client:
+
+        # the objects come from a listing still paging through the prefix. A page at a time is
+        # read in a thread, so the downloads carry on meanwhile
+        async def listing():
+            remaining = iter(listed_objects)
+            while True:
+                page = await asyncio.to_thread(
+                    list, itertools.islice(remaining, LISTING_PAGE_SIZE)
+                )
+                if len(page) == 0:
+                    return
+                for obj in page:
+                    yield obj
+
+        async def objects():
+            nonlocal n_objects
+            async for obj in listing():
+                if filter is None or filter == "" or re.search(filter, obj["Key"]):
+                    n_objects += 1
+                    yield obj
+
+        async def fetch(obj):
+            nonlocal cache_hits
+            local_file = s3lib.local_file_for_key(prefix, obj["Key"], the_local_path)
+            if not use_cache:
+                return await _download(client, bucket_name, obj, local_file)
+
+            cached_file = cachelib.lookup(
+                bucket_name, obj["Key"], obj["ETag"], obj["Size"]
+            )
+            if cached_file is None:
+                tmp_file = cachelib.temp_path()
+                return_code = await _download(client, bucket_name, obj, tmp_file)
+                if return_code != 0:
+                    return return_code
+                cached_file = cachelib.add(
+                    bucket_name, obj["Key"], obj["ETag"], tmp_file
+                )
+            else:
+                cache_hits += 1
+                metricslib.record("cached", obj["Size"])
+            cachelib.materialize(cached_file, local_file)
+            return 0
+
+        return_code = await _run_pipelined(objects(), fetch, concurrency)
+
+    if n_objects == 0:
+        print(f"error: no object found at s3://{bucket_name}/{prefix}")
+        return_code = 218
+    elif use_cache:
+        print(
+            f"fetch cache: {cache_hits} of {n_objects} objects served from {cachelib.CACHE_DIR}"
+        )
+        cachelib.evict()
+    return return_code
+
+
+# async counterpart of s3lib.get_files, for prefixes holding many objects, which fetches the
+# objects s3lib listed. Objects are always written below local_path, keeping the folders after the
+# prefix
+def get_files(
+    bucket_name: str,
+    prefix: str,
+    local_path: str,
+    objects,
+    filter: str = None,
+    concurrency: int = 200,
+    use_cache: bool = True,
+):
+    print(
+        f"fetching: {local_path} from s3://{bucket_name}/{prefix} (async, {concurrency} in flight)"
+    )
+    os.makedirs(local_path, exist_ok=True)
+    try:
+        return asyncio.run(
+            _get_files(
+                bucket_name,
+                prefix,
+                local_path,
+                filter,
+                concurrency,
+                use_cache and cachelib.is_enabled(),
+                objects,
+            )
+        )
+    except Exception as err:
+        print(f"error copying s3://{bucket_name}/{prefix} to {local_path}: {str(err)}")
+        return 216
@@ -1,12 +1,315 @@
 #!/usr/bin/python3
 # cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# annotations name boto3.client, which is imported when the first client is created
+from __future__ import annotations
+
 import concurrent.futures
+import contextvars
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
 import os
+import queue
+import random
 import re
+import threading
+import time
 from functools import partial
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+import cachelib
+import journallib
+import manifestlib
+import metricslib
+import storagelib
+import tracelib
+import ziplib
+from botocore.exceptions import ClientError, ParamValidationError
+
+if TYPE_CHECKING:
+    import boto3
+
+MB = 1024 * 1024
+
+# the default number of concurrent transfers for each transfer engine: worker threads for
+# "threads", requests in flight on one event loop for "async" (see s3asynclib)
+# "threads" defaults to 0, which lets an AdaptiveLimiter choose the number of transfers in flight
+DEFAULT_CONCURRENCY = {"threads": 0, "async": 200}
+
+# settings for the process-wide S3 client and transfer manager. The defaults can be overridden
+# with environment variables, or by calling configure_transfer() before the first transfer
+_transfer_settings = {
+    "max_pool_connections": int(os.getenv("S3_MAX_POOL_CONNECTIONS", "50")),
+    "multipart_threshold": int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "64")) * MB,
+    "multipart_chunksize": int(os.getenv("S3_MULTIPART_CHUNKSIZE_MB", "16")) * MB,
+    "max_concurrency": int(os.getenv("S3_MAX_CONCURRENCY", "10")),
+    # a single object at least this large is downloaded as concurrent byte ranges
+    "range_threshold": int(os.getenv("S3_RANGE_THRESHOLD_MB", "256")) * MB,
+    # the size of each range. 0 uses the part layout of the upload, which allows the
+    # multipart ETag to be verified after the download
+    "range_part_size": int(os.getenv("S3_RANGE_PART_SIZE_MB", "0")) * MB,
+    "range_threads": int(os.getenv("S3_RANGE_THREADS", "16")),
+    # the range of concurrent transfers explored when threads is 0 (adaptive)
+    "adaptive_min_threads": int(os.getenv("S3_ADAPTIVE_MIN_THREADS", "2")),
+    "adaptive_max_threads": int(os.getenv("S3_ADAPTIVE_MAX_THREADS", "64")),
+    # objects at least this large are copied as concurrent parts (UploadPartCopy) rather than one
+    # CopyObject request. Server-side copies move no data through the container
+    "copy_threshold": int(os.getenv("S3_COPY_THRESHOLD_MB", "256")) * MB,
+    "copy_part_size": int(os.getenv("S3_COPY_PART_SIZE_MB", "128")) * MB,
+    # attempts at each object or part, on top of the retries botocore makes for each request
+    "object_attempts": int(os.getenv("S3_OBJECT_ATTEMPTS", "3")),
+    # listings find the sub-prefixes this many folder levels below the prefix, and list them
+    # concurrently. 0 lists the prefix sequentially, one page of 1000 keys after another
+    "list_depth": int(os.getenv("S3_LIST_DEPTH", "0")),
+    "list_threads": int(os.getenv("S3_LIST_THREADS", "16")),
+}
+_client = None
+_transfer_config = None
+_client_lock = threading.Lock()
+
+
+# changes the shared transfer settings. Any existing client is discarded and rebuilt on next use
+def configure_transfer(
+    max_pool_connections: int = None,
+    multipart_threshold: int = None,
+    multipart_chunksize: int = None,
+    max_concurrency: int = None,
+    range_threshold: int = None,
+    range_part_size: int = None,
+    range_threads: int = None,
+):
+    global _client, _transfer_config
+
+    with _client_lock:
+        if range_threshold is not None:
+            _transfer_settings["range_threshold"] = range_threshold
+        if range_part_size is not None:
+            _transfer_settings["range_part_size"] = range_part_size
+        if range_threads is not None:
+            _transfer_settings["range_threads"] = range_threads
+        if max_pool_connections is not None:
+            _transfer_settings["max_pool_connections"] = max_pool_connections
+        if multipart_threshold is not None:
+            _transfer_settings["multipart_threshold"] = multipart_threshold
+        if multipart_chunksize is not None:
+            _transfer_settings["multipart_chunksize"] = multipart_chunksize
+        if max_concurrency is not None:
+            _transfer_settings["max_concurrency"] = max_concurrency
+        _client = None
+        _transfer_config = None
+
+
+# returns the process-wide S3 client, creating it on first use. boto3 clients are thread safe, so
+# a single client (and its connection pool) is shared by every thread for the whole job.
+# min_connections grows the connection pool when a caller is about to run that many threads
+def get_client(min_connections: int = 0):
+    global _client
+
+    if (
+        _client is not None
+        and min_connections <= _transfer_settings["max_pool_connections"]
+    ):
+        return _client
+
+    with _client_lock:
+        pool_size = _transfer_settings["max_pool_connections"]
+        if min_connections > pool_size:
+            # each thread may also run max_concurrency multipart workers
+            pool_size = min_connections + _transfer_settings["max_concurrency"]
+            _transfer_settings["max_pool_connections"] = pool_size
+            _client = None
+
+        if _client is None:
+            if storagelib.is_local():
+                print(f"using local storage: {storagelib.STORAGE_ROOT}")
+                _client = storagelib.create_client(pool_size)
+            else:
+                print(f"creating shared s3 client, connection pool size: {pool_size}")
+                _client = storagelib.create_client(pool_size)
+                # observe throttling and timeouts, including those botocore retries by itself
+                _client.meta.events.register_first("needs-retry.s3", _on_needs_retry)
+    return _client
+
+
+# S3 error codes and exceptions that mean the request rate should come down
+THROTTLE_ERROR_CODES = ("SlowDown", "Throttling", "RequestTimeout", "503")
+_throttle_events = 0
+
+
+def _on_needs_retry(response=None, caught_exception=None, **kwargs):
+    global _throttle_events
+
+    throttled = False
+    if response is not None:
+        http_response, parsed = response
+        code = parsed.get("Error", {}).get("Code", "")
+        throttled = code in THROTTLE_ERROR_CODES or http_response.status_code == 503
+    elif caught_exception is not None:
+        throttled = "timeout" in type(caught_exception).__name__.lower()
+    if throttled:
+        # a lost update under contention only delays the reaction by one window
+        _throttle_events += 1
+        metricslib.count_throttle()
+    # returning None leaves the retry decision to botocore
+    return None
+
+
+def is_throttle_error(err: BaseException):
+    return any(code in str(err) for code in THROTTLE_ERROR_CODES) or (
+        "timeout" in type(err).__name__.lower()
+    )
+
+
+# false for errors another attempt cannot fix, e.g. a missing key, denied access or a local file
+# that cannot be read
+def is_retryable(err: BaseException):
+    if isinstance(err, ClientError):
+        status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return status >= 500 or status in (408, 429) or is_throttle_error(err)
+    if isinstance(
+        err,
+        (ParamValidationError, FileNotFoundError, PermissionError, IsADirectoryError),
+    ):
+        return False
+    return True
+
+
+def object_attempts():
+    return max(1, _transfer_settings["object_attempts"])
+
+
+# fn called in a copy of the calling thread's context, for the threads a transfer hands its work
+# to, so their transfers count in the phase metrics and output manifest of the calling thread
+def in_context(fn):
+    context = contextvars.copy_context()
+    return lambda *args: context.copy().run(fn, *args)
+
+
+# calls fn(*args), and calls it again after a failure, up to the configured number of attempts.
+# The delays grow exponentially with full jitter, so transfers failing together do not retry together
+def retry_with_backoff(fn, *args, description: str = "", base_delay: float = 0.5):
+    attempts = object_attempts()
+    for attempt in range(attempts):
+        try:
+            return fn(*args)
+        except Exception as err:
+            if attempt == attempts - 1 or not is_retryable(err):
+                raise
+            metricslib.count_retry()
+            delay = random.uniform(0, min(30.0, base_delay * 2**attempt))
+            print(f"retrying {description} in {delay:.1f}s: {str(err)}")
+            time.sleep(delay)
+
+
+# records a transfer started at start (from time.perf_counter) in the phase metrics and the job
+# trace
+def record_transfer(operation: str, n_bytes: int, start: float, return_code: int = 0):
+    end = time.perf_counter()
+    metricslib.record(operation, n_bytes, end - start, error=return_code != 0)
+    tracelib.complete(
+        operation, "transfer", start, end, bytes=n_bytes, return_code=return_code
+    )
+
+
+# limits the number of transfers in flight, and adapts the limit to the throughput observed.
+# The limit grows by half while each window of transfers is faster than the best so far, settles
+# back to the best limit when it stops improving, and is halved when S3 throttles or times out.
+# Decisions are logged
+class AdaptiveLimiter:
+    def __init__(self, min_limit: int = None, max_limit: int = None, initial: int = 8):
+        if min_limit is None:
+            min_limit = _transfer_settings["adaptive_min_threads"]
+        if max_limit is None:
+            max_limit = _transfer_settings["adaptive_max_threads"]
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = min(max(initial, self.min_limit), self.max_limit)
+        self.peak_limit = self.limit
+        self.n_backoffs = 0
+
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._best_throughput = 0.0
+        self._best_limit = self.limit
+        self._start_window()
+
+    def _start_window(self):
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._window_bytes = 0
+        self._window_errors = 0
+        self._window_throttles = _throttle_events
 
-import boto3
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, n_bytes: int = 0, error: BaseException = None):
+        with self._condition:
+            self._in_flight -= 1
+            self._window_count += 1
+            self._window_bytes += n_bytes
+            if error is not None and is_throttle_error(error):
+                self._window_errors += 1
+
+            elapsed = time.monotonic() - self._window_start
+            if self._window_count >= max(2 * self.limit, 20) or elapsed >= 5:
+                self._adjust(elapsed)
+            self._condition.notify_all()
+
+    def _adjust(self, elapsed: float):
+        throughput = self._window_bytes / max(elapsed, 1e-6)
+        throttles = self._window_errors + _throttle_events - self._window_throttles
+        old_limit = self.limit
+
+        if throttles > 0:
+            self.limit = max(self.min_limit, self.limit // 2)
+            self._best_throughput = throughput
+            self._best_limit = self.limit
+            self.n_backoffs += 1
+            reason = f"{throttles} throttled or timed out requests"
+        elif throughput > self._best_throughput * 1.1:
+            self._best_throughput = throughput
+            self._best_limit = self.limit
+            self.limit = min(self.max_limit, self.limit + max(1, self.limit // 2))
+            reason = "throughput improved"
+        else:
+            self.limit = self._best_limit
+            reason = "throughput did not improve"
+
+        self.peak_limit = max(self.peak_limit, self.limit)
+        if self.limit != old_limit:
+            print(
+                f"adaptive concurrency: {old_limit} -> {self.limit} ({reason}, {throughput / MB:.2f} MB/s)"
+            )
+        self._start_window()
+
+    def report(self):
+        print(
+            f"adaptive concurrency: final limit {self.limit}, peak {self.peak_limit}, backoffs {self.n_backoffs}"
+        )
+
+
+# returns the shared multipart transfer settings used by upload_file/download_file
+def get_transfer_config():
+    global _transfer_config
+
+    if _transfer_config is None:
+        from boto3.s3.transfer import TransferConfig
+
+        with _client_lock:
+            if _transfer_config is None:
+                _transfer_config = TransferConfig(
+                    multipart_threshold=_transfer_settings["multipart_threshold"],
+                    multipart_chunksize=_transfer_settings["multipart_chunksize"],
+                    max_concurrency=_transfer_settings["max_concurrency"],
+                )
+    return _transfer_config
 
 
 # Copies a file from S3, providing exception handling and logging
@@ -14,17 +317,24 @@ def copy_s3_object(bucket_name, key, local_file):
     print(f"fetching file: s3://{bucket_name}/{key} to {local_file}")
     os.makedirs(os.path.dirname(local_file), exist_ok=True)
 
-    s3 = boto3.client("s3")
+    s3 = get_client()
     try:
-        s3.download_file(bucket_name, key, local_file)
+        s3.download_file(bucket_name, key, local_file, Config=get_transfer_config())
         return 0
     except Exception as err:
         print(f"Error fetching s3://{bucket_name}/{key} to {local_file}: {str(err)}")
         return 213
 
 
-def list_objects(bucket_name, client, prefix):
-    ar = []
+# yields the listing entry (Key, Size, ETag, LastModified) of every object under prefix, in key
+# order. With a depth (S3_LIST_DEPTH by default), the prefix is listed in shards concurrently
+def list_object_info(bucket_name, client, prefix, depth: int = None):
+    if depth is None:
+        depth = _transfer_settings["list_depth"]
+    if depth > 0:
+        yield from list_object_info_sharded(bucket_name, client, prefix, depth)
+        return
+
     paginator = client.get_paginator("list_objects_v2")
     response = paginator.paginate(
         Bucket=bucket_name, Prefix=prefix, PaginationConfig={"PageSize": 1000}
@@ -32,16 +342,135 @@ def list_objects(bucket_name, client, prefix):
     for files in response:
         if "Contents" in files:
             for obj in files["Contents"]:
-                file = obj["Key"]
-                ar.append(file)
-    return ar
+                yield obj
+
+
+# one delimiter listing of prefix: ("object", key, entry) for the objects directly below it and
+# ("prefix", sub-prefix, sub-prefix) for its folders, in key order
+def _list_level(bucket_name, client, prefix: str):
+    entries = []
+    paginator = client.get_paginator("list_objects_v2")
+    response = paginator.paginate(
+        Bucket=bucket_name,
+        Prefix=prefix,
+        Delimiter="/",
+        PaginationConfig={"PageSize": 1000},
+    )
+    for page in response:
+        for obj in page.get("Contents", []):
+            entries.append(("object", obj["Key"], obj))
+        for common_prefix in page.get("CommonPrefixes", []):
+            entries.append(("prefix", common_prefix["Prefix"], common_prefix["Prefix"]))
+    entries.sort(key=lambda entry: entry[1])
+    return entries
+
+
+# lists a prefix organized in folders, e.g. output/<profile>/<motion>/, as concurrent shards.
+# The folders depth levels below the prefix are found with delimiter listings (level by level,
+# concurrently), then each folder is listed by one of the threads. The entries are yielded in key
+# order as soon as their page arrives, and each thread runs only a few pages ahead of the consumer.
+# Objects found above the depth are held in memory, so the depth should follow the folder layout
+def list_object_info_sharded(
+    bucket_name, client, prefix: str, depth: int, threads: int = None
+):
+    if threads is None:
+        threads = _transfer_settings["list_threads"]
+    entries = [("prefix", prefix, prefix)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for level in range(depth):
+            prefixes = [entry[2] for entry in entries if entry[0] == "prefix"]
+            if len(prefixes) == 0:
+                break
+            levels = executor.map(
+                in_context(partial(_list_level, bucket_name, client)), prefixes
+            )
+            next_entries = []
+            for entry in entries:
+                if entry[0] == "prefix":
+                    next_entries.extend(next(levels))
+                else:
+                    next_entries.append(entry)
+            entries = next_entries
+
+    shards = [entry[2] for entry in entries if entry[0] == "prefix"]
+    if len(shards) > 0:
+        print(
+            f"listing s3://{bucket_name}/{prefix} in {len(shards)} shards, {threads} at a time"
+        )
+    # pages of each shard, ended by None or by the error that stopped its listing
+    pages = [queue.Queue(maxsize=4) for shard in shards]
+    next_shard = iter(range(len(shards)))
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def put(page_queue, item):
+        while not stop.is_set():
+            try:
+                page_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    # shards are taken in order, so the shard the consumer waits for is always being listed
+    def lister():
+        while not stop.is_set():
+            with lock:
+                i = next(next_shard, None)
+            if i is None:
+                return
+            try:
+                paginator = client.get_paginator("list_objects_v2")
+                response = paginator.paginate(
+                    Bucket=bucket_name,
+                    Prefix=shards[i],
+                    PaginationConfig={"PageSize": 1000},
+                )
+                for page in response:
+                    put(pages[i], page.get("Contents", []))
+                put(pages[i], None)
+            except Exception as err:
+                put(pages[i], err)
+
+    workers = [
+        threading.Thread(target=in_context(lister), daemon=True)
+        for i in range(min(threads, len(shards)))
+    ]
+    for thread in workers:
+        thread.start()
+    try:
+        shard = 0
+        for entry in entries:
+            if entry[0] == "object":
+                yield entry[2]
+                continue
+            while True:
+                page = pages[shard].get()
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise page
+                yield from page
+            shard += 1
+    finally:
+        stop.set()
+        for thread in workers:
+            thread.join()
+
+
+def list_objects(bucket_name, client, prefix):
+    return [
+        obj["Key"]
+        for obj in list_object_info(
+            bucket_name=bucket_name, client=client, prefix=prefix
+        )
+    ]
 
 
 def copy_s3_objects(bucket_name, prefix, local_folder):
     print(f"fetching files: s3://{bucket_name}/{prefix} to {local_folder}")
     os.makedirs(local_folder, exist_ok=True)
 
-    s3 = boto3.client("s3")
+    s3 = get_client()
     try:
         paginator = s3.get_paginator("list_objects_v2")
         response = paginator.paginate(
@@ -51,7 +480,9 @@ def copy_s3_objects(bucket_name, prefix, local_folder):
             for obj in files["Contents"]:
                 file = obj["Key"]
                 local_file = file.replace(prefix, local_folder)
-                s3.download_file(bucket_name, file, local_file)
+                s3.download_file(
+                    bucket_name, file, local_file, Config=get_transfer_config()
+                )
         return 0
     except Exception as err:
         print(
@@ -62,14 +493,303 @@ def copy_s3_objects(bucket_name, prefix, local_folder):
         return 214
 
 
-# write an object to S3, with error handling
-def write_s3_object(bucket_name: str, key: str, file: Path):
+# the destination key of a key found under src_prefix, keeping the folders after the prefix as
+# get_files does. A dest ending with '/' is a prefix, otherwise it names the copy of the single
+# object at src_prefix
+def copy_dest_key(src_prefix: str, key: str, dest: str):
+    if key == src_prefix:
+        if dest.endswith("/"):
+            return dest + Path(key).name
+        return dest
+
+    if dest != "" and not dest.endswith("/"):
+        dest += "/"
+    base = src_prefix
+    if base != "" and not base.endswith("/"):
+        base = os.path.dirname(base)
+    return dest + key[len(base) :].lstrip("/")
+
+
+# copies an object inside S3, without moving its data through the container. Objects of at least
+# copy_threshold bytes are copied in concurrent parts. The source must keep its ETag during the copy
+def copy_object(
+    bucket: str,
+    client: boto3.client,
+    key: str,
+    dest_bucket: str,
+    dest_key: str,
+    size: int,
+    etag: str,
+):
+    source = {"Bucket": bucket, "Key": key}
+    start = time.perf_counter()
+    try:
+        if size < _transfer_settings["copy_threshold"]:
+            retry_with_backoff(
+                partial(
+                    client.copy_object,
+                    CopySource=source,
+                    CopySourceIfMatch=etag,
+                    Bucket=dest_bucket,
+                    Key=dest_key,
+                ),
+                description=f"copy of {key}",
+            )
+        else:
+            copy_object_multipart(
+                bucket, client, key, dest_bucket, dest_key, size, etag
+            )
+    except BaseException as ex:
+        print(
+            f"failed to copy s3://{bucket}/{key} to s3://{dest_bucket}/{dest_key}: {str(ex)}"
+        )
+        record_transfer("copy", 0, start, 222)
+        return 222
+    record_transfer("copy", size, start)
+    return 0
+
+
+def copy_object_multipart(
+    bucket: str,
+    client: boto3.client,
+    key: str,
+    dest_bucket: str,
+    dest_key: str,
+    size: int,
+    etag: str,
+):
+    # a multipart upload does not copy the object's headers, so they are passed on
+    head = client.head_object(Bucket=bucket, Key=key, IfMatch=etag)
+    headers = {
+        name: head[name]
+        for name in (
+            "ContentType",
+            "ContentEncoding",
+            "ContentDisposition",
+            "ContentLanguage",
+            "CacheControl",
+            "Metadata",
+        )
+        if name in head
+    }
+    # S3 allows at most 10000 parts
+    part_size = max(_transfer_settings["copy_part_size"], -(-size // 10000))
+    upload_id = client.create_multipart_upload(
+        Bucket=dest_bucket, Key=dest_key, **headers
+    )["UploadId"]
+
+    def copy_part(part_number):
+        start = (part_number - 1) * part_size
+        end = min(start + part_size, size) - 1
+        response = retry_with_backoff(
+            partial(
+                client.upload_part_copy,
+                Bucket=dest_bucket,
+                Key=dest_key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                CopySource={"Bucket": bucket, "Key": key},
+                CopySourceIfMatch=etag,
+                CopySourceRange=f"bytes={start}-{end}",
+            ),
+            description=f"part {part_number} of the copy of {key}",
+        )
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=_transfer_settings["max_concurrency"]
+        ) as executor:
+            parts = list(
+                executor.map(in_context(copy_part), range(1, -(-size // part_size) + 1))
+            )
+        client.complete_multipart_upload(
+            Bucket=dest_bucket,
+            Key=dest_key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+    except BaseException:
+        client.abort_multipart_upload(
+            Bucket=dest_bucket, Key=dest_key, UploadId=upload_id
+        )
+        raise
+
+
+# server-side copy of the objects under prefix (or of the single object at prefix) to dest in
+# dest_bucket. The listing and the copies are pipelined, keeping the folders after the prefix
+def copy_objects(
+    bucket_name: str,
+    prefix: str,
+    dest_bucket: str,
+    dest: str,
+    filter: str = None,
+    threads: int = 0,
+):
+    print(f"copying: s3://{bucket_name}/{prefix} to s3://{dest_bucket}/{dest}")
+    client = get_client(min_connections=max_threads(threads))
+    n_objects = 0
+    n_bytes = 0
+
+    def copy_jobs():
+        nonlocal n_objects, n_bytes
+        for obj in list_object_info(bucket_name, client, prefix):
+            if filter is None or filter == "" or re.search(filter, obj["Key"]):
+                n_objects += 1
+                n_bytes += obj["Size"]
+                dest_key = copy_dest_key(prefix, obj["Key"], dest)
+                yield copy_object, (
+                    bucket_name,
+                    client,
+                    obj["Key"],
+                    dest_bucket,
+                    dest_key,
+                    obj["Size"],
+                    obj["ETag"],
+                ), obj["Size"]
+
+    try:
+        return_code = run_pipelined(copy_jobs(), threads)
+    except Exception as err:
+        print(
+            f"error copying s3://{bucket_name}/{prefix} to s3://{dest_bucket}/{dest}: {str(err)}"
+        )
+        return 222
+
+    if n_objects == 0:
+        print(f"error: no object found at s3://{bucket_name}/{prefix}")
+        return 218
+    print(f"copied {n_objects} objects ({n_bytes} bytes) server-side")
+    return return_code
+
+
+# write an object to S3, with error handling. With sync, an unchanged object is not uploaded again
+def write_s3_object(bucket_name: str, key: str, file: Path, sync: bool = False):
+    client = get_client()
+
+    if sync:
+        try:
+            remote = client.head_object(Bucket=bucket_name, Key=key)
+            if is_unchanged(Path(file), remote["ContentLength"], remote["ETag"]):
+                print(f"skipping unchanged {file}, already at s3://{bucket_name}/{key}")
+                manifestlib.add(
+                    bucket_name, key, remote["ContentLength"], remote["ETag"]
+                )
+                return 0
+        except Exception:
+            # not found, or not readable: upload it
+            pass
 
     print(f"storing {file} to s3://{bucket_name}/{key}")
-    session = boto3.Session()
-    client = session.client("s3")
 
-    return put_file(bucket_name, client=client, local_file=Path(file), key=key)
+    return_code = put_file(bucket_name, client=client, local_file=Path(file), key=key)
+    report_journal(1)
+    return return_code
+
+
+# a JSON object and its ETag, None and None when there is none yet
+def read_json_object(client, bucket: str, key: str):
+    try:
+        response = client.get_object(Bucket=bucket, Key=key)
+    except ClientError as err:
+        if err.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(response["Body"].read()), response["ETag"]
+
+
+# updates a JSON object shared by concurrent jobs with a conditional write, so their updates are
+# not lost: update(document) returns the new document from the one read (None when there is none
+# yet), and the write only succeeds if the object is unchanged since it was read, otherwise it is
+# read and updated again. Returns False, after printing a warning, when it was not updated
+def update_json_object(client, bucket: str, key: str, update, attempts: int = 10):
+    for attempt in range(attempts):
+        try:
+            document, etag = read_json_object(client, bucket, key)
+            body = json.dumps(update(document), separators=(",", ":")).encode("utf-8")
+            condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+            try:
+                client.put_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Body=body,
+                    ContentType="application/json",
+                    **condition,
+                )
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "NotImplemented":
+                    raise
+                # S3-compatible stores without conditional writes. An update made by another job
+                # at the same time may be lost
+                print(
+                    f"warning, conditional writes are not supported, updating s3://{bucket}/{key}"
+                )
+                client.put_object(
+                    Bucket=bucket, Key=key, Body=body, ContentType="application/json"
+                )
+            return True
+        except ClientError as err:
+            code = err.response["Error"]["Code"]
+            if code not in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+                "NoSuchKey",
+            ):
+                print(f"warning, cannot update s3://{bucket}/{key}: {str(err)}")
+                return False
+            time.sleep(random.uniform(0, min(10.0, 0.2 * 2**attempt)))
+        except Exception as err:
+            print(f"warning, cannot update s3://{bucket}/{key}: {str(err)}")
+            return False
+    print(f"warning, s3://{bucket}/{key} was not updated after {attempts} attempts")
+    return False
+
+
+# calculates the ETag S3 gives a file uploaded in parts of chunk_size, or in one piece when
+# chunk_size is None
+def local_etag(local_file: Path, chunk_size: int = None):
+    part_digests = []
+    md5 = hashlib.md5()
+    with open(local_file, "rb") as f:
+        while True:
+            data = f.read(chunk_size if chunk_size else 8 * MB)
+            if not data:
+                break
+            if chunk_size:
+                part_digests.append(hashlib.md5(data).digest())
+            else:
+                md5.update(data)
+
+    if chunk_size is None:
+        return md5.hexdigest()
+    if len(part_digests) == 0:
+        part_digests.append(hashlib.md5(b"").digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+# true when a local file has the same content as an S3 object, compared by size, then by MD5 or
+# by the multipart ETag. The part size of a multipart object is not recorded, so the sizes most
+# likely to have been used are tried
+def is_unchanged(local_file: Path, size: int, etag: str):
+    if local_file.stat().st_size != size:
+        return False
+
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return local_etag(local_file) == etag
+
+    n_parts = int(etag.split("-")[1])
+    candidates = [_transfer_settings["multipart_chunksize"]]
+    # the defaults of boto3, the aws cli and other common tools
+    candidates += [mb * MB for mb in (8, 5, 16, 32, 64, 100, 128)]
+    if n_parts > 0:
+        # the smallest whole number of MB that gives n_parts parts
+        candidates.append(-(-size // n_parts // MB) * MB)
+    for chunk_size in dict.fromkeys(candidates):
+        if chunk_size > 0 and -(-size // chunk_size) == n_parts:
+            if local_etag(local_file, chunk_size) == etag:
+                return True
+    return False
 
 
 # delegate to download a single file, used by multi-threader in getFiles()
@@ -83,60 +803,297 @@ def put_file(bucket: str, client: boto3.client, local_file: Path, key: str):
         client (boto3.client): S3 client
         s3_file (str): S3 object name
     """
+    start = time.perf_counter()
+    n_bytes = 0
     try:
+        n_bytes = Path(local_file).stat().st_size
+        if journallib.is_enabled():
+            if is_journaled_put(bucket, local_file, key):
+                journallib.count_resumed()
+                metricslib.record("journaled", n_bytes)
+                entry = journallib.get("put", bucket, key)
+                manifestlib.add(bucket, key, n_bytes, entry["etag"])
+                return 0
+
         # print(f'storing: {local_file} to s3://{bucket}/{key}')
-        client.upload_file(Bucket=bucket, Key=key, Filename=str(local_file))
+        if not journallib.is_enabled() and not manifestlib.is_recording():
+            retry_with_backoff(
+                partial(
+                    client.upload_file,
+                    Bucket=bucket,
+                    Key=key,
+                    Filename=str(local_file),
+                    Config=get_transfer_config(),
+                ),
+                description=f"upload of {local_file}",
+            )
+        elif n_bytes >= get_transfer_config().multipart_threshold:
+            # the ETags are taken from the responses of the uploads, which are right without an
+            # extra request, also with SSE-KMS or SSE-C where they are not the MD5 of the content
+            etag = put_file_resumable(bucket, client, local_file, key)
+            manifestlib.add(bucket, key, n_bytes, etag)
+        else:
+            etag = retry_with_backoff(
+                partial(_put_object_file, bucket, client, local_file, key),
+                description=f"upload of {local_file}",
+            )
+            journallib.record_file("put", bucket, key, local_file, etag)
+            manifestlib.add(bucket, key, n_bytes, etag)
     except BaseException as ex:
         return_code = 215
         print(f"failed to upload {local_file}: {str(ex)}")
 
+    record_transfer("put", n_bytes, start, return_code)
     return return_code
 
 
-# multi-threaded impl: files in folder to s3 bucket/prefix/
+# true when an earlier attempt of the job recorded an upload of the same content to the key
+def is_journaled_put(bucket: str, local_file: Path, key: str):
+    entry = journallib.get("put", bucket, key)
+    if entry is None or entry["size"] != Path(local_file).stat().st_size:
+        return False
+    if journallib.is_same_file(entry, local_file):
+        return True
+    # another host, or the file was written again: compare the content
+    return local_etag(local_file, entry.get("part_size")) == entry["etag"]
+
+
+# lists the parts of a multipart upload, as {part number: MD5 hex digest}
+def _list_parts(bucket: str, client: boto3.client, key: str, upload_id: str):
+    parts = {}
+    paginator = client.get_paginator("list_parts")
+    for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get("Parts", []):
+            parts[part["PartNumber"]] = part["ETag"].strip('"')
+    return parts
+
+
+# uploads a large file in parts, recording the multipart upload in the transfer journal. When an
+# earlier attempt left the upload unfinished, the parts already in S3 with the same content are
+# kept and only the missing parts are uploaded. Returns the ETag of the object
+def put_file_resumable(bucket: str, client: boto3.client, local_file: Path, key: str):
+    size = Path(local_file).stat().st_size
+    # S3 allows at most 10000 parts
+    part_size = max(_transfer_settings["multipart_chunksize"], -(-size // 10000))
+    n_parts = max(1, -(-size // part_size))
+
+    upload_id = None
+    # part number: [MD5, ETag] of the parts recorded in the journal that are still in S3. With
+    # SSE-KMS or SSE-C the ETag of a part is not its MD5, so both are kept
+    uploaded = {}
+    entry = journallib.get("multipart", bucket, key)
+    if entry is not None and entry["size"] == size and entry["part_size"] == part_size:
+        try:
+            listed = _list_parts(bucket, client, key, entry["upload_id"])
+            upload_id = entry["upload_id"]
+            uploaded = {
+                int(number): value
+                for number, value in entry["parts"].items()
+                if listed.get(int(number)) == value[1]
+            }
+        except ClientError:
+            # the upload was completed or aborted since
+            pass
+    if upload_id is None:
+        upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        journallib.record(
+            "multipart",
+            bucket,
+            key,
+            upload_id=upload_id,
+            size=size,
+            part_size=part_size,
+        )
+
+    n_kept = 0
+    with open(local_file, "rb") as f:
+
+        def put_part(part_number):
+            nonlocal n_kept
+            start = (part_number - 1) * part_size
+            data = os.pread(f.fileno(), min(part_size, size - start), start)
+            digest = hashlib.md5(data).hexdigest()
+            kept = uploaded.get(part_number)
+            if kept is not None and kept[0] == digest:
+                n_kept += 1
+                return kept[1]
+            response = retry_with_backoff(
+                partial(
+                    client.upload_part,
+                    Bucket=bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=data,
+                ),
+                description=f"part {part_number} of {local_file}",
+            )
+            etag = response["ETag"].strip('"')
+            journallib.add_part("multipart", bucket, key, part_number, [digest, etag])
+            return etag
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=_transfer_settings["max_concurrency"]
+        ) as executor:
+            etags = list(executor.map(in_context(put_part), range(1, n_parts + 1)))
+
+    response = client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": i + 1, "ETag": f'"{etag}"'}
+                for i, etag in enumerate(etags)
+            ]
+        },
+    )
+    if n_kept > 0:
+        print(f"resumed upload of {local_file}: kept {n_kept} of {n_parts} parts")
+    journallib.record_file(
+        "put", bucket, key, local_file, response["ETag"], part_size=part_size
+    )
+    journallib.clear("multipart", bucket, key)
+    return response["ETag"]
+
+
+# uploads a file below the multipart threshold in a single PUT, and returns its ETag
+def _put_object_file(bucket: str, client: boto3.client, local_file: Path, key: str):
+    with open(local_file, "rb") as f:
+        return client.put_object(Bucket=bucket, Key=key, Body=f)["ETag"]
+
+
+# uploads a file unless the object listed at its key has the same content. Used by put_files in sync
+# mode, returns the upload return code and whether the file was skipped
+def put_file_if_changed(
+    bucket: str, client: boto3.client, local_file: Path, key: str, remote: dict
+):
+    try:
+        if remote is not None and is_unchanged(
+            local_file, remote["Size"], remote["ETag"]
+        ):
+            manifestlib.add(bucket, key, remote["Size"], remote["ETag"])
+            return 0, True
+    except OSError as ex:
+        print(f"failed to upload {local_file}: {str(ex)}")
+        return 215, False
+
+    return put_file(bucket, client, local_file, key), False
+
+
+# the async engine only talks to S3, transfers with the local storage backend use the thread pool.
+# It does not record transfers in the transfer journal either, so the thread pool is used while
+# the journal is enabled, or when the optional aiobotocore package is not installed
+def _engine_for_backend(engine: str, threads: int):
+    if engine == "async" and storagelib.is_local():
+        return "threads", 0
+    if engine == "async" and journallib.is_enabled():
+        print("transfer journal enabled: using the thread engine instead of async")
+        return "threads", 0
+    if engine == "async" and importlib.util.find_spec("aiobotocore") is None:
+        print(
+            "warning, the async engine requires aiobotocore (pip install aiobotocore): using the thread engine"
+        )
+        return "threads", 0
+    return engine, threads
+
+
+# yields each file under local_folder matching filter, with the key it is stored at under prefix
+def local_files_with_keys(local_folder: Path, prefix: str, filter: str = "*"):
+    # Path ignores preceding './'. Remove it so we can substitute accurately
+    local_folder = str(local_folder)
+    if len(local_folder) > 2 and str(local_folder).startswith("./"):
+        local_folder = str(local_folder)[2:]
+
+    for file in Path(local_folder).rglob(filter):
+        if file.is_file() and not "DS_Store" in file.name:
+            if str(file).startswith(str(local_folder)):
+                tmp = str(file)[len(str(local_folder)) :]
+                if len(str(prefix)) > 0 and prefix[len(str(prefix)) - 1] != "/":
+                    prefix = prefix + "/"
+                key = prefix + tmp
+            key = key.replace("//", "/")
+            yield file, key
+
+
+# multi-threaded impl: files in folder to s3 bucket/prefix/. With sync, the destination prefix is
+# listed once and only new or changed files are uploaded
 def put_files(
     bucket_name: str,
     local_folder: Path,
     prefix: str,
     filter: str = "*",
-    threads: int = 10,
+    threads: int = 0,
+    sync: bool = False,
+    engine: str = "threads",
 ):
+    engine, threads = _engine_for_backend(engine, threads)
+    if engine == "async":
+        import s3asynclib
+
+        return s3asynclib.put_files(
+            bucket_name,
+            local_folder,
+            prefix,
+            filter,
+            concurrency=threads if threads > 0 else DEFAULT_CONCURRENCY["async"],
+            sync=sync,
+        )
+
     return_code = 0
 
     print(f"storing files: {local_folder} to s3://{bucket_name}/{prefix}")
-    session = boto3.Session()
-    client = session.client("s3")
+    client = get_client(min_connections=max_threads(threads))
 
-    # Path ignores preceding './'. Remove it so we can substitute accurately
-    local_folder = str(local_folder)
-    if len(local_folder) > 2 and str(local_folder).startswith("./"):
-        local_folder = str(local_folder)[2:]
+    remote_objects = {}
+    if sync:
+        try:
+            for obj in list_object_info(bucket_name, client, prefix):
+                remote_objects[obj["Key"]] = obj
+        except Exception as err:
+            print(f"error listing s3://{bucket_name}/{prefix}: {str(err)}")
+            return 216
+
+    n_files = 0
+    n_skipped = 0
+    skipped_bytes = 0
+    count_lock = threading.Lock()
+
+    def sync_file(file, key, size):
+        nonlocal n_skipped, skipped_bytes
+        process_result, skipped = put_file_if_changed(
+            bucket_name, client, file, key, remote_objects.get(key)
+        )
+        if skipped:
+            with count_lock:
+                n_skipped += 1
+                skipped_bytes += size
+        return process_result
+
+    def upload_jobs():
+        nonlocal n_files
+        for file, key in local_files_with_keys(local_folder, prefix, filter):
+            n_files += 1
+            size = file.stat().st_size
+            if sync:
+                yield sync_file, (file, key, size), size
+            else:
+                yield put_file, (bucket_name, client, file, key), size
 
-    futures = []
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            for file in Path(local_folder).rglob(filter):
-                if file.is_file() and not "DS_Store" in file.name:
-                    if str(file).startswith(str(local_folder)):
-                        tmp = str(file)[len(str(local_folder)) :]
-                        if len(str(prefix)) > 0 and prefix[len(str(prefix)) - 1] != "/":
-                            prefix = prefix + "/"
-                        key = prefix + tmp
-                    key = key.replace("//", "/")
-                    futures.append(
-                        executor.submit(put_file, bucket_name, client, file, key)
-                    )
-
-            for future in concurrent.futures.as_completed(futures):
-                process_result = future.result()
-                if process_result != 0:
-                    return_code = process_result
+        return_code = run_pipelined(upload_jobs(), threads)
     except Exception as err:
         print(
             f"error copying {local_folder} to s3://{bucket_name}/{prefix}: {str(err)}"
         )
         return_code = 216
 
+    if sync:
+        print(
+            f"sync: uploaded {n_files - n_skipped} files, skipped {n_skipped} unchanged files ({skipped_bytes} bytes)"
+        )
+    report_journal(n_files)
+
     return return_code
 
 
@@ -151,31 +1108,230 @@ def get_file(bucket: str, local_file: str, client: boto3.client, key: str):
         client (boto3.client): S3 client
         s3_file (str): S3 object name
     """
+    start = time.perf_counter()
+    n_bytes = 0
     try:
         # print(f'downloading: {local_file} from s3://{bucket}/{key}')
         os.makedirs(os.path.dirname(local_file), exist_ok=True)
 
-        client.download_file(Bucket=bucket, Key=str(key), Filename=str(local_file))
+        retry_with_backoff(
+            partial(
+                client.download_file,
+                Bucket=bucket,
+                Key=str(key),
+                Filename=str(local_file),
+                Config=get_transfer_config(),
+            ),
+            description=f"download of {key}",
+        )
+        n_bytes = os.path.getsize(local_file)
     except BaseException as ex:
         print(f"failed to download {local_file} from {key}: {str(ex)}")
         return_code = 217
 
+    record_transfer("get", n_bytes, start, return_code)
+    return return_code
+
+
+# downloads one byte range of an object into the open file descriptor. The response must be the
+# exact range of the same object version (etag), returns the MD5 digest of the part
+def _get_range(
+    bucket: str,
+    client: boto3.client,
+    key: str,
+    etag: str,
+    fd: int,
+    start: int,
+    end: int,
+):
+    response = client.get_object(
+        Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag
+    )
+    content_range = response.get("ContentRange", "")
+    if not content_range.startswith(f"bytes {start}-{end}/"):
+        raise IOError(f"unexpected range {content_range}, requested {start}-{end}")
+
+    md5 = hashlib.md5()
+    offset = start
+    for chunk in response["Body"].iter_chunks(MB):
+        os.pwrite(fd, chunk, offset)
+        md5.update(chunk)
+        offset += len(chunk)
+
+    if offset != end + 1:
+        raise IOError(
+            f"short read of range {start}-{end}, received {offset - start} bytes"
+        )
+    return md5.digest()
+
+
+# downloads a large object as concurrent byte ranges written into a preallocated file. Each part is
+# checked for its range, length and ETag, and retried on failure. When the ranges follow the
+# object's multipart layout, the combined part digests are also checked against the ETag
+def get_file_ranged(
+    bucket: str,
+    local_file: str,
+    client: boto3.client,
+    key: str,
+    size: int,
+    etag: str,
+    part_size: int = None,
+    threads: int = None,
+):
+    start_time = time.perf_counter()
+    if part_size is None:
+        part_size = _transfer_settings["range_part_size"]
+    if threads is None:
+        threads = _transfer_settings["range_threads"]
+
+    n_upload_parts = int(etag.strip('"').split("-")[1]) if "-" in etag else 0
+    verify_etag = False
+    try:
+        if part_size <= 0:
+            if n_upload_parts > 1:
+                # every part of a multipart upload but the last has the size of the first
+                head = client.head_object(Bucket=bucket, Key=key, PartNumber=1)
+                part_size = head["ContentLength"]
+            else:
+                part_size = 64 * MB
+        if n_upload_parts > 0 and -(-size // part_size) == n_upload_parts:
+            verify_etag = True
+    except BaseException as ex:
+        print(f"failed to download {local_file} from {key}: {str(ex)}")
+        record_transfer("get", 0, start_time, 217)
+        return 217
+
+    ranges = [
+        (start, min(start + part_size, size) - 1) for start in range(0, size, part_size)
+    ]
+    print(
+        f"downloading {key} in {len(ranges)} ranges of {part_size // MB} MB with {threads} threads"
+    )
+
+    tmp_file = f"{local_file}.part"
+    return_code = 0
+    fd = None
+    try:
+        if os.path.dirname(local_file) != "":
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+
+        # ranges an earlier attempt on this host completed into the same partial file
+        done = {}
+        entry = journallib.get("range", bucket, key)
+        if (
+            entry is not None
+            and entry["etag"] == etag
+            and entry["part_size"] == part_size
+            and entry["path"] == tmp_file
+            and os.path.exists(tmp_file)
+        ):
+            done = entry["parts"]
+            print(f"resuming download of {key}: {len(done)} ranges already complete")
+            fd = os.open(tmp_file, os.O_WRONLY)
+        else:
+            journallib.record(
+                "range", bucket, key, etag=etag, part_size=part_size, path=tmp_file
+            )
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            # reserve the space up front, so a full disk fails before any data is moved
+            if hasattr(os, "posix_fallocate") and size > 0:
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+
+        def get_part(start, end):
+            if str(start) in done:
+                return bytes.fromhex(done[str(start)])
+            digest = retry_with_backoff(
+                _get_range,
+                bucket,
+                client,
+                key,
+                etag,
+                fd,
+                start,
+                end,
+                description=f"range {start}-{end} of {key}",
+            )
+            journallib.add_part("range", bucket, key, start, digest.hex())
+            return digest
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            digests = list(executor.map(in_context(lambda r: get_part(*r)), ranges))
+
+        if verify_etag:
+            combined = hashlib.md5(b"".join(digests)).hexdigest()
+            if f"{combined}-{len(digests)}" != etag.strip('"'):
+                journallib.clear("range", bucket, key)
+                raise IOError(f"ETag mismatch, expected {etag}")
+
+        os.close(fd)
+        fd = None
+        os.replace(tmp_file, local_file)
+        journallib.clear("range", bucket, key)
+    except BaseException as ex:
+        print(f"failed to download {local_file} from {key}: {str(ex)}")
+        return_code = 217
+    finally:
+        if fd is not None:
+            os.close(fd)
+        # with a journal, the partial file is kept for the next attempt to resume
+        if (
+            return_code != 0
+            and os.path.exists(tmp_file)
+            and journallib.get("range", bucket, key) is None
+        ):
+            os.remove(tmp_file)
+
+    record_transfer("get", size if return_code == 0 else 0, start_time, return_code)
+    return return_code
+
+
+# downloads an object into the fetch cache, then places it at local_file. A size is given when the
+# object should be downloaded in concurrent ranges
+def get_file_cached(
+    bucket: str,
+    local_file: str,
+    client: boto3.client,
+    key: str,
+    etag: str,
+    size: int = None,
+):
+    if size is not None:
+        # a fixed name, so an interrupted ranged download can be resumed
+        tmp_file = cachelib.temp_path(cachelib.cache_path(bucket, key, etag).name)
+    else:
+        tmp_file = cachelib.temp_path()
+    if size is not None:
+        return_code = get_file_ranged(bucket, str(tmp_file), client, key, size, etag)
+    else:
+        return_code = get_file(bucket, tmp_file, client, key)
+    if return_code == 0:
+        try:
+            cached_file = cachelib.add(bucket, key, etag, tmp_file)
+            cachelib.materialize(cached_file, local_file)
+        except Exception as ex:
+            print(f"failed to download {local_file} from {key}: {str(ex)}")
+            return_code = 217
+    elif tmp_file.exists():
+        tmp_file.unlink()
+
     return return_code
 
 
 # multithreaded implementation
 def get_files_list(bucket_name: str, keys: list, local_folder: str, threads: int = 10):
     return_code = 0
-    # Creating only one session and one client
-    session = boto3.Session()
-    client = session.client("s3")
+    client = get_client(min_connections=threads)
 
     futures = []
     with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
         for key in keys:
             rel_key = Path(key).name
             local_file = Path(local_folder).joinpath(rel_key)
-            future = executor.submit(get_file, bucket_name, local_file, client, key)
+            future = executor.submit(
+                in_context(get_file), bucket_name, local_file, client, key
+            )
             futures.append(future)
 
         for future in concurrent.futures.as_completed(futures):
@@ -186,73 +1342,394 @@ def get_files_list(bucket_name: str, keys: list, local_folder: str, threads: int
     return return_code
 
 
+# runs fn(*args) for every (fn, args) job of an iterator on worker threads, and returns the last
+# non-zero result. Jobs are handed over through a bounded queue, so the producer (e.g. a listing)
+# only runs a little ahead of the transfers and memory stays flat however many jobs there are
+# When threads is 0 the number of transfers in flight is chosen by an AdaptiveLimiter, and a job may
+# carry its size in bytes as a third element, (fn, args, n_bytes), to measure the throughput
+def run_pipelined(jobs, threads: int, queue_size: int = None):
+    limiter = None
+    if threads <= 0:
+        limiter = AdaptiveLimiter()
+        threads = limiter.max_limit
+    if queue_size is None:
+        queue_size = threads * 4
+    job_queue = queue.Queue(maxsize=queue_size)
+    return_code = 0
+    error = None
+
+    def worker():
+        nonlocal return_code, error
+        while True:
+            job = job_queue.get()
+            if job is None:
+                return
+            fn, args = job[0], job[1]
+            result = None
+            job_error = None
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                result = fn(*args)
+                if result != 0:
+                    return_code = result
+            except BaseException as err:
+                error = job_error = err
+            finally:
+                if limiter is not None:
+                    # transfer functions report failures as return codes, treat them as errors
+                    if job_error is None and result not in (0, None):
+                        job_error = RuntimeError(f"return code {result}")
+                    n_bytes = job[2] if len(job) > 2 and job_error is None else 0
+                    limiter.release(n_bytes, job_error)
+
+    workers = [
+        threading.Thread(target=in_context(worker), daemon=True) for i in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    try:
+        for job in jobs:
+            if error is not None:
+                break
+            job_queue.put(job)
+    finally:
+        for thread in workers:
+            job_queue.put(None)
+        for thread in workers:
+            thread.join()
+
+    if limiter is not None:
+        limiter.report()
+    if error is not None:
+        raise error
+    return return_code
+
+
+# the most threads a transfer may use, taking the adaptive limit into account
+def max_threads(threads: int):
+    if threads <= 0:
+        return _transfer_settings["adaptive_max_threads"]
+    return threads
+
+
+# maps a key found under prefix to its path below local_path, keeping the folders after the prefix
+def local_file_for_key(prefix: str, key: str, local_path: Path):
+    if len(prefix) == 0:
+        return local_path.joinpath(key)
+
+    # get last index of '/'
+    tmp_prefix = prefix
+    if prefix[-1] != "/":
+        tmp_prefix = os.path.dirname(prefix)
+    rel_key = key.replace(tmp_prefix, "")
+    if rel_key[0] == "/":
+        rel_key = rel_key[1:]
+    return local_path.joinpath(rel_key)
+
+
 def get_files(
     bucket_name: str,
     prefix: str,
     local_path: str,
     filter: str = None,
-    threads: int = 10,
+    threads: int = 0,
+    use_cache: bool = True,
+    engine: str = "threads",
+    list_depth: int = None,
+    objects: list = None,
 ):
     return_code = 0
-    # create only one session and one client
-    session = boto3.Session()
-    client = session.client("s3")
+    engine, threads = _engine_for_backend(engine, threads)
+    client = get_client(
+        min_connections=max(max_threads(threads), _transfer_settings["range_threads"])
+    )
     print(f"fetching: {local_path} from s3://{bucket_name}/{prefix}")
 
     the_local_path = Path(local_path)
+    use_cache = use_cache and cachelib.is_enabled()
+    cache_hits = 0
+    cache_bytes = 0
+
+    # objects, e.g. from output manifests, are fetched without listing the prefix
+    if objects is None:
+        objects = list_object_info(
+            bucket_name=bucket_name, client=client, prefix=prefix, depth=list_depth
+        )
+    listing = (
+        obj
+        for obj in objects
+        if filter is None or filter == "" or re.search(filter, obj["Key"])
+    )
+    # look ahead just far enough to tell a single object from many. The rest of the listing is
+    # consumed page by page while the downloads run
+    first_objects = list(itertools.islice(listing, 2))
+    n_objects = len(first_objects)
 
-    keys = []
-    for key in list_objects(bucket_name=bucket_name, client=client, prefix=prefix):
-        if filter is None or filter == "" or re.search(filter, key):
-            keys.append(key)
+    # skips an object an earlier attempt of the job already fetched to local_file, and serves the
+    # object from the fetch cache when it holds the same ETag. Otherwise returns a function and
+    # arguments that download the object
+    def plan_fetch(obj, local_file, ranged=False):
+        if journallib.is_enabled():
+            entry = journallib.get("get", bucket_name, obj["Key"])
+            if (
+                entry is not None
+                and entry["etag"] == obj["ETag"].strip('"')
+                and journallib.is_same_file(entry, local_file)
+            ):
+                journallib.count_resumed()
+                metricslib.record("journaled", obj["Size"])
+                return None, None
 
-    # print (f"len of keys: {len(keys)}")
+            fn, args = plan_download(obj, local_file, ranged)
+            if fn is None:
+                return None, None
+            return get_file_journaled, (fn, args, bucket_name, obj, local_file)
+        return plan_download(obj, local_file, ranged)
 
-    if len(keys) == 1:
-        file_name = Path(keys[0]).name
+    def plan_download(obj, local_file, ranged):
+        nonlocal cache_hits, cache_bytes
+        key = obj["Key"]
+        # a single large object is split into byte ranges, as there is no other parallelism
+        ranged = ranged and obj["Size"] >= _transfer_settings["range_threshold"]
+        if not use_cache:
+            if ranged:
+                return get_file_ranged, (
+                    bucket_name,
+                    str(local_file),
+                    client,
+                    key,
+                    obj["Size"],
+                    obj["ETag"],
+                )
+            return get_file, (bucket_name, local_file, client, key)
+
+        cached_file = cachelib.lookup(bucket_name, key, obj["ETag"], obj["Size"])
+        if cached_file is None:
+            size = obj["Size"] if ranged else None
+            return get_file_cached, (
+                bucket_name,
+                local_file,
+                client,
+                key,
+                obj["ETag"],
+                size,
+            )
+
+        cachelib.materialize(cached_file, local_file)
+        cache_hits += 1
+        cache_bytes += obj["Size"]
+        metricslib.record("cached", obj["Size"])
+        return None, None
+
+    if n_objects == 1:
+        key = first_objects[0]["Key"]
+        file_name = Path(key).name
         # if an existing directory is given
         if the_local_path.exists() and the_local_path.is_dir():
             local_file = the_local_path.joinpath(file_name)
         else:
             # if the local path ends with the filename from the key, or if the requested key was exact, don't append
-            if str(local_path).endswith(file_name) or keys[0] == prefix:
+            if str(local_path).endswith(file_name) or key == prefix:
                 local_file = local_path
             else:
                 local_file = the_local_path.joinpath(file_name)
 
-        return_code = get_file(bucket_name, local_file, client, keys[0])
-    elif len(keys) > 1:
+        fn, args = plan_fetch(first_objects[0], local_file, ranged=True)
+        if fn is not None:
+            return_code = fn(*args)
+    elif n_objects > 1 and engine == "async":
+        import s3asynclib
+
+        return s3asynclib.get_files(
+            bucket_name,
+            prefix,
+            local_path,
+            itertools.chain(first_objects, listing),
+            filter,
+            concurrency=threads if threads > 0 else DEFAULT_CONCURRENCY["async"],
+            use_cache=use_cache,
+        )
+    elif n_objects > 1:
         # assume we are downloading to a directory when there are multiple files
         os.makedirs(the_local_path, exist_ok=True)
 
-        # multithreaded fetch
-        futures = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            for key in keys:
-                if filter is None or filter == "" or re.search(filter, key):
-                    # get last index of '/'
-                    if len(prefix) == 0:
-                        local_file = the_local_path.joinpath(key)
-                    else:
-                        tmp_prefix = prefix
-                        if prefix[-1] != "/":
-                            tmp_prefix = os.path.dirname(prefix)
-                        rel_key = key.replace(tmp_prefix, "")
-                        if rel_key[0] == "/":
-                            rel_key = rel_key[1:]
-                        local_file = the_local_path.joinpath(rel_key)
-
-                    # print(f'prefix: {prefix}  tmp_prefix: {tmp_prefix} rel_key: {rel_key} local_file {local_file}')
-                    futures.append(
-                        executor.submit(get_file, bucket_name, local_file, client, key)
-                    )
-
-            for future in concurrent.futures.as_completed(futures):
-                process_result = future.result()
-                if process_result != 0:
-                    return_code = process_result
+        def fetch_jobs():
+            nonlocal n_objects
+            for i, obj in enumerate(itertools.chain(first_objects, listing)):
+                n_objects = i + 1
+                local_file = local_file_for_key(prefix, obj["Key"], the_local_path)
+                fn, args = plan_fetch(obj, local_file)
+                if fn is not None:
+                    yield fn, args, obj["Size"]
+
+        # multithreaded fetch, downloads start as soon as the first page is listed
+        return_code = run_pipelined(fetch_jobs(), threads)
     else:
         print(f"error: no object found at s3://{bucket_name}/{prefix}")
         return_code = 218
 
+    if use_cache and n_objects > 0:
+        print(
+            f"fetch cache: {cache_hits} of {n_objects} objects ({cache_bytes} bytes) served from {cachelib.CACHE_DIR}"
+        )
+        cachelib.evict()
+    report_journal(n_objects)
+
+    return return_code
+
+
+# runs a download planned by get_files, and records it in the transfer journal when it succeeds
+def get_file_journaled(fn, args, bucket: str, obj: dict, local_file: Path):
+    return_code = fn(*args)
+    if return_code == 0:
+        journallib.record_file("get", bucket, obj["Key"], local_file, obj["ETag"])
+    return return_code
+
+
+# logs the transfers skipped thanks to the journal, and copies the journal to S3
+def report_journal(n_objects: int):
+    if not journallib.is_enabled():
+        return
+    n_resumed = journallib.take_resumed()
+    if n_resumed > 0:
+        print(
+            f"transfer journal: {n_resumed} of {n_objects} objects already transferred by an earlier attempt"
+        )
+    journallib.flush(wait=True)
+
+
+# file-like reader over an S3 object body. A background thread keeps reading ahead into a bounded
+# queue, so the download carries on while the consumer (e.g. a decompressor) is busy
+class ReadAheadStream(io.RawIOBase):
+    def __init__(self, body, chunk_size: int = MB, max_chunks: int = 16):
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = memoryview(b"")
+        self._error = None
+        self._eof = False
+        self._closing = False
+        self._thread = threading.Thread(
+            target=self._fill, args=(body, chunk_size), daemon=True
+        )
+        self._thread.start()
+
+    def _fill(self, body, chunk_size: int):
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                if self._closing:
+                    break
+                self._queue.put(chunk)
+        except BaseException as err:
+            self._error = err
+        finally:
+            body.close()
+            self._queue.put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) == 0 and not self._eof:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._eof = True
+                if self._error is not None:
+                    raise self._error
+            else:
+                self._buffer = memoryview(chunk)
+
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        # unblock the reader thread if the consumer stopped early
+        self._closing = True
+        while not self._eof:
+            if self._queue.get() is None:
+                self._eof = True
+        super().close()
+
+
+# streams an archive (see ziplib.STREAM_ARCHIVE_SUFFIXES) from S3 and expands it while it
+# downloads. The archive is never staged on disk
+def expand_s3_object(bucket_name: str, key: str, destination_path: str):
+    print(f"streaming: s3://{bucket_name}/{key} to {destination_path}")
+    start = time.perf_counter()
+    try:
+        response = get_client().get_object(Bucket=bucket_name, Key=key)
+    except Exception as err:
+        print(f"error fetching s3://{bucket_name}/{key}: {str(err)}")
+        record_transfer("get", 0, start, 219)
+        return 219
+
+    stream = ReadAheadStream(response["Body"])
+    try:
+        return_code = ziplib.expand_stream(
+            stream, destination_path, name=f"s3://{bucket_name}/{key}"
+        )
+    finally:
+        stream.close()
+    record_transfer("get", response["ContentLength"], start, return_code)
+    return return_code
+
+
+# downloads the files under prefix and expands each .7z archive as soon as it arrives, while the
+# following archives keep downloading. At most 'threads' archives are staged on disk at a time
+def get_files_expanded(
+    bucket_name: str,
+    prefix: str,
+    local_path: str,
+    remove_zips: bool = True,
+    threads: int = 10,
+):
+    return_code = 0
+    client = get_client(min_connections=threads)
+    print(f"fetching and expanding: {local_path} from s3://{bucket_name}/{prefix}")
+
+    the_local_path = Path(local_path)
+    keys = (
+        obj["Key"]
+        for obj in list_object_info(
+            bucket_name=bucket_name, client=client, prefix=prefix
+        )
+    )
+    n_keys = 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {}
+        while True:
+            # keep the download threads busy, but never run too far ahead of the expansion
+            while len(pending) < threads:
+                key = next(keys, None)
+                if key is None:
+                    break
+                n_keys += 1
+                local_file = local_file_for_key(prefix, key, the_local_path)
+                future = executor.submit(
+                    in_context(get_file), bucket_name, local_file, client, key
+                )
+                pending[future] = local_file
+
+            if len(pending) == 0:
+                break
+
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                local_file = pending.pop(future)
+                rc = future.result()
+                if rc == 0 and str(local_file).endswith(".7z"):
+                    rc = ziplib.expand(local_file, Path(local_file).parent)
+                    if rc == 0 and remove_zips:
+                        os.remove(local_file)
+                if rc != 0:
+                    return_code = rc
+
+    if n_keys == 0:
+        print(f"error: no object found at s3://{bucket_name}/{prefix}")
+        return_code = 218
+
     return return_code
@@ -50,6 +50,13 @@ parser.add_argument(
     help="when the workitems parameter provides a numeric value, a numeric range or comma-separated list, the number of padded zeros (optional)",
     default=3,
 )
+parser.add_argument(
+    "-items-per-job",
+    dest="itemsPerJob",
+    type=int,
+    help="the number of work items each job runs in turn, sharing the inputs it fetches (optional)",
+    default=1,
+)
 parser.add_argument(
     "-name-value",
     action="append",
@@ -72,6 +79,26 @@ group1.add_argument(
 )
 
 
+# the longest list of work items passed in $WORK_ITEMS, longer lists are stored in S3 and passed
+# in $WORK_ITEMS_MANIFEST. Container overrides are limited to 8 KB
+MAX_WORK_ITEMS_LENGTH = 4096
+
+
+# the job name for a work item, or a group of items named after the first
+def job_name_for(work_items: list):
+    # Need to remove certain characters from the job name
+    job_name = (
+        work_items[0]
+        .replace("/", "_")
+        .replace(" ", "_")
+        .replace("*", "X")
+        .replace("_", "p")
+    )
+    if len(work_items) > 1:
+        job_name += f"-and-{len(work_items) - 1}"
+    return job_name
+
+
 # starts batch jobs in AWS using the list of work items specified
 def main(args):
     if args.jobDef is None:
@@ -101,40 +128,51 @@ def main(args):
         if any(len(kv) < 2 for kv in args.name_values):
             raise ValueError('-name-value must be given in the form "KEY=VALUE"')
 
+    if args.itemsPerJob < 1:
+        print("Error: -items-per-job must be at least 1")
+        exit(-1)
+
     if not args.apply:
         print("previewing job startup...")
 
     client = boto3.client("batch")
 
     count = 0
-    for work_item in work_items:
+    for start in range(0, len(work_items), args.itemsPerJob):
+        job_items = work_items[start : start + args.itemsPerJob]
+        work_item = job_items[0] if len(job_items) == 1 else ",".join(job_items)
         count = count + 1
         print(
             f"starting: region [{client.meta.region_name}] bucket [{args.bucket}] job [{str(count).zfill(4)}] with [{work_item}] in mode [{args.mode}]"
         )
         job_queue = args.jobQueue
         job_def = args.jobDef
+        job_name = job_name_for(job_items)
 
         env_vars = [
             {"name": "AWS_REGION", "value": client.meta.region_name},
             {"name": "BUCKET_NAME", "value": args.bucket},
-            {"name": "WORK_ITEM", "value": work_item},
             {"name": "MODE_STR", "value": args.mode},
         ]
+        if len(job_items) == 1:
+            env_vars.append({"name": "WORK_ITEM", "value": work_item})
+        elif len(work_item) <= MAX_WORK_ITEMS_LENGTH:
+            env_vars.append({"name": "WORK_ITEMS", "value": work_item})
+        else:
+            key = f"work-items/{job_name}.txt"
+            if args.apply:
+                boto3.client("s3").put_object(
+                    Bucket=args.bucket, Key=key, Body="\n".join(job_items).encode()
+                )
+            env_vars.append(
+                {"name": "WORK_ITEMS_MANIFEST", "value": f"s3://{args.bucket}/{key}"}
+            )
 
         # add custom variables
         if not (args.name_values is None or len(args.name_values) == 0):
             for name_value in args.name_values:
                 env_vars.append({"name": name_value[0], "value": name_value[1]})
 
-        # Need to remove certain characters from the job name
-        job_name = (
-            work_item.replace("/", "_")
-            .replace(" ", "_")
-            .replace("*", "X")
-            .replace("_", "p")
-        )
-
         if args.apply:
             response = client.submit_job(
                 jobName=job_name,
@@ -0,0 +1,619 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# storage backends for s3lib. A backend is a client object with the subset of the boto3 S3 client
+# API that s3lib uses: list_objects_v2 and list_parts, also paginated, head_object, get_object
+# (with Range, IfMatch), put_object, upload_file, download_file, copy_object, delete_object and the
+# multipart calls (create/upload_part/upload_part_copy/complete/abort). Errors are raised as
+# botocore ClientErrors with the S3 error codes.
+#   STORAGE_BACKEND=s3      the boto3 S3 client (default)
+#   STORAGE_BACKEND=local   a directory tree under STORAGE_ROOT, one folder per bucket, so fetch and
+#                           store pipelines can run and be profiled at disk speed without AWS
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from pathlib import Path
+
+from botocore.exceptions import ClientError, OperationNotPageableError
+
+MB = 1024 * 1024
+
+BACKEND = os.getenv("STORAGE_BACKEND", "s3")
+STORAGE_ROOT = os.getenv("STORAGE_ROOT", "./storage.tmp")
+# the bookkeeping folder of the local backend, inside STORAGE_ROOT: object metadata and
+# multipart uploads in progress
+LOCAL_META_DIR = ".cloudburst"
+
+
+def is_local():
+    return BACKEND == "local"
+
+
+# creates a client of the configured backend
+def create_client(pool_size: int):
+    if BACKEND == "local":
+        return LocalClient(STORAGE_ROOT)
+    if BACKEND != "s3":
+        raise ValueError(f"unknown STORAGE_BACKEND {BACKEND}, expected 's3' or 'local'")
+    # imported with the first client, they take longer to load than the rest of the framework
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(
+        "s3",
+        # e.g. a local S3 stand-in such as minio or moto_server
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=Config(max_pool_connections=pool_size),
+    )
+
+
+def _error(code: str, status: int, operation: str, message: str = ""):
+    return ClientError(
+        {
+            "Error": {"Code": code, "Message": message or code},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        },
+        operation,
+    )
+
+
+def _quote(etag: str):
+    return f'"{etag}"'
+
+
+# the ETag S3 gives an object uploaded in parts with these MD5 digests
+def _multipart_etag(digests: list):
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+# the body of a get_object response, reading length bytes from start
+class _LocalBody:
+    def __init__(self, path: Path, start: int, length: int):
+        self._file = open(path, "rb")
+        self._file.seek(start)
+        self._remaining = length
+
+    def read(self, amt: int = None):
+        if amt is None or amt > self._remaining:
+            amt = self._remaining
+        data = self._file.read(amt)
+        self._remaining -= len(data)
+        return data
+
+    def iter_chunks(self, chunk_size: int = MB):
+        while True:
+            data = self.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# true when key comes after the continuation token. A token that is a common prefix stands for
+# all the keys rolled up into it
+def _is_after(key: str, token: str, delimiter: str):
+    if delimiter and token.endswith(delimiter) and key.startswith(token):
+        return False
+    return key.encode("utf-8") > token.encode("utf-8")
+
+
+class _Paginator:
+    def __init__(self, method):
+        self._method = method
+
+    def paginate(self, **kwargs):
+        return self._method(**kwargs)
+
+
+# a storage backend on the local file system. Objects are files under root/bucket/key, and their
+# ETag, part layout and headers are kept in root/.cloudburst/meta. Objects uploaded in parts get
+# the same multipart ETag as in S3, so ranged downloads, sync and the fetch cache behave the same
+class LocalClient:
+    def __init__(self, root: str):
+        self.root = Path(root).absolute()
+        self._meta_root = self.root.joinpath(LOCAL_META_DIR)
+        os.makedirs(self._meta_root.joinpath("tmp"), exist_ok=True)
+        # objects are replaced, and their metadata rebuilt, under this lock. Conditional writes
+        # check the current object under it too
+        self._write_lock = threading.RLock()
+
+    def _object_path(self, bucket: str, key: str, operation: str):
+        bucket_path = self.root.joinpath(bucket)
+        path = bucket_path.joinpath(key)
+        if (
+            bucket == LOCAL_META_DIR
+            or key == ""
+            or key.endswith("/")
+            or not os.path.abspath(path).startswith(str(bucket_path) + os.sep)
+        ):
+            raise _error("InvalidArgument", 400, operation, f"invalid key {key}")
+        return path
+
+    def _meta_path(self, bucket: str, key: str):
+        return self._meta_root.joinpath("meta", bucket, key + ".json")
+
+    def _temp_path(self):
+        return self._meta_root.joinpath("tmp", uuid.uuid4().hex)
+
+    # the recorded metadata of an object. A file placed in the tree by other means is given the
+    # ETag of a single part upload
+    def _meta(self, bucket: str, key: str, operation: str):
+        path = self._object_path(bucket, key, operation)
+        meta = self._recorded_meta(bucket, key, path, operation)
+        if meta is not None:
+            return path, meta
+
+        with self._write_lock:
+            # the object may have been replaced while it was checked
+            meta = self._recorded_meta(bucket, key, path, operation)
+            if meta is not None:
+                return path, meta
+            md5 = hashlib.md5()
+            with open(path, "rb") as f:
+                for data in iter(lambda: f.read(8 * MB), b""):
+                    md5.update(data)
+            return path, self._write_meta(bucket, key, path, md5.hexdigest(), [])
+
+    # the metadata recorded for the object at path, None when it is missing or out of date
+    def _recorded_meta(self, bucket: str, key: str, path: Path, operation: str):
+        try:
+            st = path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            raise _error("NoSuchKey", 404, operation, f"no such key {key}")
+        if not path.is_file():
+            raise _error("NoSuchKey", 404, operation, f"no such key {key}")
+
+        try:
+            with open(self._meta_path(bucket, key), "r") as f:
+                meta = json.load(f)
+            if meta["size"] == st.st_size and meta["mtime_ns"] == st.st_mtime_ns:
+                return meta
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        return None
+
+    def _write_meta(self, bucket, key, path, etag, part_sizes, headers=None):
+        st = path.stat()
+        meta = {
+            "etag": etag,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "parts": part_sizes,
+            "headers": headers or {},
+        }
+        meta_path = self._meta_path(bucket, key)
+        os.makedirs(meta_path.parent, exist_ok=True)
+        tmp = self._temp_path()
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+        return meta
+
+    # moves a completed temp file into place as the object, and records its metadata
+    def _commit(self, bucket, key, tmp_file, etag, part_sizes, headers, operation):
+        path = self._object_path(bucket, key, operation)
+        if not self.root.joinpath(bucket).is_dir():
+            raise _error("NoSuchBucket", 404, operation, f"no such bucket {bucket}")
+        os.makedirs(path.parent, exist_ok=True)
+        with self._write_lock:
+            os.replace(tmp_file, path)
+            self._write_meta(bucket, key, path, etag, part_sizes, headers)
+        return _quote(etag)
+
+    def _check_etag(self, meta: dict, etag: str, operation: str):
+        if etag is not None and etag.strip('"') != meta["etag"]:
+            raise _error("PreconditionFailed", 412, operation)
+
+    # copies a stream into a temp file, returning the file and its ETag. With a part size, the
+    # ETag is the multipart ETag of parts of that size
+    def _write_temp(self, source, part_size: int = None):
+        tmp = self._temp_path()
+        digests = []
+        part_sizes = []
+        md5 = hashlib.md5()
+        with open(tmp, "wb") as f:
+            while True:
+                data = source.read(part_size or 8 * MB)
+                if not data:
+                    break
+                f.write(data)
+                if part_size:
+                    digests.append(hashlib.md5(data).digest())
+                    part_sizes.append(len(data))
+                else:
+                    md5.update(data)
+        if part_size and len(digests) > 0:
+            return tmp, _multipart_etag(digests), part_sizes
+        return tmp, md5.hexdigest(), []
+
+    @staticmethod
+    def _headers(kwargs: dict):
+        names = (
+            "ContentType",
+            "ContentEncoding",
+            "ContentDisposition",
+            "ContentLanguage",
+            "CacheControl",
+            "Metadata",
+        )
+        return {name: kwargs[name] for name in names if name in kwargs}
+
+    def create_bucket(self, Bucket: str, **kwargs):
+        os.makedirs(self.root.joinpath(Bucket), exist_ok=True)
+        return {}
+
+    @staticmethod
+    def _head(meta: dict):
+        return {
+            "ContentLength": meta["size"],
+            "ETag": _quote(meta["etag"]),
+            "LastModified": datetime.datetime.fromtimestamp(
+                meta["mtime_ns"] / 1e9, datetime.timezone.utc
+            ),
+            "Metadata": {},
+            **meta["headers"],
+        }
+
+    def head_object(self, Bucket: str, Key: str, IfMatch=None, PartNumber=None):
+        path, meta = self._meta(Bucket, Key, "HeadObject")
+        self._check_etag(meta, IfMatch, "HeadObject")
+        length = meta["size"]
+        response = self._head(meta)
+        if PartNumber is not None:
+            parts = meta["parts"] or [length]
+            if PartNumber > len(parts):
+                raise _error("InvalidPartNumber", 416, "HeadObject")
+            length = parts[PartNumber - 1]
+            response["PartsCount"] = len(parts)
+        response["ContentLength"] = length
+        return response
+
+    def get_object(self, Bucket: str, Key: str, Range=None, IfMatch=None, **kwargs):
+        # the body is opened under the lock, so it is the version the metadata describes even
+        # when the object is replaced at the same time
+        with self._write_lock:
+            return self._get_object(Bucket, Key, Range, IfMatch)
+
+    def _get_object(self, Bucket: str, Key: str, Range, IfMatch):
+        path, meta = self._meta(Bucket, Key, "GetObject")
+        self._check_etag(meta, IfMatch, "GetObject")
+        size = meta["size"]
+        start, end = 0, size - 1
+        response = self._head(meta)
+        if Range is not None:
+            try:
+                first, last = Range[len("bytes=") :].split("-")
+                start = int(first)
+                end = min(int(last), size - 1) if last != "" else size - 1
+            except ValueError:
+                raise _error("InvalidRange", 416, "GetObject", Range)
+            if start > end:
+                raise _error("InvalidRange", 416, "GetObject", Range)
+            response["ContentRange"] = f"bytes {start}-{end}/{size}"
+        response["ContentLength"] = end - start + 1
+        response["Body"] = _LocalBody(path, start, end - start + 1)
+        return response
+
+    def put_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Body=b"",
+        IfMatch=None,
+        IfNoneMatch=None,
+        **kwargs,
+    ):
+        if isinstance(Body, (bytes, bytearray)):
+            tmp = self._temp_path()
+            with open(tmp, "wb") as f:
+                f.write(Body)
+            etag = hashlib.md5(Body).hexdigest()
+        else:
+            tmp, etag, _ = self._write_temp(Body)
+        with self._write_lock:
+            if IfMatch is not None or IfNoneMatch is not None:
+                try:
+                    path, meta = self._meta(Bucket, Key, "PutObject")
+                except ClientError:
+                    meta = None
+                if (IfNoneMatch == "*" and meta is not None) or (
+                    IfMatch is not None
+                    and (meta is None or IfMatch.strip('"') != meta["etag"])
+                ):
+                    os.remove(tmp)
+                    raise _error("PreconditionFailed", 412, "PutObject")
+            etag = self._commit(
+                Bucket, Key, tmp, etag, [], self._headers(kwargs), "PutObject"
+            )
+        return {"ETag": etag}
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs):
+        path = self._object_path(Bucket, Key, "DeleteObject")
+        for file in (path, self._meta_path(Bucket, Key)):
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+        return {}
+
+    # follows the transfer manager: files of at least the multipart threshold get a multipart ETag
+    def upload_file(
+        self,
+        Filename,
+        Bucket: str,
+        Key: str,
+        ExtraArgs=None,
+        Callback=None,
+        Config=None,
+    ):
+        threshold = Config.multipart_threshold if Config else 8 * MB
+        chunk_size = Config.multipart_chunksize if Config else 8 * MB
+        part_size = chunk_size if os.path.getsize(Filename) >= threshold else None
+        with open(Filename, "rb") as f:
+            tmp, etag, part_sizes = self._write_temp(f, part_size)
+        self._commit(Bucket, Key, tmp, etag, part_sizes, ExtraArgs or {}, "PutObject")
+
+    def download_file(
+        self,
+        Bucket: str,
+        Key: str,
+        Filename,
+        ExtraArgs=None,
+        Callback=None,
+        Config=None,
+    ):
+        path, meta = self._meta(Bucket, Key, "GetObject")
+        tmp = f"{Filename}.{uuid.uuid4().hex[:8]}"
+        try:
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, Filename)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def copy_object(
+        self, CopySource: dict, Bucket: str, Key: str, CopySourceIfMatch=None, **kwargs
+    ):
+        path, meta = self._meta(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        self._check_etag(meta, CopySourceIfMatch, "CopyObject")
+        with open(path, "rb") as f:
+            tmp, etag, _ = self._write_temp(f)
+        headers = meta["headers"]
+        if kwargs.get("MetadataDirective") == "REPLACE":
+            headers = self._headers(kwargs)
+        self._commit(Bucket, Key, tmp, etag, [], headers, "CopyObject")
+        return {"CopyObjectResult": {"ETag": _quote(etag)}}
+
+    def _upload_path(self, upload_id: str, operation: str):
+        path = self._meta_root.joinpath("uploads", upload_id)
+        if not path.is_dir():
+            raise _error("NoSuchUpload", 404, operation, f"no such upload {upload_id}")
+        return path
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs):
+        self._object_path(Bucket, Key, "CreateMultipartUpload")
+        upload_id = uuid.uuid4().hex
+        path = self._meta_root.joinpath("uploads", upload_id)
+        os.makedirs(path)
+        with open(path.joinpath("upload.json"), "w") as f:
+            json.dump(
+                {"bucket": Bucket, "key": Key, "headers": self._headers(kwargs)}, f
+            )
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _write_part(self, upload_id: str, part_number: int, data: bytes, operation):
+        path = self._upload_path(upload_id, operation)
+        if not 1 <= part_number <= 10000:
+            raise _error("InvalidArgument", 400, operation, "invalid part number")
+        tmp = self._temp_path()
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path.joinpath(f"{part_number:05d}.part"))
+        return _quote(hashlib.md5(data).hexdigest())
+
+    def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body=b"", **kwargs
+    ):
+        if not isinstance(Body, (bytes, bytearray)):
+            Body = Body.read()
+        return {"ETag": self._write_part(UploadId, PartNumber, Body, "UploadPart")}
+
+    def upload_part_copy(
+        self,
+        Bucket: str,
+        Key: str,
+        UploadId: str,
+        PartNumber: int,
+        CopySource: dict,
+        CopySourceRange=None,
+        CopySourceIfMatch=None,
+        **kwargs,
+    ):
+        response = self.get_object(
+            CopySource["Bucket"],
+            CopySource["Key"],
+            Range=CopySourceRange,
+            IfMatch=CopySourceIfMatch,
+        )
+        with response["Body"] as body:
+            data = body.read()
+        etag = self._write_part(UploadId, PartNumber, data, "UploadPartCopy")
+        return {"CopyPartResult": {"ETag": etag}}
+
+    def _list_parts(self, Bucket: str, Key: str, UploadId: str, **kwargs):
+        path = self._upload_path(UploadId, "ListParts")
+        parts = []
+        for part_file in sorted(path.glob("*.part")):
+            data = part_file.read_bytes()
+            parts.append(
+                {
+                    "PartNumber": int(part_file.stem),
+                    "ETag": _quote(hashlib.md5(data).hexdigest()),
+                    "Size": len(data),
+                }
+            )
+        yield {"Bucket": Bucket, "Key": Key, "UploadId": UploadId, "Parts": parts}
+
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **kwargs
+    ):
+        path = self._upload_path(UploadId, "CompleteMultipartUpload")
+        with open(path.joinpath("upload.json"), "r") as f:
+            upload = json.load(f)
+
+        tmp = self._temp_path()
+        digests = []
+        part_sizes = []
+        with open(tmp, "wb") as f:
+            for part in MultipartUpload["Parts"]:
+                part_file = path.joinpath(f"{part['PartNumber']:05d}.part")
+                try:
+                    data = part_file.read_bytes()
+                except FileNotFoundError:
+                    raise _error("InvalidPart", 400, "CompleteMultipartUpload")
+                digest = hashlib.md5(data)
+                if part["ETag"].strip('"') != digest.hexdigest():
+                    raise _error("InvalidPart", 400, "CompleteMultipartUpload")
+                f.write(data)
+                digests.append(digest.digest())
+                part_sizes.append(len(data))
+
+        etag = self._commit(
+            Bucket,
+            Key,
+            tmp,
+            _multipart_etag(digests),
+            part_sizes,
+            upload["headers"],
+            "CompleteMultipartUpload",
+        )
+        shutil.rmtree(path)
+        return {"Bucket": Bucket, "Key": Key, "ETag": etag}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs):
+        shutil.rmtree(self._upload_path(UploadId, "AbortMultipartUpload"))
+        return {}
+
+    # pages of up to PageSize keys in S3 order (by UTF-8 bytes). With a delimiter, the keys below
+    # the next delimiter after the prefix are rolled up into CommonPrefixes. A continuation token
+    # is the last key or common prefix of the previous page
+    def _list_objects_v2(
+        self,
+        Bucket: str,
+        Prefix: str = "",
+        Delimiter: str = None,
+        StartAfter: str = None,
+        PaginationConfig: dict = None,
+        ContinuationToken: str = None,
+        **kwargs,
+    ):
+        bucket_path = self.root.joinpath(Bucket)
+        if not bucket_path.is_dir():
+            raise _error(
+                "NoSuchBucket", 404, "ListObjectsV2", f"no such bucket {Bucket}"
+            )
+        page_size = (PaginationConfig or {}).get("PageSize", 1000)
+
+        # only walk the folder the prefix points into
+        start_dir = bucket_path.joinpath(os.path.dirname(Prefix))
+        keys = []
+        for root, dirs, files in os.walk(start_dir):
+            rel_root = os.path.relpath(root, bucket_path)
+            for name in files:
+                key = (
+                    name
+                    if rel_root == "."
+                    else f"{rel_root}/{name}".replace(os.sep, "/")
+                )
+                if key.startswith(Prefix) and (StartAfter is None or key > StartAfter):
+                    if ContinuationToken is None or _is_after(
+                        key, ContinuationToken, Delimiter
+                    ):
+                        keys.append(key)
+        keys.sort(key=lambda k: k.encode("utf-8"))
+
+        page = {"Contents": [], "CommonPrefixes": []}
+        common_prefixes = set()
+        for key in keys:
+            if Delimiter:
+                position = key.find(Delimiter, len(Prefix))
+                if position >= 0:
+                    common_prefix = key[: position + len(Delimiter)]
+                    if common_prefix in common_prefixes:
+                        continue
+                    common_prefixes.add(common_prefix)
+                    page["CommonPrefixes"].append({"Prefix": common_prefix})
+                    if len(page["Contents"]) + len(page["CommonPrefixes"]) >= page_size:
+                        yield self._page(Bucket, Prefix, page, True)
+                        page = {"Contents": [], "CommonPrefixes": []}
+                    continue
+            try:
+                path, meta = self._meta(Bucket, key, "ListObjectsV2")
+            except ClientError:
+                # removed while listing
+                continue
+            page["Contents"].append(
+                {
+                    "Key": key,
+                    "Size": meta["size"],
+                    "ETag": _quote(meta["etag"]),
+                    "LastModified": self._head(meta)["LastModified"],
+                    "StorageClass": "STANDARD",
+                }
+            )
+            if len(page["Contents"]) + len(page["CommonPrefixes"]) >= page_size:
+                yield self._page(Bucket, Prefix, page, True)
+                page = {"Contents": [], "CommonPrefixes": []}
+        yield self._page(Bucket, Prefix, page, False)
+
+    @staticmethod
+    def _page(bucket: str, prefix: str, page: dict, truncated: bool):
+        response = {
+            "Name": bucket,
+            "Prefix": prefix,
+            "KeyCount": len(page["Contents"]) + len(page["CommonPrefixes"]),
+            "IsTruncated": truncated,
+        }
+        # as in S3, empty lists are left out of the response
+        for name in ("Contents", "CommonPrefixes"):
+            if len(page[name]) > 0:
+                response[name] = page[name]
+        return response
+
+    # a single page of a listing, as the list_objects_v2 call of the S3 client
+    def list_objects_v2(self, Bucket: str, MaxKeys: int = 1000, **kwargs):
+        pages = self._list_objects_v2(
+            Bucket=Bucket, PaginationConfig={"PageSize": MaxKeys}, **kwargs
+        )
+        response = next(pages)
+        pages.close()
+        if response["IsTruncated"]:
+            last = [obj["Key"] for obj in response.get("Contents", [])[-1:]] + [
+                common["Prefix"] for common in response.get("CommonPrefixes", [])[-1:]
+            ]
+            response["NextContinuationToken"] = max(
+                last, key=lambda k: k.encode("utf-8")
+            )
+        return response
+
+    def list_parts(self, Bucket: str, Key: str, UploadId: str, **kwargs):
+        return next(self._list_parts(Bucket, Key, UploadId))
+
+    def get_paginator(self, operation_name: str):
+        if operation_name == "list_objects_v2":
+            return _Paginator(self._list_objects_v2)
+        if operation_name == "list_parts":
+            return _Paginator(self._list_parts)
+        # as the S3 client does for an operation without pages
+        raise OperationNotPageableError(operation_name=operation_name)
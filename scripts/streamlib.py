@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# streaming store. A store task with "stream": true watches its source folder while the tasks run,
+# and stores each output subtree as soon as it is complete: when it holds the marker file, or when
+# nothing in it has changed for the settle time. When the store phase reaches the task, the watcher
+# stops and a final sweep stores whatever is new or changed since, so the job ends about one upload
+# after the last computation.
+import contextvars
+import os
+import threading
+import time
+from pathlib import Path
+
+import manifestlib
+import metricslib
+import s3lib
+import tracelib
+import ziplib
+
+# how often the watchers look at their source folders
+POLL_SECONDS = float(os.getenv("STREAM_POLL_SECONDS", "5"))
+
+# task name: watcher, of the store tasks being streamed
+_watchers = {}
+
+
+def is_streaming():
+    return len(_watchers) > 0
+
+
+# {file: (size, mtime)} of the files under path
+def _signature(path: Path):
+    signature = {}
+    for file in Path(path).rglob("*"):
+        try:
+            if file.is_file() and not "DS_Store" in file.name:
+                stat = file.stat()
+                signature[str(file)] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            # removed while scanning
+            pass
+    return signature
+
+
+# {directory: mtime} of path and the directories below it. It changes when files are added, removed
+# or renamed, and is read without a stat of every file
+def _directory_signature(path: Path):
+    signature = {}
+    for directory, _, _ in os.walk(path):
+        try:
+            signature[directory] = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            # removed while scanning
+            pass
+    return signature
+
+
+# the directories depth levels below source, the subtrees that are stored as a whole
+def _units(source: Path, depth: int):
+    units = [Path(source)]
+    for level in range(depth):
+        units = [child for unit in units for child in unit.iterdir() if child.is_dir()]
+    return sorted(units)
+
+
+class StoreWatcher(threading.Thread):
+    def __init__(self, task: dict):
+        super().__init__(daemon=True)
+        self.task_name = task["name"]
+        self.bucket = task["bucket"]
+        self.source = Path(task["source"])
+        self.dest = task["dest"]
+        self.compress = task.get("compressSubDirectories", False)
+        self.zip_shared_memory = task.get("compressInSharedMemory", False)
+        self.remove_on_store = task.get("removeOnStore", True)
+        self.concurrency = task.get("concurrency", s3lib.DEFAULT_CONCURRENCY["threads"])
+        # compressed subdirectories are always the first level
+        self.depth = 1 if self.compress else task.get("streamDepth", 1)
+        self.settle_seconds = task.get("streamSettleSeconds", 30)
+        self.marker = task.get("streamMarker")
+        self.n_stored = 0
+        # the signature and directory signature of each unit when it was stored, and the signature
+        # of each file when not compressing
+        self._stored_units = {}
+        self._stored_directories = {}
+        self._stored_files = {}
+        # unit: (signature, time first seen) of the units not yet complete
+        self._pending = {}
+        self._stopping = threading.Event()
+        # the streamed objects count in the store phase started in the calling thread
+        self._context = contextvars.copy_context()
+
+    def run(self):
+        self._context.run(self._watch)
+
+    def _watch(self):
+        while not self._stopping.wait(POLL_SECONDS):
+            try:
+                self.scan(final=False)
+            except Exception as err:
+                # the final sweep stores what could not be stored here
+                print(f"error streaming store task [{self.task_name}]: {str(err)}")
+
+    # stores the units that are complete, or all the units that changed when final. Stored units
+    # are only read again when a file was added or removed in them, the final sweep also finds
+    # files rewritten in place. Returns the last non-zero return code of the units stored
+    def scan(self, final: bool):
+        return_code = 0
+        if not self.source.is_dir():
+            return return_code
+
+        for unit in _units(self.source, self.depth):
+            directories = _directory_signature(unit)
+            if not final and self._stored_directories.get(unit) == directories:
+                continue
+            signature = _signature(unit)
+            if len(signature) == 0 or self._stored_units.get(unit) == signature:
+                continue
+            if not final and not self._is_complete(unit, signature):
+                continue
+
+            with tracelib.span(self.task_name, "store", unit=str(unit)):
+                rc = self._store_unit(unit, signature)
+            if rc == 0:
+                self._stored_units[unit] = signature
+                self._stored_directories[unit] = directories
+                self._pending.pop(unit, None)
+                self.n_stored += 1
+            else:
+                return_code = rc
+
+        if final and not self.compress:
+            # files outside of the units
+            rc = self._store_files(_signature(self.source))
+            if rc != 0:
+                return_code = rc
+        return return_code
+
+    def _is_complete(self, unit: Path, signature: dict):
+        if self.marker is not None:
+            return unit.joinpath(self.marker).exists()
+
+        now = time.monotonic()
+        pending = self._pending.get(unit)
+        if pending is None or pending[0] != signature:
+            self._pending[unit] = (signature, now)
+            return False
+        return now - pending[1] >= self.settle_seconds
+
+    def _store_unit(self, unit: Path, signature: dict):
+        if not self.compress:
+            return self._store_files(signature)
+
+        tmp_zip = ziplib.temp_zip_path(unit, self.zip_shared_memory)
+        return_code = ziplib.compress(source_path=unit, zip_path=tmp_zip)
+        if return_code != 0:
+            return return_code
+
+        key = Path(self.dest).joinpath(Path(tmp_zip).name)
+        return_code = s3lib.write_s3_object(
+            bucket_name=self.bucket, key=str(key), file=tmp_zip
+        )
+        if self.remove_on_store:
+            os.remove(tmp_zip)
+        return return_code
+
+    # the key of a file below the source, under dest
+    def _key(self, file: str):
+        dest = self.dest if self.dest.endswith("/") else self.dest + "/"
+        return (dest + Path(file).relative_to(self.source).as_posix()).replace(
+            "//", "/"
+        )
+
+    # uploads the files of signature that are new or changed since they were stored
+    def _store_files(self, signature: dict):
+        changed = {
+            file: self._key(file)
+            for file in signature
+            if self._stored_files.get(file) != signature[file]
+        }
+        if len(changed) == 0:
+            return 0
+        client = s3lib.get_client(min_connections=s3lib.max_threads(self.concurrency))
+
+        print(
+            f"streaming {len(changed)} files from {self.source} to s3://{self.bucket}/{self.dest}"
+        )
+        results = {}
+
+        def put(file, key):
+            results[file] = s3lib.put_file(self.bucket, client, Path(file), key)
+            return results[file]
+
+        jobs = ((put, (file, key), signature[file][0]) for file, key in changed.items())
+        return_code = s3lib.run_pipelined(jobs, self.concurrency)
+        for file, rc in results.items():
+            if rc == 0:
+                self._stored_files[file] = signature[file]
+        return return_code
+
+    # stops watching, without storing what remains
+    def cancel(self):
+        self._stopping.set()
+        self.join()
+
+    # stops watching and stores whatever is new or changed
+    def finish(self):
+        self.cancel()
+        if not self.source.exists():
+            print(
+                f"error: source path for store task [{self.task_name}] does not exists: {self.source}"
+            )
+            return 43
+        return_code = self.scan(final=True)
+        print(
+            f"streaming store task [{self.task_name}]: stored {self.n_stored} subtrees of {self.source}"
+        )
+        return return_code
+
+
+# starts watching the source of each store task with "stream": true that runs in this mode, before
+# the tasks run
+def start(tasks_store: list, mode: str, prior_errors: bool = False):
+    for task in tasks_store:
+        if not task.get("stream", False):
+            continue
+        if prior_errors and not task.get("required", False):
+            continue
+        if "includeWhenMode" in task and mode not in task["includeWhenMode"]:
+            continue
+        if "excludeWhenMode" in task and mode in task["excludeWhenMode"]:
+            continue
+        if task.get("pack", False) or (
+            task.get("compress", False)
+            and not task.get("compressSubDirectories", False)
+        ):
+            print(
+                f"store task [{task['name']}] stores its source as a whole, it is stored after the tasks"
+            )
+            continue
+
+        if len(_watchers) == 0:
+            # the store phase starts now, its metrics and manifest include the streamed objects
+            metricslib.reset()
+            manifestlib.start()
+        print(f"streaming store task [{task['name']}]: watching {task['source']}")
+        watcher = StoreWatcher(task)
+        _watchers[task["name"]] = watcher
+        watcher.start()
+
+
+# the watcher of a store task, which stops being tracked, or None when the task is not streamed
+def stop(name: str):
+    return _watchers.pop(name, None)
+
+
+# stops the watchers the store phase did not finish, e.g. when it was skipped after an error
+def stop_all():
+    for name in list(_watchers):
+        _watchers.pop(name).cancel()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# job timeline trace. When enabled, the phases of the job and their operations (fetch and store
+# tasks, transfers, expansions, compressions, moves and the items of each process task) are
+# recorded as spans with the thread they ran on and the bytes they moved. The trace is written in
+# the Chrome trace event format, which chrome://tracing and https://ui.perfetto.dev display as a
+# timeline of the job.
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+# the trace is recorded when a file or an S3 location is given
+TRACE_FILE = os.getenv("JOB_TRACE_FILE")
+# e.g. s3://my-bucket/output/, the trace is stored there as <WORK_ITEM>.trace.json
+TRACE_S3 = os.getenv("JOB_TRACE_S3")
+# the most spans recorded, those after are counted but dropped
+MAX_EVENTS = int(os.getenv("JOB_TRACE_MAX_EVENTS", "200000"))
+
+_origin = time.perf_counter()
+_events = []
+_n_dropped = 0
+# thread ident: the small id it is shown with
+_threads = {}
+_lock = threading.Lock()
+
+
+def is_enabled():
+    return bool(TRACE_FILE) or bool(TRACE_S3)
+
+
+def _thread_id():
+    ident = threading.get_ident()
+    tid = _threads.get(ident)
+    if tid is None:
+        tid = len(_threads) + 1
+        _threads[ident] = tid
+        _events.append(
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": threading.current_thread().name},
+            }
+        )
+    return tid
+
+
+# records an operation that ran from start to end (from time.perf_counter) on this thread
+def complete(name: str, category: str, start: float, end: float = None, **args):
+    global _n_dropped
+    if not is_enabled():
+        return
+    if end is None:
+        end = time.perf_counter()
+    with _lock:
+        if len(_events) >= MAX_EVENTS:
+            _n_dropped += 1
+            return
+        _events.append(
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - _origin) * 1e6, 1),
+                "dur": round((end - start) * 1e6, 1),
+                "pid": os.getpid(),
+                "tid": _thread_id(),
+                "args": args,
+            }
+        )
+
+
+# a span recorded when its 'with' block ends. Arguments known only at the end, such as the bytes
+# moved, can be added to args
+class Span:
+    def __init__(self, name: str, category: str, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = str(exc_value)
+        complete(self.name, self.category, self.start, **self.args)
+        return False
+
+
+def span(name: str, category: str, **args):
+    return Span(name, category, **args)
+
+
+# writes the trace to JOB_TRACE_FILE, or ./logs/trace.json, and stores it under JOB_TRACE_S3
+def write():
+    if not is_enabled():
+        return 0
+    with _lock:
+        trace = {
+            "traceEvents": list(_events),
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "workItem": os.getenv("WORK_ITEM"),
+                "jobId": os.getenv("AWS_BATCH_JOB_ID"),
+                "droppedEvents": _n_dropped,
+            },
+        }
+    path = Path(TRACE_FILE or "./logs/trace.json")
+    try:
+        os.makedirs(path.parent, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(trace, f, separators=(",", ":"))
+    except OSError as err:
+        print(f"error writing the job trace {path}: {str(err)}")
+        return 224
+    print(f"job trace: {len(trace['traceEvents'])} events written to {path}")
+
+    if TRACE_S3:
+        import s3lib
+
+        bucket, _, prefix = TRACE_S3[len("s3://") :].partition("/")
+        if len(prefix) > 0 and not prefix.endswith("/"):
+            prefix += "/"
+        name = "".join(
+            c if c.isalnum() or c in "-_." else "-"
+            for c in os.getenv("WORK_ITEM") or os.getenv("AWS_BATCH_JOB_ID", "local")
+        )
+        key = f"{prefix}{name}.trace.json"
+        try:
+            s3lib.get_client().upload_file(str(path), bucket, key)
+        except Exception as err:
+            print(f"error storing the job trace to s3://{bucket}/{key}: {str(err)}")
+            return 224
+        print(f"job trace stored to s3://{bucket}/{key}")
+    return 0
@@ -4,6 +4,7 @@ import argparse
 import pathlib
 
 import clilib
+import metricslib
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -35,19 +36,42 @@ parser.add_argument(
     "-threads",
     dest="threads",
     type=int,
-    help="the number of threads used in uploading files",
-    default=10,
+    help="the number of concurrent transfers, by default the number of threads adapts to the throughput, or 200 requests with -engine async",
+)
+parser.add_argument(
+    "-engine",
+    dest="engine",
+    choices=["threads", "async"],
+    help="the transfer engine. 'async' keeps many more requests in flight for small files and requires aiobotocore",
+    default="threads",
+)
+parser.add_argument(
+    "-sync",
+    dest="sync",
+    action="store_true",
+    help="upload only new or changed files, comparing size and MD5 with the files already in s3",
+)
+parser.add_argument(
+    "-metrics-file",
+    dest="metricsFile",
+    help="append the JSON summary of the transfer metrics to this file. It is always printed",
 )
 
 
 def main(args):
+    if args.metricsFile is not None:
+        metricslib.METRICS_FILE = args.metricsFile
+    metricslib.reset()
     clilib.upload(
         bucket_name=args.bucket,
         local_folder=args.localFolder,
         prefix=args.prefix,
         filter=args.filter,
         thread_count=args.threads,
+        engine=args.engine,
+        sync=args.sync,
     )
+    metricslib.report("upload_inputs")
 
 
 if __name__ == "__main__":
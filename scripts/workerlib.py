@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+# cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
+# persistent python worker processes for 'callable' tasks. A shell task pays for a shell, a new
+# interpreter and its imports (numpy, pandas, pystrata...) for every item. A callable task names a
+# function as 'module:function', and its items are run by a pool of worker processes that import
+# the module once and then run item after item. The pool can be started before the fetch, so the
+# imports happen while the inputs download.
+import concurrent.futures
+import importlib
+import multiprocessing
+import os
+import queue
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+# how often a running item is checked for its timeout and for cancellation
+POLL_SECONDS = 0.1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# the module of a 'module:function' target
+def target_module(target: str):
+    return target.partition(":")[0]
+
+
+def _resolve(target: str):
+    module_name, _, attribute = target.partition(":")
+    fn = importlib.import_module(module_name)
+    for name in attribute.split("."):
+        fn = getattr(fn, name)
+    return fn
+
+
+# the current and peak RSS of this process in bytes, from /proc/self/status
+def _rss():
+    rss = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmRSS", "VmHWM"):
+                    rss[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return rss.get("VmRSS"), rss.get("VmHWM")
+
+
+def _cpu_seconds():
+    seconds = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        seconds += usage.ru_utime + usage.ru_stime
+    return seconds
+
+
+# resets the peak RSS of this process to its current RSS. Returns False where it is not supported
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+# runs one item in a worker process, with stdout and stderr redirected to the log files when
+# given. Redirecting the file descriptors also captures the output of native code. Returns the
+# return code: the int the function returns (None is 0), the code of a SystemExit, or 1 when it
+# raises, the memory the item added to the worker at its peak (None when unknown), and the CPU
+# seconds of the worker and of the processes the item waited for
+def _run_item(target: str, args: list, out_path: str, err_path: str):
+    saved = []
+    cwd = os.getcwd()
+    return_code = 0
+    start_rss = _rss()[0] if _reset_peak_rss() else None
+    start_cpu = _cpu_seconds()
+    try:
+        if out_path is not None:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, path in ((1, out_path), (2, err_path)):
+                saved.append((fd, os.dup(fd)))
+                log_fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.dup2(log_fd, fd)
+                os.close(log_fd)
+
+        # for functions that read their arguments like a script
+        sys.argv = [target] + list(args)
+        result = _resolve(target)(list(args))
+        if isinstance(result, int):
+            return_code = result
+    except SystemExit as ex:
+        if ex.code is None:
+            return_code = 0
+        elif isinstance(ex.code, int):
+            return_code = ex.code
+        else:
+            print(ex.code, file=sys.stderr)
+            return_code = 1
+    except BaseException:
+        traceback.print_exc()
+        return_code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in saved:
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        # items do not see the working directory an earlier item changed to
+        os.chdir(cwd)
+
+    peak_rss = None
+    peak = _rss()[1]
+    if start_rss is not None and peak is not None:
+        peak_rss = max(0, peak - start_rss)
+    return return_code, peak_rss, _cpu_seconds() - start_cpu
+
+
+def _worker_main(conn, modules: list):
+    # a process group of its own, so the processes an item starts are stopped with the worker
+    os.setsid()
+    # tasks run from the work directory, their modules may be found there
+    if os.getcwd() not in sys.path:
+        sys.path.append(os.getcwd())
+    for module_name in modules:
+        try:
+            importlib.import_module(module_name)
+        except BaseException:
+            # reported when an item calls into the module
+            pass
+    conn.send("ready")
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        conn.send(_run_item(*request))
+
+
+class _Worker:
+    def __init__(self, context, modules: list):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, modules), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def _signal_group(self, sig: int):
+        try:
+            os.killpg(self.process.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    # stops the worker and the processes its item started: at once with kill, after grace seconds
+    # of SIGTERM with terminate, and otherwise when it has finished its item
+    def stop(self, kill: bool = False, terminate: bool = False, grace: float = 0):
+        if terminate:
+            self._signal_group(signal.SIGTERM)
+            self.process.join(grace)
+            kill = True
+        if kill:
+            self._signal_group(signal.SIGKILL)
+            self.process.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+# a pool of worker processes. With the forkserver start method the modules are imported once by
+# the server, and each worker is forked from it already warm, also when a worker is replaced after
+# a timeout. Elsewhere each worker imports the modules when it starts
+class WorkerPool:
+    def __init__(self, modules: list):
+        self.modules = list(dict.fromkeys(modules))
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self.context = multiprocessing.get_context("forkserver")
+            self.context.set_forkserver_preload(self.modules)
+        else:
+            self.context = multiprocessing.get_context("spawn")
+        self.size = 0
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+
+    def _new_worker(self):
+        return _Worker(self.context, self.modules)
+
+    # starts workers until there are size of them
+    def grow(self, size: int):
+        with self._lock:
+            while self.size < size:
+                self._idle.put(self._new_worker())
+                self.size += 1
+
+    # runs target(args) in an idle worker and returns its return code, the memory the item used
+    # at its peak and its CPU seconds (None when unknown). A worker that times out is killed and replaced, and
+    # subprocess.TimeoutExpired is raised as for shell commands. When cancel is set, the worker
+    # is terminated, killed after grace seconds, replaced, and concurrent.futures.CancelledError
+    # is raised. A worker that dies returns its exit code, negative for a signal
+    def run(
+        self,
+        target: str,
+        args: list,
+        timeout: int,
+        out_path=None,
+        err_path=None,
+        cancel: threading.Event = None,
+        grace: float = 0,
+    ):
+        worker = self._idle.get()
+        try:
+            if not worker.ready:
+                # the imports were made when the worker started
+                worker.conn.recv()
+                worker.ready = True
+            worker.conn.send((target, list(args), out_path, err_path))
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not worker.conn.poll(POLL_SECONDS):
+                if cancel is not None and cancel.is_set():
+                    worker.stop(terminate=True, grace=grace)
+                    worker = self._new_worker()
+                    raise concurrent.futures.CancelledError()
+                if deadline is not None and time.monotonic() >= deadline:
+                    worker.stop(kill=True)
+                    worker = self._new_worker()
+                    raise subprocess.TimeoutExpired(
+                        f"{target} {' '.join(args)}", timeout
+                    )
+            return worker.conn.recv()
+        except (EOFError, OSError):
+            worker.process.join()
+            return_code = worker.process.exitcode
+            worker.conn.close()
+            worker = self._new_worker()
+            return (return_code if return_code is not None else 1), None, None
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        with self._lock:
+            while self.size > 0:
+                self._idle.get().stop()
+                self.size -= 1
+
+
+# the pool shared by the callable tasks of the job, started with size workers that import modules
+def get_pool(modules: list, size: int):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            print(
+                f"starting {size} python workers, importing: {', '.join(dict.fromkeys(modules))}"
+            )
+            _pool = WorkerPool(modules)
+    _pool.grow(size)
+    return _pool
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
@@ -1,10 +1,27 @@
 #!/usr/bin/python3
 # cloudburst framework - Bruce Hearn 2021 bruce.hearn@gmail.com
 import os
+import tarfile
 from pathlib import Path
 
+import tracelib
+
+# runs an archive operation as a span of the job trace, with the size of the archive
+def _traced(operation: str, archive, fn, *args):
+    with tracelib.span(operation, "archive", archive=str(archive)) as trace_args:
+        return_code = fn(*args)
+        trace_args["return_code"] = return_code
+        if os.path.isfile(archive):
+            trace_args["bytes"] = os.path.getsize(archive)
+    return return_code
+
+
 # Compresses a 7zip archive, providing exception handling and logging
 def compress(zip_path: Path, source_path: Path):
+    return _traced("compress", zip_path, _compress, zip_path, source_path)
+
+
+def _compress(zip_path: Path, source_path: Path):
     zip_path = Path(zip_path)
     source_path = Path(source_path)
 
@@ -29,8 +46,28 @@ def compress(zip_path: Path, source_path: Path):
         return 211
 
 
+# the temporary archive a directory is compressed to before it is stored: next to the directory, or
+# under /dev/shm/ when compressing in shared memory
+def temp_zip_path(source_path: str, shared_memory: bool = False):
+    src = str(source_path)
+    # trim trailing / character
+    if src[-1] == "/":
+        src = src[0:-1]
+    if shared_memory:
+        if src[0] == ".":
+            src = src[1:]
+        if src[0] == "/":
+            src = src[1:]
+        return "/dev/shm/" + src + ".7z"
+    return src + ".7z"
+
+
 # expands a 7z archive from path to destination
 def expand(source_path: str, destination_path: str):
+    return _traced("expand", source_path, _expand, source_path, destination_path)
+
+
+def _expand(source_path: str, destination_path: str):
     print(f"expanding: {source_path} to {destination_path}")
     os.makedirs(destination_path, exist_ok=True)
 
@@ -48,3 +85,73 @@ def expand(source_path: str, destination_path: str):
     except Exception as err:
         print(f"error unzipping {source_path} to {destination_path}: {str(err)}")
         return 212
+
+
+# archive types that can be expanded while they are being read, i.e. without a seekable file
+STREAM_ARCHIVE_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def is_stream_archive(path: str):
+    return str(path).lower().endswith(STREAM_ARCHIVE_SUFFIXES)
+
+
+# Compresses a folder into a tar archive that can later be expanded from a stream with expand_stream()
+def compress_tar(zip_path: Path, source_path: Path):
+    return _traced("compress", zip_path, _compress_tar, zip_path, source_path)
+
+
+def _compress_tar(zip_path: Path, source_path: Path):
+    zip_path = Path(zip_path)
+    source_path = Path(source_path)
+
+    print(f"compressing: {source_path} to: {zip_path}")
+    if not zip_path.parent is None and not zip_path.parent.exists():
+        os.makedirs(zip_path.parent, exist_ok=True)
+
+    mode = "w"
+    kwargs = {}
+    name = zip_path.name.lower()
+    if name.endswith(".gz") or name.endswith(".tgz"):
+        mode = "w:gz"
+        kwargs["compresslevel"] = 1
+    elif name.endswith(".bz2"):
+        mode = "w:bz2"
+    elif name.endswith(".xz"):
+        mode = "w:xz"
+
+    try:
+        with tarfile.open(zip_path, mode, **kwargs) as tar:
+            # like 7z, the archive contains the folder itself rather than its full path
+            tar.add(source_path.resolve(), arcname=source_path.resolve().name)
+        return 0
+    except Exception as err:
+        print(f"error zipping {source_path} to {zip_path}: {str(err)}")
+        return 211
+
+
+# expands a tar archive from a readable, non-seekable stream (e.g. an S3 object body) to destination.
+# Members are written as they arrive, so the archive itself is never stored on disk
+def expand_stream(stream, destination_path: str, name: str = "stream"):
+    return _traced("expand", name, _expand_stream, stream, destination_path, name)
+
+
+def _expand_stream(stream, destination_path: str, name: str = "stream"):
+    print(f"expanding: {name} to {destination_path}")
+    os.makedirs(destination_path, exist_ok=True)
+    root = os.path.realpath(destination_path)
+
+    try:
+        with tarfile.open(fileobj=stream, mode="r|*") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extraction_filter = tarfile.data_filter
+            for member in tar:
+                # refuse members that would be written outside the destination folder
+                target = os.path.realpath(os.path.join(root, member.name))
+                if os.path.commonpath([root, target]) != root:
+                    print(f"error unzipping {name}: unsafe path {member.name}")
+                    return 212
+                tar.extract(member, root)
+        return 0
+    except Exception as err:
+        print(f"error unzipping {name} to {destination_path}: {str(err)}")
+        return 212
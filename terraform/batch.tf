@@ -69,7 +69,9 @@ resource "aws_batch_job_definition" "aws_jobdef" {
       "environment": [
         {"name": "AWS_REGION", "value": ""},
         {"name": "BUCKET_NAME", "value": ""},
-        {"name": "MODE_STR", "value": ""}
+        {"name": "MODE_STR", "value": ""},
+        {"name": "TRANSFER_JOURNAL_S3", "value": ""},
+        {"name": "OUTPUT_MANIFEST_S3", "value": ""}
       ],
       "networkConfiguration": {
          "assignPublicIp": "ENABLED"